@@ -0,0 +1,221 @@
+"""
+Times the cold start of each handler in fresh interpreters: importing its module, its first
+invocation and a warm one.
+
+A cold Lambda container imports the handler's module, then runs the first invocation, which pays for
+whatever the module left to first use. Each run starts a new Python process per handler, so nothing
+is imported or cached beforehand. The query handler serves an entity from a SQLite store filled
+beforehand; the import handler verifies a synthetic aggregate and stores it into a new SQLite table.
+A local store keeps the network out of the timings, so they are those of the code and its imports;
+'clientMs' is what creating the DynamoDb client costs the query handler's first invocation on top,
+and 'warmClientMs' what it costs once the container holds the client. Reported are the medians of
+the runs and the heavy modules loaded after the import and after the first invocation.
+
+Run from the project directory:
+```
+python -m benchmarks.bench_cold_start --runs 10 --entities 200
+```
+"""
+
+from __future__ import print_function
+
+import argparse
+import importlib
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from urllib import parse
+
+# Modules a handler should only load on the paths that need them
+HEAVY_MODULES = ('boto3', 'botocore', 'lxml', 'signxml', 'cryptography', 'OpenSSL', 'sqlite3')
+PROVIDER = 'Benchmark'
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def loaded_modules():
+    return [name for name in HEAVY_MODULES if name in sys.modules]
+
+
+def child_query(options):
+    """
+    Runs in a fresh interpreter: imports queryMetadata and serves the entity twice
+    """
+    os.environ['METADATA_STORE'] = options['store']
+    os.environ['METADATA_TABLE'] = options['table']
+    os.environ['ENTITY_CACHE_TTL'] = '0'
+    results = {}
+
+    start = time.perf_counter()
+    query_metadata = importlib.import_module('src.lambda_scripts.queryMetadata')
+    results['importMs'] = (time.perf_counter() - start) * 1000
+    results['importLoaded'] = loaded_modules()
+
+    event = {'params': {'path': {'entityId': parse.quote(options['entityId'], safe='')},
+                        'header': {'If-None-Match': ''}}}
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        for name in ('firstInvocationMs', 'warmInvocationMs'):
+            start = time.perf_counter()
+            status = query_metadata.lambda_handler(event, None)['status']
+            results[name] = (time.perf_counter() - start) * 1000
+            if status != '200':
+                raise RuntimeError('query answered %s' % status)
+    results['invocationLoaded'] = loaded_modules()
+
+    for name in ('clientMs', 'warmClientMs'):
+        start = time.perf_counter()
+        query_metadata.get_dynamodb_client()
+        results[name] = (time.perf_counter() - start) * 1000
+    return results
+
+
+def child_import(options):
+    """
+    Runs in a fresh interpreter: imports importMetadata, then verifies and stores the aggregate
+    """
+    results = {}
+    start = time.perf_counter()
+    import_metadata = importlib.import_module('src.lambda_scripts.importMetadata')
+    results['importMs'] = (time.perf_counter() - start) * 1000
+    results['importLoaded'] = loaded_modules()
+
+    with open(options['aggregate'], 'rb') as handle:
+        document = handle.read()
+    with open(options['cert'], 'r') as handle:
+        our_cert = handle.read()
+    with open(options['key'], 'rb') as handle:
+        our_key = handle.read()
+    event = {'providerName': PROVIDER, 'descriptorType': 'SPSSODescriptor', 'metadataStore': options['store'],
+             'tableName': options['table']}
+
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        start = time.perf_counter()
+        import_metadata.store_metadata(import_metadata.get_and_validate_metadata(document, our_cert), event,
+                                       our_key, our_cert)
+        results['firstInvocationMs'] = (time.perf_counter() - start) * 1000
+    results['invocationLoaded'] = loaded_modules()
+    return results
+
+
+def run_child(handler, options):
+    """
+    :return: the results of one handler in a new interpreter, with 'processMs' the wall clock seconds
+        of the whole process
+    :rtype: dict
+    """
+    env = dict(os.environ)
+    env.setdefault('AWS_DEFAULT_REGION', 'us-west-1')
+    start = time.perf_counter()
+    output = subprocess.check_output([sys.executable, '-m', 'benchmarks.bench_cold_start', '--child', handler,
+                                      '--options', json.dumps(options)], cwd=ROOT, env=env)
+    results = json.loads(output.decode('utf-8'))
+    results['processMs'] = (time.perf_counter() - start) * 1000
+    return results
+
+
+def prepare(directory, entity_count):
+    """
+    Writes a synthetic aggregate and imports it into a SQLite store
+
+    :return: options of the query and import children
+    :rtype: (dict, dict)
+    """
+    from benchmarks import synthetic
+    from src.lambda_scripts import importMetadata
+    from src.lambda_scripts.metadataStore import SQLITE_STORES
+    from src.tests import fixtures
+
+    aggregate = os.path.join(directory, 'aggregate.xml')
+    with open(aggregate, 'wb') as handle:
+        handle.write(synthetic.build_aggregate(entity_count, idp_share=0.0))
+    store = 'sqlite:' + os.path.join(directory, 'metadata.db')
+
+    event = {'providerName': PROVIDER, 'descriptorType': 'SPSSODescriptor', 'metadataStore': store,
+             'tableName': 'query'}
+    with open(aggregate, 'rb') as handle, open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        root = importMetadata.get_and_validate_metadata(handle.read(), fixtures.read_our_cert())
+        importMetadata.store_metadata(root, event, fixtures.read_our_key(), fixtures.read_our_cert())
+    entity_id = sorted(importMetadata.get_metadata_store(event).entity_ids())[0]
+    for sqlite_store in SQLITE_STORES.values():
+        sqlite_store.close()
+    SQLITE_STORES.clear()
+
+    query = {'store': store, 'table': 'query', 'entityId': entity_id}
+    imports = {'store': store, 'aggregate': aggregate, 'cert': fixtures.DUMMY_OUR_CERT, 'key': fixtures.DUMMY_OUR_KEY}
+    return query, imports
+
+
+def summarize(runs):
+    """
+    :return: the median of every timing of the runs, and the modules the last run loaded
+    :rtype: dict
+    """
+    summary = dict((name, statistics.median(run[name] for run in runs))
+                   for name in runs[0] if name.endswith('Ms'))
+    summary['importLoaded'] = runs[-1]['importLoaded']
+    summary['invocationLoaded'] = runs[-1]['invocationLoaded']
+    return summary
+
+
+def run(runs, entity_count):
+    from benchmarks.bench_import_pipeline import git_revision
+
+    directory = tempfile.mkdtemp()
+    try:
+        query, imports = prepare(directory, entity_count)
+        results = {'query': [], 'import': []}
+        for number in range(runs):
+            results['query'].append(run_child('query', query))
+            # Every run imports into an empty table, like the first import of a deployment
+            results['import'].append(run_child('import', dict(imports, table='import%d' % number)))
+    finally:
+        shutil.rmtree(directory)
+
+    return {
+        'benchmark': 'cold_start',
+        'timestamp': time.time(),
+        'revision': git_revision(),
+        'parameters': {'runs': runs, 'entities': entity_count, 'python': sys.version.split()[0]},
+        'handlers': dict((handler, summarize(values)) for handler, values in results.items())
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per handler')
+    parser.add_argument('--entities', type=int, default=100, help='entities in the synthetic aggregate')
+    parser.add_argument('--output', default=None, help='file for the JSON results, - for stdout')
+    parser.add_argument('--child', choices=['query', 'import'], help=argparse.SUPPRESS)
+    parser.add_argument('--options', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child = child_query if args.child == 'query' else child_import
+        print(json.dumps(child(json.loads(args.options))))
+        return
+
+    results = run(args.runs, args.entities)
+    if args.output == '-':
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+    if args.output:
+        with open(args.output, 'w') as handle:
+            handle.write(json.dumps(results, indent=2, sort_keys=True) + '\n')
+
+    output = sys.stderr if args.output else sys.stdout
+    for handler, summary in sorted(results['handlers'].items()):
+        timings = ', '.join('%s %.1f' % (name[:-2], value) for name, value in sorted(summary.items())
+                            if name.endswith('Ms'))
+        print('%-6s ms: %s' % (handler, timings), file=output)
+        print('%-6s loaded by import: %s; by first invocation: %s' % (
+            handler, ' '.join(summary['importLoaded']) or '-', ' '.join(summary['invocationLoaded']) or '-'),
+            file=output)
+
+
+if __name__ == '__main__':
+    main()
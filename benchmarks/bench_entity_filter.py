@@ -0,0 +1,82 @@
+"""
+Measures the entity filter: its size, build time and false positive rate for a number of entities,
+and the cost of ruling out an unknown entityID with it versus a DynamoDb miss (mocked).
+
+Run from the project directory:
+```
+python -m benchmarks.bench_entity_filter --entities 100000 --rates 0.01 0.001 0.0001
+```
+"""
+
+from __future__ import print_function
+
+import argparse
+import io
+import time
+from contextlib import redirect_stdout
+
+from moto import mock_dynamodb2
+
+from src.lambda_scripts import queryMetadata
+from src.lambda_scripts.entityFilter import BloomFilter
+from src.lambda_scripts.metadataStore import DynamoDbStore
+from src.tests import fixtures
+
+UNKNOWN_LOOKUPS = 100000
+
+
+def build(entity_count, rate, max_bytes):
+    entity_filter = BloomFilter.for_capacity(2 * entity_count, rate, max_bytes)
+    start = time.time()
+    for number in range(entity_count):
+        entity_filter.add('https://sp%d.example.org/shibboleth' % number)
+        entity_filter.add('{sha1}%040x' % number)
+    return entity_filter, time.time() - start
+
+
+def time_lookups(entity_filter):
+    identifiers = ['https://unknown%d.example.org' % number for number in range(UNKNOWN_LOOKUPS)]
+    start = time.time()
+    false_positives = sum(1 for identifier in identifiers if identifier in entity_filter)
+    return (time.time() - start) / len(identifiers), float(false_positives) / len(identifiers)
+
+
+@fixtures.aws_environment()
+@mock_dynamodb2
+def time_dynamodb_miss(rounds):
+    dynamo_db = queryMetadata.get_dynamodb_client()
+    fixtures.create_metadata_table(dynamo_db)
+    store = DynamoDbStore(dynamo_db)
+    start = time.time()
+    with redirect_stdout(io.StringIO()):
+        for number in range(rounds):
+            queryMetadata.get_db_record(store, 'https://unknown%d.example.org' % number)
+    return (time.time() - start) / rounds
+
+
+def run(entity_count, rates, max_bytes, rounds):
+    print('%d entities, %d identifiers' % (entity_count, 2 * entity_count))
+    print('%-8s %10s %10s %12s %12s %12s' % ('rate', 'bytes', 'hashes', 'build s', 'measured', 'lookup us'))
+    for rate in rates:
+        entity_filter, built = build(entity_count, rate, max_bytes)
+        lookup, measured = time_lookups(entity_filter)
+        print('%-8g %10d %10d %12.2f %12.5f %12.2f' % (rate, len(entity_filter.to_bytes()), entity_filter.hashes,
+                                                       built, measured, lookup * 1000000))
+
+    print('DynamoDb miss (moto, no network): %.2f ms' % (time_dynamodb_miss(rounds) * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--entities', type=int, default=100000, help='entities held by the filter')
+    parser.add_argument('--rates', type=float, nargs='+', default=[0.01, 0.001, 0.0001],
+                        help='false positive rates to size the filter for')
+    parser.add_argument('--max-bytes', type=int, default=None, help='upper bound of the filter size')
+    parser.add_argument('--rounds', type=int, default=200, help='DynamoDb misses timed')
+    args = parser.parse_args()
+
+    run(args.entities, args.rates, args.max_bytes, args.rounds)
+
+
+if __name__ == '__main__':
+    main()
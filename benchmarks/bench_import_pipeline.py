@@ -0,0 +1,324 @@
+"""
+Times each stage of an import of a synthetic aggregate and writes the results as JSON.
+
+The stages are the ones store_metadata goes through: parse and verify the aggregate, cut the
+fragments of the chosen descriptor type and take their source digests, sign them, serialize the
+signed documents and store them. EntitySigner serializes the document it signs, so 'sign' is its
+time minus that of serializing the signed fragments again, which is 'serialize'. 'import' and
+'reimport' time store_metadata end to end on an empty store and on one that already holds every
+entity. Each stage reports the best of the rounds.
+
+'memory' holds the peak resident set size of an import of the aggregate in a fresh interpreter,
+in memory and streaming, above that of the interpreter before it read the aggregate: after the
+signature check ('verifyPeakBytes') and after the whole import ('peakBytes'). The signature check
+parses the whole aggregate in both modes, so both peaks grow with the aggregate.
+
+Run from the project directory:
+```
+python -m benchmarks.bench_import_pipeline --entities 20000 --idp-share 0.3 --store memory --output import.json
+```
+"""
+
+from __future__ import print_function
+
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+
+import lxml
+from lxml import etree
+from moto import mock_dynamodb2
+
+from benchmarks import synthetic
+from src.lambda_scripts import importMetadata
+from src.lambda_scripts.importMetadata import (URN, EntitySigner, MetadataWriter, entity_digest,
+                                               get_and_validate_metadata, select_fragments, store_metadata,
+                                               verify_metadata_root)
+from src.lambda_scripts.metadataStore import MEMORY_STORES, SQLITE_STORES, open_store
+from src.tests import fixtures
+
+PROVIDER = 'Benchmark'
+
+
+class StoreFactory(object):
+    """
+    Hands out empty stores of one backend: 'memory', 'sqlite' or 'dynamodb' (mocked)
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.directory = tempfile.mkdtemp()
+        self.opened = 0
+        self.mock = None
+        self.environment = None
+        if backend == 'dynamodb':
+            self.environment = fixtures.aws_environment()
+            self.environment.start()
+            self.mock = mock_dynamodb2()
+            self.mock.start()
+
+    def event(self):
+        """
+        :return: event keys selecting a new, empty store
+        :rtype: dict
+        """
+        self.opened += 1
+        table = 'metadata%d' % self.opened
+        if self.backend == 'dynamodb':
+            # The mocked table is created as 'metadata', so each round starts from an empty one
+            dynamo_db = importMetadata.get_dynamodb_client()
+            if self.opened > 1:
+                dynamo_db.delete_table(TableName='metadata')
+            fixtures.create_metadata_table(dynamo_db)
+            return {'metadataStore': 'dynamodb', 'tableName': 'metadata'}
+        if self.backend == 'sqlite':
+            return {'metadataStore': 'sqlite:' + os.path.join(self.directory, 'metadata.db'), 'tableName': table}
+        return {'metadataStore': 'memory', 'tableName': table}
+
+    def store(self, event):
+        return open_store(event['metadataStore'], event['tableName'], importMetadata.get_dynamodb_client)
+
+    def close(self):
+        for store in SQLITE_STORES.values():
+            store.close()
+        SQLITE_STORES.clear()
+        MEMORY_STORES.clear()
+        if self.mock is not None:
+            self.mock.stop()
+            self.environment.stop()
+        shutil.rmtree(self.directory)
+
+
+def time_stages(document, descriptor_type, stores, our_key, our_cert):
+    """
+    :return: stage -> seconds, and the number of entities signed
+    :rtype: (dict, int)
+    """
+    seconds = {}
+
+    start = time.perf_counter()
+    root = etree.fromstring(document)
+    seconds['parse'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    root = verify_metadata_root(root, our_cert)
+    seconds['verify'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    fragments = list(select_fragments(root.iter(URN + 'EntityDescriptor'), descriptor_type, root.attrib['validUntil']))
+    seconds['fragment'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    digests = [entity_digest(fragment, our_cert) for _, fragment in fragments]
+    seconds['digest'] = time.perf_counter() - start
+
+    signer = EntitySigner(our_key, our_cert)
+    start = time.perf_counter()
+    documents = [signer.sign(fragment) for _, fragment in fragments]
+    signed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _, fragment in fragments:
+        etree.tostring(fragment, pretty_print=False, xml_declaration=True, encoding="UTF-8", standalone=True,
+                       with_tail=False)
+    seconds['serialize'] = time.perf_counter() - start
+    seconds['sign'] = max(signed - seconds['serialize'], 0.0)
+
+    store = stores.store(stores.event())
+    start = time.perf_counter()
+    writer = MetadataWriter(store, importMetadata.current_timestamp())
+    for (entity_id, _), doc, digest in zip(fragments, documents, digests):
+        writer.put(entity_id, PROVIDER, doc, digest)
+    counts = writer.close()
+    seconds['store'] = time.perf_counter() - start
+    if counts['failed']:
+        raise RuntimeError('%d writes failed' % counts['failed'])
+
+    return seconds, len(fragments)
+
+
+def time_imports(document, descriptor_type, stores, our_key, our_cert):
+    """
+    :return: seconds of store_metadata on an empty store, then again on the filled one
+    :rtype: dict
+    """
+    event = dict(stores.event(), providerName=PROVIDER, descriptorType=descriptor_type)
+    seconds = {}
+    for stage in ('import', 'reimport'):
+        start = time.perf_counter()
+        store_metadata(get_and_validate_metadata(document, our_cert), event, our_key, our_cert)
+        seconds[stage] = time.perf_counter() - start
+    return seconds
+
+
+def peak_rss():
+    """
+    :return: peak resident set size of this process so far, in bytes
+    :rtype: int
+    """
+    # On Linux getrusage reports the larger peak of the parent across fork and exec, the high water
+    # mark of /proc only covers this program
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, the others kilobytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def child_memory(options):
+    """
+    Runs in a fresh interpreter: imports the aggregate the way lambda_handler does, in memory or
+    streaming, into a memory store
+
+    :return: peak RSS before reading the aggregate, after verifying it and after the import
+    :rtype: dict
+    """
+    our_key = fixtures.read_our_key()
+    our_cert = fixtures.read_our_cert()
+    event = {'providerName': PROVIDER, 'descriptorType': options['descriptorType'], 'metadataStore': 'memory',
+             'tableName': 'metadata'}
+    results = {'baseBytes': peak_rss()}
+
+    with open(options['aggregate'], 'rb') as handle, redirect_stdout(io.StringIO()):
+        if options['streaming']:
+            valid_until = importMetadata.verify_metadata_file(handle, our_cert)
+            results['verifyBytes'] = peak_rss()
+            importMetadata.import_within_budget(handle, importMetadata.iter_entity_descriptors(handle),
+                                                importMetadata.create_checkpoint(valid_until, {}), event, None,
+                                                our_key, our_cert)
+        else:
+            root = get_and_validate_metadata(handle.read(), our_cert)
+            results['verifyBytes'] = peak_rss()
+            importMetadata.import_within_budget(root, root.iter(URN + 'EntityDescriptor'),
+                                                importMetadata.create_checkpoint(root.attrib['validUntil'], {}),
+                                                event, None, our_key, our_cert)
+    results['peakBytes'] = peak_rss()
+    return results
+
+
+def measure_memory(document, descriptor_type):
+    """
+    :return: for the 'inMemory' and 'streaming' import, the peak RSS above that of the interpreter
+        before it read the aggregate, after verifying it and after the import
+    :rtype: dict
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        aggregate = os.path.join(directory, 'aggregate.xml')
+        with open(aggregate, 'wb') as handle:
+            handle.write(document)
+
+        env = dict(os.environ)
+        env.setdefault('AWS_DEFAULT_REGION', fixtures.TEST_REGION)
+        memory = {}
+        for mode, streaming in (('inMemory', False), ('streaming', True)):
+            options = {'aggregate': aggregate, 'descriptorType': descriptor_type, 'streaming': streaming}
+            output = subprocess.check_output([sys.executable, '-m', 'benchmarks.bench_import_pipeline', '--child',
+                                              '--options', json.dumps(options)], env=env)
+            results = json.loads(output.decode('utf-8'))
+            memory[mode] = {'verifyPeakBytes': results['verifyBytes'] - results['baseBytes'],
+                            'peakBytes': results['peakBytes'] - results['baseBytes']}
+    finally:
+        shutil.rmtree(directory)
+    return memory
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(entity_count, idp_share, document_bytes, descriptor_type, backend, rounds, memory=True):
+    started = time.perf_counter()
+    document = synthetic.build_aggregate(entity_count, idp_share, document_bytes)
+    generated = time.perf_counter() - started
+    our_key = fixtures.read_our_key()
+    our_cert = fixtures.read_our_cert()
+
+    rounds_seconds = {}
+    signed = 0
+    stores = StoreFactory(backend)
+    try:
+        with redirect_stdout(io.StringIO()):
+            for _ in range(rounds):
+                seconds, signed = time_stages(document, descriptor_type, stores, our_key, our_cert)
+                seconds.update(time_imports(document, descriptor_type, stores, our_key, our_cert))
+                for stage, value in seconds.items():
+                    rounds_seconds.setdefault(stage, []).append(value)
+    finally:
+        stores.close()
+    memory = measure_memory(document, descriptor_type) if memory else None
+
+    stages = {}
+    for stage, values in rounds_seconds.items():
+        stages[stage] = {'seconds': min(values), 'perEntityMs': 1000 * min(values) / max(signed, 1),
+                         'rounds': values}
+    return {
+        'benchmark': 'import_pipeline',
+        'timestamp': time.time(),
+        'revision': git_revision(),
+        'environment': {'python': platform.python_version(), 'lxml': lxml.__version__,
+                        'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'parameters': {'entities': entity_count, 'idpShare': idp_share, 'documentBytes': document_bytes,
+                       'descriptorType': descriptor_type, 'store': backend, 'rounds': rounds},
+        'aggregate': {'bytes': len(document), 'entities': entity_count, 'selected': signed,
+                      'generateSeconds': generated},
+        'stages': stages,
+        'memory': memory
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--entities', type=int, default=1000, help='entities in the synthetic aggregate')
+    parser.add_argument('--idp-share', type=float, default=0.5, help='share of identity providers')
+    parser.add_argument('--document-bytes', type=int, default=None,
+                        help='pad entities to about this size, default keeps the dummy sizes')
+    parser.add_argument('--descriptor-type', default='SPSSODescriptor')
+    parser.add_argument('--store', choices=['memory', 'sqlite', 'dynamodb'], default='memory')
+    parser.add_argument('--rounds', type=int, default=3, help='best of N passes')
+    parser.add_argument('--output', default='-', help='file for the JSON results, - for stdout')
+    parser.add_argument('--no-memory', action='store_true', help='skip the peak RSS measurement')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--options', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(child_memory(json.loads(args.options))))
+        return
+
+    results = run(args.entities, args.idp_share, args.document_bytes, args.descriptor_type, args.store, args.rounds,
+                  not args.no_memory)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output == '-':
+        print(text)
+    else:
+        with open(args.output, 'w') as handle:
+            handle.write(text + '\n')
+        for stage in ('parse', 'verify', 'fragment', 'digest', 'sign', 'serialize', 'store', 'import', 'reimport'):
+            print('%-10s %9.3f s %9.3f ms/entity' % (stage, results['stages'][stage]['seconds'],
+                                                     results['stages'][stage]['perEntityMs']), file=sys.stderr)
+        for mode, memory in sorted((results['memory'] or {}).items()):
+            print('%-10s peak RSS %.1f MB after verify, %.1f MB after import, aggregate %.1f MB' % (
+                mode, memory['verifyPeakBytes'] / 1e6, memory['peakBytes'] / 1e6,
+                results['aggregate']['bytes'] / 1e6), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
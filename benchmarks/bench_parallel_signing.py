@@ -0,0 +1,51 @@
+"""
+Measures how entity signing scales with the number of signing worker processes.
+
+Run from the project directory:
+```
+python -m benchmarks.bench_parallel_signing --entities 129 --workers 1 2 4
+```
+"""
+
+from __future__ import print_function
+
+import argparse
+import time
+
+from lxml import etree
+
+from src.lambda_scripts.importMetadata import URN, select_fragments, sign_documents
+from src.tests import fixtures
+
+
+def run(entity_count, worker_counts, descriptor_type):
+    root = etree.fromstring(fixtures.build_signed_aggregate(entity_count=entity_count))
+    entities = list(root.iter(URN + 'EntityDescriptor'))
+    our_key = fixtures.read_our_key()
+    our_cert = fixtures.read_our_cert()
+
+    baseline = None
+    print('workers  entities  seconds  entities/s  speedup')
+    for workers in worker_counts:
+        fragments = select_fragments(entities, descriptor_type, root.attrib['validUntil'])
+        start = time.time()
+        signed = sum(1 for _ in sign_documents(fragments, our_key, our_cert, workers))
+        elapsed = time.time() - start
+
+        if baseline is None:
+            baseline = elapsed
+        print('%7d  %8d  %7.2f  %10.1f  %6.2fx' % (workers, signed, elapsed, signed / elapsed, baseline / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--entities', type=int, default=None, help='entities taken from the dummy aggregate')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--descriptor-type', default='IDPSSODescriptor')
+    args = parser.parse_args()
+
+    run(args.entities, args.workers, args.descriptor_type)
+
+
+if __name__ == '__main__':
+    main()
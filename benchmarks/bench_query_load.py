@@ -0,0 +1,270 @@
+"""
+Replays MDQ requests against queryMetadata.lambda_handler concurrently and reports throughput,
+latency percentiles and memory per request.
+
+The store is filled by importing a synthetic aggregate. Requests are API Gateway events asking for
+entities with Zipf-distributed popularity, by entityID or {sha1} identifier, some for entities that
+do not exist, some revalidating the ETag they hold (304) and some accepting gzip, which are only
+answered compressed with --gzip-responses. Threads share the container's entity cache and store like
+warm invocations of one container would; a Lambda container serves one request at a time, so this
+measures contention in the read path, not Lambda scaling.
+
+Memory per request is measured in a separate, sequential pass under tracemalloc: the peak above the
+memory held before the request, and what the pass kept allocated, per request.
+
+Run from the project directory:
+```
+python -m benchmarks.bench_query_load --entities 2000 --requests 50000 --concurrency 8 --zipf 1.1
+```
+"""
+
+from __future__ import print_function
+
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from urllib import parse
+
+from benchmarks import synthetic
+from benchmarks.bench_import_pipeline import PROVIDER, StoreFactory, git_revision
+from src.lambda_scripts import importMetadata, queryMetadata
+from src.tests import fixtures
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def fill_store(stores, entity_count, idp_share, document_bytes):
+    """
+    Imports a synthetic aggregate into a new store
+
+    :return: the store's event keys and the stored entityID -> etag
+    :rtype: (dict, dict)
+    """
+    our_key = fixtures.read_our_key()
+    our_cert = fixtures.read_our_cert()
+    event = stores.event()
+    document = synthetic.build_aggregate(entity_count, idp_share, document_bytes)
+    root = importMetadata.get_and_validate_metadata(document, our_cert)
+    for descriptor_type in ('SPSSODescriptor', 'IDPSSODescriptor'):
+        # Both descriptor types under one provider, so neither import may sweep the other's entities
+        importMetadata.store_metadata(root, dict(event, providerName=PROVIDER, descriptorType=descriptor_type,
+                                                 sweepStale=False), our_key, our_cert)
+    store = stores.store(event)
+    records = store.batch_get_items(list(store.entity_ids()), ['etag'])
+    return event, dict((entity_id, item['etag']['S']) for entity_id, item in records.items())
+
+
+def zipf_weights(count, exponent):
+    """
+    :return: cumulative weights of ranks 1 to count, the weight of rank k being 1 / k^exponent
+    :rtype: list
+    """
+    return list(itertools.accumulate(1.0 / rank ** exponent for rank in range(1, count + 1)))
+
+
+def build_events(etags, count, exponent, revalidate_share, sha1_share, missing_share, gzip_share, seed):
+    """
+    :return: API Gateway events of MDQ requests
+    :rtype: list
+    """
+    draw = random.Random(seed)
+    entity_ids = sorted(etags)
+    # Popularity is unrelated to the order of the entityIDs
+    draw.shuffle(entity_ids)
+    weights = zipf_weights(len(entity_ids), exponent)
+
+    events = []
+    for number in range(count):
+        if draw.random() < missing_share:
+            entity_id = 'https://missing%d.bench.example.org/shibboleth' % number
+            etag = ''
+        else:
+            entity_id = draw.choices(entity_ids, cum_weights=weights)[0]
+            etag = etags[entity_id] if draw.random() < revalidate_share else ''
+
+        if draw.random() < sha1_share:
+            identifier = '{sha1}' + hashlib.sha1(entity_id.encode('utf-8')).hexdigest()
+        else:
+            identifier = parse.quote(entity_id, safe='')
+
+        header = {'If-None-Match': etag}
+        if draw.random() < gzip_share:
+            header['Accept-Encoding'] = 'gzip, deflate'
+        events.append({'params': {'path': {'entityId': identifier}, 'header': header}})
+    return events
+
+
+def handle(event):
+    """
+    :return: status and seconds of one request
+    :rtype: (string, float)
+    """
+    start = time.perf_counter()
+    try:
+        status = queryMetadata.lambda_handler(event, None)['status']
+    except Exception as e:
+        status = str(e)
+    return status, time.perf_counter() - start
+
+
+def replay(events, concurrency):
+    """
+    :return: (status, seconds) of every request, and the wall clock seconds of the replay
+    :rtype: (list, float)
+    """
+    results = [None] * len(events)
+    position = itertools.count()
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                number = next(position)
+            if number >= len(events):
+                return
+            results[number] = handle(events[number])
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        for future in [executor.submit(worker) for _ in range(concurrency)]:
+            future.result()
+    return results, time.perf_counter() - start
+
+
+def measure_memory(events):
+    """
+    :return: peak bytes above those held before each request, and bytes kept per request
+    :rtype: (list, float)
+    """
+    peaks = []
+    tracemalloc.start()
+    try:
+        started = tracemalloc.get_traced_memory()[0]
+        for event in events:
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            handle(event)
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+        kept = tracemalloc.get_traced_memory()[0] - started
+    finally:
+        tracemalloc.stop()
+    return peaks, float(kept) / max(len(events), 1)
+
+
+def percentiles(values):
+    """
+    :return: the PERCENTILES of the values (nearest rank), their mean and maximum
+    :rtype: dict
+    """
+    if not values:
+        return {}
+    values = sorted(values)
+    summary = dict(('p%g' % percentile, values[min(len(values) - 1, int(len(values) * percentile / 100.0))])
+                   for percentile in PERCENTILES)
+    summary['mean'] = sum(values) / len(values)
+    summary['max'] = values[-1]
+    return summary
+
+
+def run(args):
+    stores = StoreFactory(args.store)
+    saved = (queryMetadata.METADATA_STORE, queryMetadata.METADATA_TABLE, queryMetadata.ENTITY_CACHE,
+             queryMetadata.GZIP_RESPONSES)
+    try:
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            event, etags = fill_store(stores, args.entities, args.idp_share, args.document_bytes)
+            queryMetadata.METADATA_STORE = event['metadataStore']
+            queryMetadata.METADATA_TABLE = event['tableName']
+            queryMetadata.ENTITY_CACHE = queryMetadata.EntityCache(args.cache_ttl, args.cache_bytes)
+            queryMetadata.GZIP_RESPONSES = args.gzip_responses
+
+            events = build_events(etags, args.warmup + args.requests + args.memory_requests, args.zipf,
+                                  args.revalidate_share, args.sha1_share, args.missing_share, args.gzip_share,
+                                  args.seed)
+            replay(events[:args.warmup], args.concurrency)
+            results, elapsed = replay(events[args.warmup:args.warmup + args.requests], args.concurrency)
+            peaks, kept = measure_memory(events[args.warmup + args.requests:])
+            cache = queryMetadata.ENTITY_CACHE.stats()
+    finally:
+        (queryMetadata.METADATA_STORE, queryMetadata.METADATA_TABLE, queryMetadata.ENTITY_CACHE,
+         queryMetadata.GZIP_RESPONSES) = saved
+        stores.close()
+
+    statuses = {}
+    for status, seconds in results:
+        statuses.setdefault(status, []).append(seconds * 1000)
+    return {
+        'benchmark': 'query_load',
+        'timestamp': time.time(),
+        'revision': git_revision(),
+        'parameters': dict((name, value) for name, value in vars(args).items() if name != 'output'),
+        'stored': len(etags),
+        'throughput': len(results) / elapsed,
+        'seconds': elapsed,
+        'latencyMs': percentiles([seconds * 1000 for _, seconds in results]),
+        'statuses': dict((status, dict(percentiles(values), count=len(values))) for status, values in statuses.items()),
+        'memory': {'peakBytes': percentiles(peaks), 'keptBytesPerRequest': kept},
+        'cache': cache
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--entities', type=int, default=1000, help='entities imported into the store')
+    parser.add_argument('--idp-share', type=float, default=0.5, help='share of identity providers')
+    parser.add_argument('--document-bytes', type=int, default=None, help='pad entities to about this size')
+    parser.add_argument('--store', choices=['memory', 'sqlite'], default='sqlite')
+    parser.add_argument('--requests', type=int, default=20000, help='measured requests')
+    parser.add_argument('--warmup', type=int, default=2000, help='requests replayed before measuring')
+    parser.add_argument('--memory-requests', type=int, default=500, help='requests of the memory pass')
+    parser.add_argument('--concurrency', type=int, default=8, help='threads replaying the requests')
+    parser.add_argument('--zipf', type=float, default=1.1, help='exponent of the entity popularity')
+    parser.add_argument('--revalidate-share', type=float, default=0.3, help='requests sending the current ETag')
+    parser.add_argument('--sha1-share', type=float, default=0.2, help='requests by {sha1} identifier')
+    parser.add_argument('--missing-share', type=float, default=0.05, help='requests for unknown entities')
+    parser.add_argument('--gzip-share', type=float, default=0.5, help='requests accepting gzip')
+    parser.add_argument('--gzip-responses', action='store_true',
+                        help='answer them gzip-compressed, as GZIP_RESPONSES does')
+    parser.add_argument('--cache-ttl', type=float, default=queryMetadata.ENTITY_CACHE_TTL,
+                        help='seconds entities stay cached, 0 reads the store for every request')
+    parser.add_argument('--cache-bytes', type=int, default=queryMetadata.ENTITY_CACHE_MAX_BYTES)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='file for the JSON results, - for stdout')
+    args = parser.parse_args()
+
+    results = run(args)
+    if args.output == '-':
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+    if args.output:
+        with open(args.output, 'w') as handle:
+            handle.write(json.dumps(results, indent=2, sort_keys=True) + '\n')
+
+    output = sys.stderr if args.output else sys.stdout
+    print('%d requests, %d threads, %.0f requests/s' % (args.requests, args.concurrency, results['throughput']),
+          file=output)
+    print('%-8s %8s %9s %9s %9s %9s %9s' % ('status', 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'p99.9 ms', 'max ms'),
+          file=output)
+    rows = [('all', dict(results['latencyMs'], count=args.requests))] + sorted(results['statuses'].items())
+    for status, summary in rows:
+        print('%-8s %8d %9.3f %9.3f %9.3f %9.3f %9.3f' % (status, summary['count'], summary['p50'], summary['p90'],
+                                                          summary['p99'], summary['p99.9'], summary['max']),
+              file=output)
+    print('memory per request: peak p50 %d bytes, p99 %d bytes, kept %.0f bytes' % (
+        results['memory']['peakBytes']['p50'], results['memory']['peakBytes']['p99'],
+        results['memory']['keptBytesPerRequest']), file=output)
+    print('entity cache: %(hits)d hits, %(misses)d misses, %(entries)d entries, %(bytes)d bytes' % results['cache'],
+          file=output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+Measures the per-entity cost of the signing engine against the signxml path it replaces.
+
+Run from the project directory:
+```
+python -m benchmarks.bench_signing_engine --entities 129
+```
+"""
+
+from __future__ import print_function
+
+import argparse
+import time
+
+from lxml import etree
+
+from src.lambda_scripts.importMetadata import (URN, EntitySigner, create_document, create_standalone_fragment,
+                                               create_xml_signer, load_cert_chain, load_signing_key, sign_fragment)
+from src.tests import fixtures
+
+
+def time_legacy(entities, our_key, our_cert):
+    xml_signer = create_xml_signer()
+    key = load_signing_key(our_key)
+    cert_chain = load_cert_chain(our_cert)
+    documents = []
+    start = time.time()
+    for entity in entities:
+        fragment = create_standalone_fragment(entity, entity.attrib['entityID'], 'validUntil')
+        documents.append(create_document(sign_fragment(fragment, xml_signer, key, cert_chain)))
+    return (time.time() - start) / len(entities), documents
+
+
+def time_engine(entities, our_key, our_cert):
+    signer = EntitySigner(our_key, our_cert)
+    documents = []
+    start = time.time()
+    for entity in entities:
+        fragment = create_standalone_fragment(entity, entity.attrib['entityID'], 'validUntil')
+        documents.append(signer.sign(fragment))
+    return (time.time() - start) / len(entities), documents
+
+
+def run(entity_count, rounds):
+    root = etree.fromstring(fixtures.build_signed_aggregate(entity_count=entity_count))
+    entities = list(root.iter(URN + 'EntityDescriptor'))
+    our_key = fixtures.read_our_key()
+    our_cert = fixtures.read_our_cert()
+
+    legacy = min(time_legacy(entities, our_key, our_cert)[0] for _ in range(rounds))
+    engine = min(time_engine(entities, our_key, our_cert)[0] for _ in range(rounds))
+    identical = time_legacy(entities, our_key, our_cert)[1] == time_engine(entities, our_key, our_cert)[1]
+
+    print('per-entity signing, signxml:  %7.2f ms' % (legacy * 1000))
+    print('per-entity signing, engine:   %7.2f ms' % (engine * 1000))
+    print('saved per entity:             %7.2f ms (%.0f%%)' % ((legacy - engine) * 1000,
+                                                            100 * (legacy - engine) / legacy))
+    print('byte-identical output:        %s' % identical)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--entities', type=int, default=None, help='entities taken from the dummy aggregate')
+    parser.add_argument('--rounds', type=int, default=3, help='best of N passes')
+    args = parser.parse_args()
+
+    run(args.entities, args.rounds)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Measures what the signing material caches save: per-entity signing with a PEM key versus a key
+parsed once, and cold versus warm reads of the key files from (mocked) S3.
+
+Run from the project directory:
+```
+python -m benchmarks.bench_signing_material --entities 50
+```
+"""
+
+from __future__ import print_function
+
+import argparse
+import time
+
+from lxml import etree
+from moto import mock_s3
+
+from src.lambda_scripts import importMetadata
+from src.lambda_scripts.importMetadata import (URN, create_document, create_standalone_fragment, create_xml_signer,
+                                               load_cert_chain, load_signing_key, read_cached_file_from_s3,
+                                               sign_fragment)
+from src.tests import fixtures
+
+
+def time_signing(entities, key, cert):
+    xml_signer = create_xml_signer()
+    start = time.time()
+    for entity in entities:
+        fragment = create_standalone_fragment(entity, entity.attrib['entityID'], 'validUntil')
+        create_document(sign_fragment(fragment, xml_signer, key, cert))
+    return (time.time() - start) / len(entities)
+
+
+@fixtures.aws_environment()
+@mock_s3
+def time_s3_reads(rounds):
+    s3 = importMetadata.get_s3_client()
+    fixtures.create_bucket(s3, 'keys')
+    for name, body in (('provider.pem', fixtures.read_our_cert()), ('ours.pem', fixtures.read_our_cert()),
+                       ('ours.key', fixtures.read_our_key())):
+        s3.put_object(Bucket='keys', Key=name, Body=body)
+
+    timings = []
+    for _ in range(rounds):
+        start = time.time()
+        for name in ('provider.pem', 'ours.pem', 'ours.key'):
+            read_cached_file_from_s3(name, 'keys')
+        timings.append(time.time() - start)
+    return timings[0], sum(timings[1:]) / max(len(timings) - 1, 1)
+
+
+def run(entity_count, rounds):
+    root = etree.fromstring(fixtures.build_signed_aggregate(entity_count=entity_count))
+    entities = list(root.iter(URN + 'EntityDescriptor'))
+    our_key = fixtures.read_our_key()
+    our_cert = fixtures.read_our_cert()
+
+    from_pem = time_signing(entities, our_key, our_cert)
+    parsed = time_signing(entities, load_signing_key(our_key), load_cert_chain(our_cert))
+    print('per-entity signing, PEM key:     %7.2f ms' % (from_pem * 1000))
+    print('per-entity signing, parsed key:  %7.2f ms' % (parsed * 1000))
+    print('saved per entity:                %7.2f ms (%.0f%%)' % ((from_pem - parsed) * 1000,
+                                                               100 * (from_pem - parsed) / from_pem))
+
+    cold, warm = time_s3_reads(rounds)
+    print('signing material from S3, cold:  %7.2f ms' % (cold * 1000))
+    print('signing material from S3, warm:  %7.2f ms' % (warm * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--entities', type=int, default=50, help='entities taken from the dummy aggregate')
+    parser.add_argument('--rounds', type=int, default=5, help='invocations simulated for the S3 reads')
+    args = parser.parse_args()
+
+    run(args.entities, args.rounds)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+Synthetic aggregates for the benchmarks: any number of entities, cloned from the dummy metadata in
+`src/tests`, with a chosen share of identity providers and a chosen size per entity, signed with
+the dummy key.
+"""
+
+from __future__ import print_function
+
+import random
+from copy import deepcopy
+
+from lxml import etree
+
+from src.tests import fixtures
+
+MD = fixtures.MD
+MDUI = '{urn:oasis:names:tc:SAML:metadata:ui}'
+# Padding is made of words, so documents compress about as well as real descriptions do
+PADDING_WORDS = ('federation', 'service', 'provider', 'identity', 'university', 'research', 'library',
+                 'campus', 'access', 'portal', 'learning', 'students', 'faculty', 'staff', 'login', 'the',
+                 'of', 'and', 'for', 'with')
+
+
+def load_templates():
+    """
+    :return: EntityDescriptor elements of the dummy metadata without their signatures, as
+        (service providers, identity providers)
+    :rtype: (list, list)
+    """
+    root = etree.parse(fixtures.DUMMY_SAML_DATA).getroot()
+    for signature in list(root.iter(fixtures.DS + 'Signature')):
+        signature.getparent().remove(signature)
+    entities = list(root.iter(MD + 'EntityDescriptor'))
+    return ([entity for entity in entities if entity.find(MD + 'IDPSSODescriptor') is None],
+            [entity for entity in entities if entity.find(MD + 'IDPSSODescriptor') is not None])
+
+
+def generate_entities(entity_count, idp_share=0.5, document_bytes=None, seed=0):
+    """
+    Clones dummy entities under new entityIDs
+
+    :param entity_count: number of entities
+    :param idp_share: share of identity providers, the others are service providers
+    :param document_bytes: pads smaller entities up to about this many serialized bytes, None keeps
+        the size of the dummy entity they were cloned from
+    :param seed: seed of the padding text
+    :return: EntityDescriptor elements
+    :rtype: generator
+    """
+    service_providers, identity_providers = load_templates()
+    words = random.Random(seed)
+    for number in range(entity_count):
+        if int((number + 1) * idp_share) > int(number * idp_share):
+            entity = deepcopy(identity_providers[number % len(identity_providers)])
+            entity.attrib['entityID'] = 'https://idp%d.bench.example.org/idp/shibboleth' % number
+        else:
+            entity = deepcopy(service_providers[number % len(service_providers)])
+            entity.attrib['entityID'] = 'https://sp%d.bench.example.org/shibboleth' % number
+
+        if document_bytes is not None:
+            missing = document_bytes - len(etree.tostring(entity))
+            if missing > 0:
+                pad_entity(entity, missing, words)
+        yield entity
+
+
+def pad_entity(entity, size, words):
+    """
+    Grows an entity by about size bytes with an mdui:Description in its Extensions
+    """
+    extensions = entity.find(MD + 'Extensions')
+    if extensions is None:
+        extensions = etree.Element(MD + 'Extensions')
+        entity.insert(0, extensions)
+    ui_info = etree.SubElement(extensions, MDUI + 'UIInfo', nsmap={'mdui': MDUI[1:-1]})
+    description = etree.SubElement(ui_info, MDUI + 'Description')
+    description.set('{http://www.w3.org/XML/1998/namespace}lang', 'en')
+
+    text = []
+    length = 0
+    while length < size:
+        word = words.choice(PADDING_WORDS)
+        text.append(word)
+        length += len(word) + 1
+    description.text = ' '.join(text)
+
+
+def build_aggregate(entity_count, idp_share=0.5, document_bytes=None, valid_until='2099-01-01T00:00:00Z', seed=0):
+    """
+    Builds and signs a synthetic aggregate
+
+    :return: serialized, signed aggregate
+    :rtype: bytes
+    """
+    root = etree.Element(MD + 'EntitiesDescriptor', nsmap={None: MD[1:-1]}, validUntil=valid_until,
+                         Name='urn:mace:bench.example.org')
+    for entity in generate_entities(entity_count, idp_share, document_bytes, seed):
+        root.append(entity)
+    return fixtures.sign_aggregate(root)
@@ -0,0 +1,108 @@
+"""
+Bloom filter over the identifiers of the stored entities
+
+importMetadata publishes one for all entityIDs and their {sha1} identifiers, and queryMetadata
+answers requests for identifiers that are definitely not in it without reading DynamoDb.
+"""
+
+from __future__ import print_function
+
+import hashlib
+import math
+import struct
+
+# Serialized filters start with this header: magic, format version, number of hash functions,
+# number of bits and number of identifiers added
+FILTER_MAGIC = b'MDQF'
+FILTER_VERSION = 1
+FILTER_HEADER = struct.Struct('>4sBIQQ')
+
+DEFAULT_FALSE_POSITIVE_RATE = 0.001
+
+
+class BloomFilter(object):
+    """
+    Set of identifiers that may answer "maybe" for identifiers never added, but never "no" for one
+    that was
+
+    The bit positions of an identifier come from two 64-bit halves of its BLAKE2b digest
+    (Kirsch-Mitzenmacher double hashing).
+    """
+
+    def __init__(self, bits, hashes, data=None, count=0):
+        """
+        :param bits: size of the bit array
+        :param hashes: number of bits set per identifier
+        :param data: bit array of a serialized filter
+        :param count: number of identifiers in data
+        """
+        self.bits = bits
+        self.hashes = hashes
+        self.data = bytearray((bits + 7) // 8) if data is None else bytearray(data)
+        self.count = count
+
+    @classmethod
+    def for_capacity(cls, capacity, false_positive_rate=DEFAULT_FALSE_POSITIVE_RATE, max_bytes=None):
+        """
+        Sizes a filter for a number of identifiers
+
+        :param capacity: number of identifiers the filter will hold
+        :param false_positive_rate: rate of "maybe" answers for identifiers that were not added
+        :param max_bytes: upper bound of the bit array; the false positive rate rises above the one
+            asked for when it has to be smaller
+        :return: an empty filter
+        :rtype: BloomFilter
+        """
+        capacity = max(capacity, 1)
+        bits = int(math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+        if max_bytes is not None:
+            bits = min(bits, max_bytes * 8)
+        bits = max(bits, 8)
+        hashes = max(1, int(round(float(bits) / capacity * math.log(2))))
+        return cls(bits, hashes)
+
+    def add(self, identifier):
+        for position in self._positions(identifier):
+            self.data[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, identifier):
+        data = self.data
+        for position in self._positions(identifier):
+            if not data[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def false_positive_rate(self):
+        """
+        :return: expected false positive rate for the identifiers added
+        :rtype: float
+        """
+        return (1 - math.exp(-float(self.hashes) * self.count / self.bits)) ** self.hashes
+
+    def to_bytes(self):
+        return FILTER_HEADER.pack(FILTER_MAGIC, FILTER_VERSION, self.hashes, self.bits, self.count) + bytes(self.data)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        :return: the filter serialized by to_bytes
+        :rtype: BloomFilter
+        :raises ValueError: for data that is not a filter of this format version
+        """
+        if len(data) < FILTER_HEADER.size:
+            raise ValueError('Not an entity filter')
+        magic, version, hashes, bits, count = FILTER_HEADER.unpack_from(data)
+        if magic != FILTER_MAGIC or version != FILTER_VERSION or len(data) - FILTER_HEADER.size != (bits + 7) // 8:
+            raise ValueError('Not an entity filter of version %d' % FILTER_VERSION)
+        return cls(bits, hashes, data[FILTER_HEADER.size:], count)
+
+    def _positions(self, identifier):
+        first, second = struct.unpack('>QQ', hashlib.blake2b(identifier.encode('utf-8'), digest_size=16).digest())
+        second |= 1
+        bits = self.bits
+        return [(first + number * second) % bits for number in range(self.hashes)]
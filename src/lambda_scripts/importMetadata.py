@@ -6,22 +6,110 @@ re-signs each descriptor and stores in DynamoDb.
 from __future__ import print_function
 
 import datetime
+import gzip
 import hashlib
+import io
+import json
+import multiprocessing
+import re
+import shutil
 import sys
+import tempfile
+import threading
+import time
+from base64 import b64encode
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
+from itertools import islice
 
-import boto3
-import botocore
 import pytz
-import signxml
-from lxml import etree
-from urllib.request import urlopen
-from botocore import exceptions
+from urllib import parse
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from . import metrics
+from .entityFilter import DEFAULT_FALSE_POSITIVE_RATE, BloomFilter
+from .lazyImport import lazy_import
+from .metadataStore import (BATCH_GET_SIZE, DEFAULT_TABLE, DOCUMENT_CODEC, DOCUMENT_KEY_PREFIX, ENTITY_FILTER_MANIFEST,
+                            ENTITY_FILTER_PREFIX, SHA1_PREFIX, StoreError, get_client, open_store)
+
+# Loaded on first use: an import of an unchanged aggregate into a local store needs none of these, and
+# cryptography and OpenSSL are only needed once an aggregate is verified or an entity signed
+config = lazy_import('botocore.config')
+exceptions = lazy_import('botocore.exceptions')
+signxml = lazy_import('signxml')
+etree = lazy_import('lxml.etree')
+backends = lazy_import('cryptography.hazmat.backends')
+padding = lazy_import('cryptography.hazmat.primitives.asymmetric.padding')
+hashes = lazy_import('cryptography.hazmat.primitives.hashes')
+serialization = lazy_import('cryptography.hazmat.primitives.serialization')
+crypto = lazy_import('OpenSSL.crypto')
 
 NSMAP = {None: "http://www.w3.org/2000/09/xmldsig#"}
 URN = '{urn:oasis:names:tc:SAML:2.0:metadata}'
-
-
+DS = '{http://www.w3.org/2000/09/xmldsig#}'
+
+C14N_ALGORITHM = u'http://www.w3.org/2001/10/xml-exc-c14n#'
+SIGNATURE_METHOD = u'http://www.w3.org/2001/04/xmldsig-more#rsa-sha256'
+DIGEST_METHOD = u'http://www.w3.org/2001/04/xmlenc#sha256'
+ENVELOPED_SIGNATURE = u'http://www.w3.org/2000/09/xmldsig#enveloped-signature'
+CACHE_DURATION = 'P0Y0M0DT6H0M0.000S'
+XML_DURATION = re.compile(r'^P(?:(\d+)Y)?(?:(\d+)M)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:([\d.]+)S)?)?$')
+
+# Downloads larger than this spill from memory to a temporary file on /tmp
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Number of fragments shipped to a signing worker process at a time
+SIGNING_BATCH_SIZE = 16
+# Signing workers are never forked from the handler: imports run feeds, shards and writes on
+# threads, and a child forked while one of them holds a lock (of a boto3 client, of logging or of
+# the allocator) deadlocks on it. A fork server, or a fresh interpreter where there is none, has no
+# such threads.
+SIGNING_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+# Compressed documents larger than this go to S3, under their SHA-256, and their item only points
+# there. DynamoDb items are limited to 400 KB.
+DOCUMENT_OFFLOAD_SIZE = 256 * 1024
+DOCUMENT_OBJECT_PREFIX = 'documents/'
+# Statically published documents, under the URL-encoded entityID and under '{sha1}' and its hex SHA-1
+ENTITY_OBJECT_PREFIX = 'entities/'
+# Upper bound of the published entity filter's size
+ENTITY_FILTER_MAX_BYTES = 4 * 1024 * 1024
+
+# BatchWriteItem accepts at most 25 requests
+BATCH_WRITE_SIZE = 25
+BATCH_WRITE_ATTEMPTS = 8
+BATCH_WRITE_BACKOFF = 0.05
+WRITE_CONCURRENCY = 8
+
+# Validators of the last imported aggregate, one object per provider and descriptor type in the state bucket
+FEED_STATE_PREFIX = 'feeds/'
+# Verified aggregates handed to shard workers or kept for a resumed import, removed once done
+STAGING_PREFIX = 'staging/'
+# Progress of an import that ran out of time, one object per provider and descriptor type in the state bucket
+CHECKPOINT_PREFIX = 'checkpoints/'
+# Seconds left to an invocation when it stops taking new entities and saves a checkpoint
+CHECKPOINT_MARGIN = 30
+SHARD_CONCURRENCY = 4
+# Feeds of a multi-feed import fetched, verified and stored at the same time
+FEED_CONCURRENCY = 4
+# A shard may run for as long as a Lambda invocation can
+LAMBDA_INVOKE_TIMEOUT = 900
+
+# Seconds a file read from S3 is used without asking S3 whether it changed
+S3_CACHE_TTL = 300
+CERT_PEM = re.compile('-----BEGIN CERTIFICATE-----\r?\n(.+?)-----END CERTIFICATE-----', flags=re.S)
+
+# Survive warm invocations of the container:
+#   (bucket, key) -> (etag, body, fetched at)
+S3_FILE_CACHE = {}
+#   (kind, sha256 of the PEM) -> parsed key, certificate or certificate chain
+PARSED_KEY_CACHE = {}
+
+
+@metrics.metric_scope('importMetadata')
 def lambda_handler(event, context):
     """
     Updates a Dynamodb metadata table with a SAML metadata feed
@@ -33,10 +121,91 @@ def lambda_handler(event, context):
         - providerSigningCert: the signing certificate used to validate the incoming metadata
         - ourSigningCert: the certificate of the private key used to re-sign the split out metadata
         - ourSigningKey: he private key used to re-sign the split out metadata
-        - tableName: the destination AWS DynamoDb table acting as the metadata store
+        - tableName: the destination table acting as the metadata store
 
         The event object CAN specify:
+        - metadataStore: 'dynamodb' (default), 'sqlite:' and the path of a database file, or
+          'memory', for local runs and benchmarks
         - descriptorType ('SPSSODescriptor' or 'IDPSSODescriptor'): process only the given type
+        - streaming (bool): write entities incrementally: spool the aggregate to a temporary file
+          and, once its signature is checked, walk it entity by entity instead of keeping the
+          downloaded bytes and the parsed tree while signing. This does not bound the memory of an
+          import: its peak is set by the signature check, which parses the whole aggregate
+          (see verify_metadata_file), and is only a few percent lower than without streaming.
+        - signingWorkers (int): number of worker processes used to sign entities (default 1,
+          signs in the handler's own process). Workers are started by a fork server (or spawned
+          where there is none), never forked from the handler, so they may be combined with
+          feedConcurrency, shards and the writer's threads. Starting them takes a fraction of a
+          second per import, as they import their modules afresh.
+        - forceResign (bool): sign and write every entity, even those whose source did not change
+          since the last import
+        - writeConcurrency (int): number of concurrent DynamoDb updates (default 8)
+        - stateBucket: stores the ETag/Last-Modified of the last imported aggregate, checkpoints and
+          staged aggregates (default: none, which turns conditional fetches and checkpoints off).
+          Never falls back to the keyBucket, which holds our private key.
+        - conditionalFetch (bool): send the stored validators and skip the import when the aggregate
+          did not change (default true with a stateBucket, forceResign always downloads)
+        - signatureValidity (hours): sign entities with our own validity window instead of the
+          aggregate's validUntil, and re-sign an unchanged entity only when its signature is due
+          for renewal. The window never extends past the aggregate's validUntil.
+        - renewBefore (hours): renew signatures that expire within this many hours (default a
+          quarter of signatureValidity)
+        - shardSize (int): verify the aggregate here, stage it in the stateBucket (required) and
+          have workers sign and store ranges of this many entities
+        - workerFunction: name of the Lambda function invoked for each shard (default: shards
+          run on threads of this invocation)
+        - shardConcurrency (int): number of shards running at the same time (default 4)
+        - checkpointMargin (seconds): stop taking new entities when the invocation has this much
+          time left, and save a checkpoint in the stateBucket the next invocation resumes from
+          (default 30; without a stateBucket the next invocation starts over)
+        - documentBucket: stores the signed documents too large for a DynamoDb item (default: none,
+          such documents stay in their item and fail to be written). Never the keyBucket, which
+          holds our private key.
+        - sweepStale (bool): once an import is complete and none of its writes failed, delete the
+          provider's entities of the descriptorType it did not see (default false, needs the
+          PROVIDER_INDEX of the table). Only records stored with their descriptor type are swept,
+          so entities that no import of this version signed or saw yet are kept.
+        - publishBucket: also publish every signed document to this bucket, for a CDN to serve
+          MDQ requests, at ENTITY_OBJECT_PREFIX and the URL-encoded entityID and at
+          ENTITY_OBJECT_PREFIX, '{sha1}' and the hex SHA-1 of the entityID. Only entities signed
+          by a run are published, so the first run with a publishBucket should force a resign.
+        - publishOnly (bool): with a publishBucket, DynamoDb only keeps the entity records that
+          drive change detection and sweeping, not the documents (default false)
+        - filterBucket: once an import is complete, publish a Bloom filter over the entityIDs and
+          {sha1} identifiers of all providers to this bucket, for queryMetadata to answer unknown
+          identifiers without reading DynamoDb (needs the PROVIDER_INDEX of the table)
+        - filterFalsePositiveRate (float): share of unknown identifiers the filter lets through
+          (default 0.001)
+        - filterMaxBytes (int): upper bound of the filter's size, which raises the false positive
+          rate when it is reached (default 4 MB)
+        - feeds (list): import several feeds in one invocation, see below
+        - feedConcurrency (int): number of feeds imported at the same time (default 4)
+
+    The DynamoDb table needs PROVIDER_INDEX, 'provider-last_seen-index': a global secondary index with
+    the hash key 'provider' (S), the range key 'last_seen' (N) and an INCLUDE projection of
+    PROVIDER_INDEX_ATTRIBUTES (source_digest, valid_until and descriptor_type). Every import reads the
+    stored source digests from it; without it, or with fewer attributes projected, imports scan the
+    whole table instead. Without it, sweepStale and filterBucket are skipped.
+
+    Several feeds are imported by one invocation when the event holds a list of 'feeds'. Each feed
+    is a dict of the keys that differ between feeds, usually metadataUrl, providerName and
+    providerSigningCert, and takes the other keys from the event. Feeds are fetched, verified and
+    stored by feedConcurrency threads sharing the signing material and the clients. An
+    entity carried by several feeds is stored by the first feed of the list that carries it; the
+    feeds after it leave the entity alone. A feed that was not modified or failed keeps the entities
+    it stored before. Stale entities are swept once all feeds are stored, and the entity filter is
+    published once. Feeds are imported in memory: shardSize and streaming do not apply. The fetch,
+    verify and store time of each feed are printed and logged as the Feeds property of the metrics.
+
+    With METRICS_ENABLED (environment variable), each invocation logs its metrics in CloudWatch
+    embedded metric format, in METRICS_NAMESPACE with the dimensions Function and Provider: the
+    FetchBytes and FetchTime of the download, VerifyTime, the SignTime of each entity signed in the
+    handler's process, the latency of batched (BatchWriteLatency) and conditional (WriteLatency)
+    writes, the number of Changed, Renewed, Unchanged, Failed and Swept entities, and its Duration.
+
+    Shard workers are invoked with the coordinator's event and an additional 'shard' key holding the
+    'bucket' and 'key' of the staged aggregate, its 'validUntil' and the 'start' and 'stop' index of
+    the entities to import. They return the counts of their import.
 
     :param event: data representing the captured activity
     :param context: runtime information for handler
@@ -45,24 +214,82 @@ def lambda_handler(event, context):
     :return: irrelevant to functionality
     :rtype: int
     """
-    validate_event_object(event)
-
-    md_cert_pem = read_file_from_s3(event['providerSigningCert'], event['keyBucket'])
-    our_cert = read_file_from_s3(event['ourSigningCert'], event['keyBucket'])
-    our_key = read_file_from_s3(event['ourSigningKey'], event['keyBucket'])
+    if 'feeds' in event:
+        import_feeds(event)
+        return 0
 
-    handle = urlopen(event['metadataUrl'])
-    root = get_and_validate_metadata(handle.read(), md_cert_pem)
+    validate_event_object(event)
+    metrics.current().set_dimension('Provider', event['providerName'])
+
+    if 'shard' in event:
+        return import_shard(event)
+
+    conditional = is_conditional_fetch(event)
+
+    checkpoint = None if 'shardSize' in event or get_state_bucket(event) is None else read_checkpoint(event)
+    handle = open_checkpoint(event, checkpoint) if checkpoint else None
+    if handle is not None:
+        print("Resuming the import of %s after entity %d" % (event['metadataUrl'], checkpoint['entityIndex']))
+        new_feed_state = checkpoint['feedState']
+    else:
+        checkpoint = None
+        feed_state = read_feed_state(event) if conditional else {}
+        if 'signatureValidity' in event and feed_state.get('renewBy', 0) <= current_timestamp():
+            # Signatures are due for renewal, so the aggregate is needed even if it did not change
+            feed_state = {}
+
+        handle, new_feed_state = download_metadata(event['metadataUrl'], feed_state)
+        if handle is None:
+            print("Metadata at %s was not modified since the last import" % event['metadataUrl'])
+            refresh_last_seen(event['providerName'], current_timestamp(), get_metadata_store(event))
+            return 0
+
+    started = time.time()
+    md_cert_pem = read_cached_file_from_s3(event['providerSigningCert'], event['keyBucket']).decode()
+    our_key, our_cert = read_signing_material(event)
+    print("Loaded signing material in %.3fs" % (time.time() - started))
 
-    success = store_metadata(root, event, our_key, our_cert)
+    try:
+        if 'shardSize' in event:
+            valid_until = verify_metadata_file(handle, md_cert_pem)
+            success = import_sharded(handle, valid_until, event, new_feed_state)
+        elif checkpoint is not None:
+            # The staged aggregate was verified by the invocation that saved the checkpoint
+            success = import_within_budget(handle, iter_entity_descriptors(handle), checkpoint, event, context,
+                                           our_key, our_cert)
+        elif event.get('streaming'):
+            valid_until = verify_metadata_file(handle, md_cert_pem)
+            checkpoint = create_checkpoint(valid_until, new_feed_state)
+            success = import_within_budget(handle, iter_entity_descriptors(handle), checkpoint, event, context,
+                                           our_key, our_cert)
+        else:
+            root = get_and_validate_metadata(handle.read(), md_cert_pem)
+            checkpoint = create_checkpoint(root.attrib['validUntil'], new_feed_state)
+            success = import_within_budget(root, root.iter(URN + "EntityDescriptor"), checkpoint, event, context,
+                                           our_key, our_cert)
+    finally:
+        handle.close()
 
     # TODO determine where this is going
     if success:
+        # Only a completed import may let the next run skip this version of the aggregate
+        if conditional:
+            write_feed_state(event, new_feed_state)
         return 0
 
     return 0
 
 
+def read_signing_material(event):
+    """
+    :return: our signing key and our signing certificate
+    :rtype: (bytes, string)
+    """
+    our_cert = read_cached_file_from_s3(event['ourSigningCert'], event['keyBucket']).decode()
+    our_key = read_cached_file_from_s3(event['ourSigningKey'], event['keyBucket'])
+    return our_key, our_cert
+
+
 def validate_event_object(event):
     """
     Validate incoming event by confirming required keys for processing
@@ -83,12 +310,215 @@ def validate_event_object(event):
             print("%s is missing from the event object." % required_key)
             missing_keys = True
 
+    if 'shardSize' in event and 'stateBucket' not in event:
+        print("stateBucket is missing from the event object, shardSize needs it to stage the aggregate.")
+        missing_keys = True
+
     if missing_keys:
         sys.exit(6)
 
     return True
 
 
+def create_feed_events(event):
+    """
+    Merges each feed of a multi-feed event over the keys the feeds share
+
+    :param event: data representing the captured activity, with a list of 'feeds'
+    :return: the event of each feed, in order of precedence
+    :rtype: list
+    """
+
+    shared = dict((key, value) for key, value in event.items() if key not in ('feeds', 'feedConcurrency'))
+    feeds = [dict(shared, **feed) for feed in event['feeds']]
+    if not feeds:
+        print("feeds is empty.")
+        sys.exit(6)
+
+    for feed in feeds:
+        validate_event_object(feed)
+        if 'shardSize' in feed or feed.get('streaming'):
+            print("%s: shardSize and streaming do not apply to a multi-feed import." % feed['providerName'])
+            sys.exit(6)
+
+    providers = [feed['providerName'] for feed in feeds]
+    if len(set(providers)) < len(providers):
+        print("Each feed needs a providerName of its own.")
+        sys.exit(6)
+
+    return feeds
+
+
+def import_feeds(event):
+    """
+    Imports several feeds in one invocation, see lambda_handler
+
+    :param event: data representing the captured activity, with a list of 'feeds'
+    :return: providerName -> 'status' ('imported', 'notModified' or 'failed'), the 'fetch',
+        'verify', 'store' and 'finish' seconds and the number of entities 'skipped' for feeds before
+        it, of every feed
+    :rtype: dict
+    """
+
+    feeds = create_feed_events(event)
+    timestamp = current_timestamp()
+    for feed in feeds:
+        # Read once here, the threads then find the signing material in the caches
+        load_signing_key(read_signing_material(feed)[0])
+
+    concurrency = min(int(event.get('feedConcurrency', FEED_CONCURRENCY)), len(feeds))
+    with ThreadPoolExecutor(concurrency) as executor:
+        fetched = list(executor.map(metrics.bind(fetch_feed), feeds))
+        claims = claim_entities(feeds, fetched)
+        reports = list(executor.map(metrics.bind(lambda args: store_feed(*args, timestamp=timestamp)),
+                                    zip(feeds, fetched, claims)))
+
+    # Sweeping waits for all feeds, so that no entity another feed just took over looks stale
+    for feed, report in zip(feeds, reports):
+        started = time.perf_counter()
+        if report['status'] == 'notModified':
+            refresh_last_seen(feed['providerName'], timestamp, get_metadata_store(feed))
+        elif report['status'] == 'imported':
+            sweep_after_import(feed, timestamp, report['failed'])
+            if is_conditional_fetch(feed):
+                write_feed_state(feed, report.pop('feedState'))
+        report.pop('feedState', None)
+        report['finish'] = time.perf_counter() - started
+
+    if 'filterBucket' in event:
+        publish_entity_filter(event['filterBucket'],
+                              float(event.get('filterFalsePositiveRate', DEFAULT_FALSE_POSITIVE_RATE)),
+                              int(event.get('filterMaxBytes', ENTITY_FILTER_MAX_BYTES)), get_metadata_store(event))
+
+    reports = OrderedDict((feed['providerName'], report) for feed, report in zip(feeds, reports))
+    for provider, report in reports.items():
+        print("Feed %s %s: fetch %.2fs, verify %.2fs, store %.2fs, finish %.2fs, %d entities left to feeds "
+              "before it" % (provider, report['status'], report.get('fetch', 0), report.get('verify', 0),
+                             report.get('store', 0), report['finish'], report['skipped']))
+    metrics.current().set_property('Feeds', reports)
+    return reports
+
+
+def fetch_feed(feed):
+    """
+    Downloads and verifies the aggregate of one feed of a multi-feed import
+
+    :param feed: event of the feed
+    :return: 'root' of the verified aggregate, None when it was not modified or could not be read,
+        its 'feedState', the 'error' that stopped it and the 'fetch' and 'verify' seconds
+    :rtype: dict
+    """
+
+    fetched = {'root': None, 'feedState': {}, 'error': None}
+    conditional = is_conditional_fetch(feed)
+    try:
+        feed_state = read_feed_state(feed) if conditional else {}
+        if 'signatureValidity' in feed and feed_state.get('renewBy', 0) <= current_timestamp():
+            # Signatures are due for renewal, so the aggregate is needed even if it did not change
+            feed_state = {}
+
+        started = time.perf_counter()
+        handle, fetched['feedState'] = download_metadata(feed['metadataUrl'], feed_state)
+        fetched['fetch'] = time.perf_counter() - started
+        if handle is None:
+            print("Metadata at %s was not modified since the last import" % feed['metadataUrl'])
+            return fetched
+
+        md_cert_pem = read_cached_file_from_s3(feed['providerSigningCert'], feed['keyBucket']).decode()
+        started = time.perf_counter()
+        try:
+            fetched['root'] = get_and_validate_metadata(handle.read(), md_cert_pem)
+        finally:
+            handle.close()
+        fetched['verify'] = time.perf_counter() - started
+    except (Exception, SystemExit) as e:
+        # One broken feed does not hold up the others
+        print("ERROR: could not read %s: %r" % (feed['metadataUrl'], e))
+        fetched['error'] = repr(e)
+    return fetched
+
+
+def claim_entities(feeds, fetched):
+    """
+    Decides which feed stores each entity: the first feed of the list that carries it
+
+    A feed whose aggregate was not modified or could not be read claims the entities it stored
+    before, so that the feeds after it do not take them over in the meantime.
+
+    :param feeds: events of the feeds, in order of precedence
+    :param fetched: as returned by fetch_feed for each feed
+    :return: for each feed, the entityIDs claimed by the feeds before it
+    :rtype: list
+    """
+
+    claimed = set()
+    earlier = []
+    for feed, result in zip(feeds, fetched):
+        earlier.append(frozenset(claimed))
+        if result['root'] is None:
+            claimed.update(load_source_digests(feed['providerName'], get_metadata_store(feed)))
+        elif 'descriptorType' in feed:
+            claimed.update(entity.attrib['entityID'] for entity in result['root'].iter(URN + 'EntityDescriptor')
+                           if entity.find(URN + feed['descriptorType']) is not None)
+    return earlier
+
+
+def store_feed(feed, fetched, claimed, timestamp):
+    """
+    Signs and stores the entities of one verified feed of a multi-feed import
+
+    :param feed: event of the feed
+    :param fetched: as returned by fetch_feed
+    :param claimed: entityIDs claimed by the feeds before it, which it leaves alone
+    :param timestamp: Time stamp of the multi-feed import
+    :return: the 'status', timings and entity counts of the feed, and its 'feedState'
+    :rtype: dict
+    """
+
+    report = dict((key, fetched[key]) for key in ('fetch', 'verify', 'feedState') if key in fetched)
+    report['skipped'] = 0
+    if fetched['error'] is not None:
+        report.update(status='failed', error=fetched['error'])
+        return report
+    if fetched['root'] is None:
+        report['status'] = 'notModified'
+        return report
+
+    root = fetched['root']
+    skipped = []
+    results = {}
+    started = time.perf_counter()
+    try:
+        our_key, our_cert = read_signing_material(feed)
+        store_entities(skip_claimed(root.iter(URN + 'EntityDescriptor'), claimed, skipped),
+                       root.attrib['validUntil'], feed, our_key, our_cert, report['feedState'], results, timestamp)
+    except (Exception, SystemExit) as e:
+        print("ERROR: could not store %s: %r" % (feed['metadataUrl'], e))
+        report.update(status='failed', error=repr(e))
+    else:
+        report['status'] = 'imported'
+    report['store'] = time.perf_counter() - started
+    report['skipped'] = len(skipped)
+    for name in ('changed', 'renewed', 'unchanged', 'failed'):
+        report[name] = results.get(name, 0)
+    return report
+
+
+def skip_claimed(entities, claimed, skipped):
+    """
+    :param entities: EntityDescriptor elements
+    :param claimed: entityIDs to leave out
+    :param skipped: receives the entityIDs left out
+    :return: the entities not claimed
+    :rtype: generator
+    """
+    for entity in entities:
+        if entity.attrib['entityID'] in claimed:
+            skipped.append(entity.attrib['entityID'])
+        else:
+            yield entity
+
+
 def get_and_validate_metadata(metadata, md_cert_pem):
     """
     Validate metadata from event via XML Verifier class
@@ -102,22 +532,562 @@ def get_and_validate_metadata(metadata, md_cert_pem):
     """
 
     md_root = etree.fromstring(metadata)
+    return verify_metadata_root(md_root, md_cert_pem)
+
+
+def verify_metadata_root(md_root, md_cert_pem):
+    """
+    Verify the signature of a parsed metadata aggregate
+
+    :param md_root: root of the parsed XML metadata
+    :param md_cert_pem: Provider signing certification
+    :type md_root: XML node
+    :type md_cert_pem: str
+    :return: the signed part of the metadata
+    :rtype: XML node
+    """
 
     try:
-        asserted_metadata = signxml.XMLVerifier().verify(md_root, x509_cert=md_cert_pem)
+        with metrics.current().timer('VerifyTime'):
+            asserted_metadata = signxml.XMLVerifier().verify(md_root, x509_cert=load_x509_certificate(md_cert_pem))
         root = asserted_metadata.signed_xml
 
     except signxml.exceptions.InvalidSignature:
         print("ERROR: signature validation failure")
         sys.exit(5)
-    except signxml.exceptions:
+    except signxml.exceptions.SignXMLException:
         print("ERROR: Some other error occurred")
         sys.exit(5)
 
     return root
 
 
-def store_metadata(root, event, our_key, our_cert):
+def download_metadata(url, feed_state=None):
+    """
+    Download the metadata aggregate into a spooled temporary file
+
+    Small documents stay in memory, large ones are written to /tmp, so the download never needs
+    a second in-memory copy of the aggregate. The stored validators are sent as conditional request
+    headers and gzip transfer encoding is accepted.
+
+    :param url: the url to load the metadata from
+    :param feed_state: 'etag' and 'lastModified' of the last imported aggregate
+    :type url: string
+    :type feed_state: dict
+    :return: file object positioned at the start of the document, or None when the aggregate was
+        not modified, and the validators of the downloaded aggregate
+    :rtype: (tempfile.SpooledTemporaryFile, dict)
+    """
+
+    started = time.perf_counter()
+    feed_state = feed_state or {}
+    request = Request(url, headers={'Accept-Encoding': 'gzip'})
+    if feed_state.get('etag'):
+        request.add_header('If-None-Match', feed_state['etag'])
+    if feed_state.get('lastModified'):
+        request.add_header('If-Modified-Since', feed_state['lastModified'])
+
+    try:
+        handle = urlopen(request)
+    except HTTPError as e:
+        if e.code == 304:
+            metrics.current().count('NotModified')
+            return None, feed_state
+        raise
+
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    try:
+        headers = handle.info()
+        body = handle
+        if headers.get('Content-Encoding', '').lower() == 'gzip':
+            body = gzip.GzipFile(fileobj=handle, mode='rb')
+        shutil.copyfileobj(body, spool, DOWNLOAD_CHUNK_SIZE)
+    finally:
+        handle.close()
+
+    new_feed_state = {}
+    if headers.get('ETag'):
+        new_feed_state['etag'] = headers['ETag']
+    if headers.get('Last-Modified'):
+        new_feed_state['lastModified'] = headers['Last-Modified']
+
+    recorder = metrics.current()
+    recorder.put('FetchBytes', spool.tell(), 'Bytes')
+    recorder.put('FetchTime', (time.perf_counter() - started) * 1000, 'Milliseconds')
+    spool.seek(0)
+    return spool, new_feed_state
+
+
+def read_feed_state(event):
+    """
+    Reads the validators of the provider's last imported aggregate
+
+    :param event: data representing the captured activity
+    :return: 'etag' and 'lastModified', empty when nothing was imported yet
+    :rtype: dict
+    """
+
+    s3 = get_s3_client()
+    try:
+        response = s3.get_object(Bucket=get_state_bucket(event), Key=get_feed_state_key(event))
+    except exceptions.ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchKey':
+            print("Could not read the feed state: %s" % e.response['Error']['Message'])
+        return {}
+
+    return json.loads(response['Body'].read().decode('utf-8'))
+
+
+def write_feed_state(event, feed_state):
+    """
+    Saves the validators of the imported aggregate for the next conditional fetch
+
+    :param event: data representing the captured activity
+    :param feed_state: 'etag' and 'lastModified' of the aggregate
+    """
+
+    s3 = get_s3_client()
+    try:
+        s3.put_object(Bucket=get_state_bucket(event), Key=get_feed_state_key(event),
+                      Body=json.dumps(feed_state).encode('utf-8'), ContentType='application/json')
+    except exceptions.ClientError as e:
+        print("Could not save the feed state: %s" % e.response['Error']['Message'])
+
+
+def create_checkpoint(valid_until, feed_state):
+    """
+    :param valid_until: the validUntil of the aggregate
+    :param feed_state: validators of the aggregate, saved once the import is complete
+    :return: the progress of an import that did not process any entity yet
+    :rtype: dict
+    """
+    return {'entityIndex': -1, 'timestamp': current_timestamp(), 'validUntil': valid_until, 'feedState': feed_state}
+
+
+def read_checkpoint(event):
+    """
+    Reads the progress of the provider's unfinished import
+
+    :param event: data representing the captured activity
+    :return: 'digest', 'bucket' and 'key' of the staged aggregate, index of the last processed entity
+        ('entityIndex'), 'timestamp' of the run, number of 'failed' writes so far, 'validUntil' and
+        'feedState' of the aggregate, or None when no import is unfinished
+    :rtype: dict
+    """
+
+    s3 = get_s3_client()
+    try:
+        response = s3.get_object(Bucket=get_state_bucket(event), Key=get_checkpoint_key(event))
+    except exceptions.ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchKey':
+            print("Could not read the checkpoint: %s" % e.response['Error']['Message'])
+        return None
+
+    return json.loads(response['Body'].read().decode('utf-8'))
+
+
+def write_checkpoint(event, checkpoint):
+    """
+    Saves the progress of an import that ran out of time for the next invocation
+
+    :param event: data representing the captured activity
+    :param checkpoint: as returned by read_checkpoint
+    """
+
+    s3 = get_s3_client()
+    s3.put_object(Bucket=get_state_bucket(event), Key=get_checkpoint_key(event),
+                  Body=json.dumps(checkpoint).encode('utf-8'), ContentType='application/json')
+
+
+def delete_checkpoint(event, checkpoint):
+    """
+    Removes the checkpoint of a finished or abandoned import and its staged aggregate
+    """
+
+    s3 = get_s3_client()
+    if 'key' in checkpoint:
+        s3.delete_object(Bucket=checkpoint['bucket'], Key=checkpoint['key'])
+    s3.delete_object(Bucket=get_state_bucket(event), Key=get_checkpoint_key(event))
+
+
+def open_checkpoint(event, checkpoint):
+    """
+    Reads the staged aggregate of a checkpoint
+
+    :param event: data representing the captured activity
+    :param checkpoint: as returned by read_checkpoint
+    :return: file object holding the verified aggregate, None when the staged aggregate is gone or
+        was modified, in which case the checkpoint is dropped and the import starts over
+    :rtype: tempfile.SpooledTemporaryFile
+    """
+
+    handle = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    try:
+        get_s3_client().download_fileobj(checkpoint['bucket'], checkpoint['key'], handle)
+    except exceptions.ClientError as e:
+        print("Could not read the staged aggregate: %s" % e.response['Error']['Message'])
+        handle.close()
+        handle = None
+    else:
+        if file_digest(handle) != checkpoint['digest']:
+            print("ERROR: staged aggregate does not match its checkpoint")
+            handle.close()
+            handle = None
+
+    if handle is None:
+        delete_checkpoint(event, checkpoint)
+    return handle
+
+
+def import_within_budget(verified, entities, checkpoint, event, context, our_key, our_cert):
+    """
+    Sign and save entities until the invocation runs out of time, then save a checkpoint
+
+    Entities are counted in document order over the whole aggregate. The ones up to the checkpoint's
+    'entityIndex' are skipped, and all entities of the import are stored with the time stamp of the
+    run that started it. The verified aggregate is staged in the state bucket the first time a
+    checkpoint is saved, so that resumed runs neither download nor verify it again. Stale entities
+    are swept once the last entity is stored.
+
+    :param verified: file object holding the verified aggregate, or its verified root element
+    :param entities: EntityDescriptor elements of the verified aggregate
+    :param checkpoint: progress of the import, updated in place
+    :param event: data representing the captured activity
+    :param context: runtime information for handler, None for no time limit
+    :param our_key: Our signing key
+    :param our_cert: Our signing certificate
+    :return: success, false when the import is not complete yet
+    :rtype: bool
+    """
+
+    budget = TimeBudget(context, float(event.get('checkpointMargin', CHECKPOINT_MARGIN)))
+    feed_state = {}
+    results = {}
+    success = store_entities(budget.watch(entities, checkpoint['entityIndex'] + 1), checkpoint['validUntil'], event,
+                             our_key, our_cert, feed_state, results, checkpoint['timestamp'])
+
+    if 'renewBy' in feed_state:
+        previous = checkpoint['feedState'].get('renewBy', feed_state['renewBy'])
+        checkpoint['feedState']['renewBy'] = min(previous, feed_state['renewBy'])
+    checkpoint['failed'] = checkpoint.get('failed', 0) + results.get('failed', 0)
+
+    if not budget.exhausted:
+        if 'key' in checkpoint:
+            delete_checkpoint(event, checkpoint)
+        finish_import(event, checkpoint['timestamp'], checkpoint['failed'])
+        return success
+
+    if get_state_bucket(event) is None:
+        print("WARNING: running out of time without a stateBucket to save a checkpoint to, the next invocation "
+              "starts over")
+        return False
+    if budget.last_index is None:
+        print("WARNING: no time left to import any entity, checkpointMargin may be too large")
+    else:
+        checkpoint['entityIndex'] = budget.last_index
+    if 'key' not in checkpoint:
+        if isinstance(verified, etree._Element):
+            verified = io.BytesIO(etree.tostring(verified))
+        checkpoint['bucket'] = get_state_bucket(event)
+        checkpoint['key'] = get_staging_key(event)
+        checkpoint['digest'] = file_digest(verified)
+        get_s3_client().upload_fileobj(verified, checkpoint['bucket'], checkpoint['key'])
+    write_checkpoint(event, checkpoint)
+    print("Running out of time, saved a checkpoint after entity %d" % checkpoint['entityIndex'])
+    return False
+
+
+class TimeBudget(object):
+    """
+    Feeds entities to an import until the invocation is about to time out
+    """
+
+    def __init__(self, context, margin=CHECKPOINT_MARGIN):
+        """
+        :param context: runtime information for handler, None for no time limit
+        :param margin: seconds left to the invocation when no more entities are taken
+        """
+        self.context = context
+        self.margin = margin
+        self.last_index = None
+        self.exhausted = False
+
+    def watch(self, entities, start=0):
+        """
+        :param entities: EntityDescriptor elements in document order
+        :param start: index of the first entity to pass on
+        :return: the entities from start on, until the remaining time drops below the margin
+        :rtype: generator
+        """
+        for index, entity in enumerate(islice(entities, start, None), start):
+            if self.context is not None and self.context.get_remaining_time_in_millis() < self.margin * 1000:
+                self.exhausted = True
+                return
+            self.last_index = index
+            yield entity
+
+
+def file_digest(handle):
+    """
+    :return: hex SHA-256 digest of a file's content; the file is positioned at its start again
+    :rtype: string
+    """
+    handle.seek(0)
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: handle.read(DOWNLOAD_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    handle.seek(0)
+    return digest.hexdigest()
+
+
+def get_import_name(event):
+    # The SP and IdP imports of a provider usually read the same aggregate, but each keeps its own
+    # validators and progress
+    name = parse.quote(event['providerName'], safe='')
+    if 'descriptorType' in event:
+        name += '/' + parse.quote(event['descriptorType'], safe='')
+    return name
+
+
+def get_checkpoint_key(event):
+    return CHECKPOINT_PREFIX + get_import_name(event) + '.json'
+
+
+def get_state_bucket(event):
+    # No fallback to the keyBucket, which holds our private key
+    return event.get('stateBucket')
+
+
+def is_conditional_fetch(event):
+    """
+    :return: whether the import sends the validators of the last imported aggregate, and saves the
+        new ones, which needs a stateBucket
+    :rtype: bool
+    """
+    return event.get('conditionalFetch', True) and not event.get('forceResign') and get_state_bucket(event) is not None
+
+
+def get_feed_state_key(event):
+    return FEED_STATE_PREFIX + get_import_name(event) + '.json'
+
+
+def get_document_bucket(event):
+    # Without a document bucket, documents stay in their items however large. They never fall back
+    # to the keyBucket: the query handler would need read access to the bucket of our private key.
+    return event.get('documentBucket')
+
+
+def verify_metadata_file(handle, md_cert_pem):
+    """
+    Verify the signature of a spooled metadata aggregate before any of it is used
+
+    The parsed tree is only needed for the signature check and is released on return; the
+    entities are then read again from the file with iter_entity_descriptors.
+
+    This step is not bounded in memory: the whole aggregate is parsed, and signxml verifies a copy
+    of the tree, so the peak memory grows linearly with the aggregate, at over ten times its size
+    (bench_import_pipeline reports it). The Lambda memory size has to allow for that.
+
+    :param handle: file object holding the aggregate
+    :param md_cert_pem: Provider signing certification
+    :type md_cert_pem: str
+    :return: the validUntil attribute of the aggregate
+    :rtype: string
+    """
+
+    handle.seek(0)
+    md_root = etree.parse(handle).getroot()
+    signed_root = verify_metadata_root(md_root, md_cert_pem)
+
+    # The file is walked again after verification, so the signature has to cover the whole
+    # document and not just some element inside it.
+    if signed_root.tag != md_root.tag or signed_root.get('ID') != md_root.get('ID') or \
+            list_entity_ids(signed_root) != list_entity_ids(md_root):
+        print("ERROR: signature does not cover the whole metadata document")
+        sys.exit(5)
+
+    return md_root.attrib['validUntil']
+
+
+def list_entity_ids(root):
+    return [item.get('entityID') for item in root.iter(URN + "EntityDescriptor")]
+
+
+def iter_entity_descriptors(handle):
+    """
+    Walk the EntityDescriptor elements of a metadata aggregate with an incremental parser
+
+    Each element is cleared once the caller has moved on to the next one, and already processed
+    siblings are dropped from the partial tree, so the walk itself does not hold the document. It
+    does not bound the memory of an import, see verify_metadata_file.
+
+    :param handle: file object holding the aggregate
+    :return: EntityDescriptor elements in document order
+    :rtype: generator
+    """
+
+    handle.seek(0)
+    for _, item in etree.iterparse(handle, events=('end',), tag=URN + "EntityDescriptor"):
+        yield item
+
+        item.clear()
+        parent = item.getparent()
+        while item.getprevious() is not None:
+            del parent[0]
+
+
+def import_sharded(handle, valid_until, event, feed_state):
+    """
+    Import a verified aggregate by handing out ranges of its entities to shard workers
+
+    The aggregate is staged in the state bucket for the workers and removed afterwards; a lifecycle
+    rule on the staging prefix takes care of documents left behind by a coordinator that died.
+
+    :param handle: file object holding the verified aggregate
+    :param valid_until: the validUntil of the aggregate
+    :param event: data representing the captured activity
+    :param feed_state: receives 'renewBy', the earliest renewal time reported by the shards
+    :return: success, false when any shard failed
+    :rtype: bool
+    """
+
+    entity_count = sum(1 for _ in iter_entity_descriptors(handle))
+    shard_size = int(event['shardSize'])
+    concurrency = int(event.get('shardConcurrency', SHARD_CONCURRENCY))
+
+    bucket = get_state_bucket(event)
+    key = get_staging_key(event)
+    s3 = get_s3_client()
+    handle.seek(0)
+    s3.upload_fileobj(handle, bucket, key)
+
+    shard_event = dict((name, value) for name, value in event.items() if name != 'shardSize')
+    shard_events = [dict(shard_event, shard={'bucket': bucket, 'key': key, 'validUntil': valid_until,
+                                             'start': start, 'stop': min(start + shard_size, entity_count)})
+                    for start in range(0, entity_count, shard_size)]
+
+    if 'workerFunction' in event:
+        executor = LambdaShardExecutor(event['workerFunction'], concurrency)
+    else:
+        executor = LocalShardExecutor(concurrency)
+
+    started = time.time()
+    # Shards store their entities with time stamps of their own, all later than this one
+    timestamp = current_timestamp()
+    try:
+        results = executor.run(shard_events)
+    finally:
+        s3.delete_object(Bucket=bucket, Key=key)
+
+    success = True
+    totals = {}
+    for shard, result in zip(shard_events, results):
+        start, stop = shard['shard']['start'], shard['shard']['stop']
+        if isinstance(result, BaseException):
+            print("ERROR: shard of entities %d to %d failed: %r" % (start, stop, result))
+            success = False
+            continue
+
+        print("Shard of entities %d to %d: %d changed, %d renewed, %d unchanged, %d failed writes in %.2fs" % (
+            start, stop, result.get('changed', 0), result.get('renewed', 0), result.get('unchanged', 0),
+            result.get('failed', 0), result['seconds']))
+        for name in ('changed', 'renewed', 'unchanged', 'put', 'updated', 'touched', 'failed'):
+            totals[name] = totals.get(name, 0) + result.get(name, 0)
+        if result.get('renewBy') is not None:
+            feed_state['renewBy'] = min(feed_state.get('renewBy', result['renewBy']), result['renewBy'])
+
+    print("Imported %d entities in %d shards in %.2fs: %s" % (
+        entity_count, len(shard_events), time.time() - started,
+        ', '.join('%d %s' % (totals[name], name) for name in sorted(totals))))
+    if success:
+        finish_import(event, timestamp, totals.get('failed', 0))
+    return success
+
+
+def import_shard(event):
+    """
+    Sign and save one range of entities of an aggregate staged by import_sharded
+
+    The staged aggregate was verified by the coordinator and is not verified again.
+
+    :param event: the coordinator's event with the 'shard' to import
+    :return: the counts of the import, its 'renewBy' and the 'seconds' it took
+    :rtype: dict
+    """
+
+    started = time.time()
+    shard = event['shard']
+    our_key, our_cert = read_signing_material(event)
+
+    handle = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    try:
+        get_s3_client().download_fileobj(shard['bucket'], shard['key'], handle)
+
+        # Entities before the range are parsed and dropped again; parsing is cheap next to signing
+        entities = islice(iter_entity_descriptors(handle), shard['start'], shard['stop'])
+        shard_state = {}
+        results = {}
+        store_entities(entities, shard['validUntil'], event, our_key, our_cert, shard_state, results)
+    finally:
+        handle.close()
+
+    results['renewBy'] = shard_state.get('renewBy')
+    results['seconds'] = time.time() - started
+    return results
+
+
+def get_staging_key(event):
+    return '%s%s/%d.xml' % (STAGING_PREFIX, get_import_name(event), int(time.time() * 1000))
+
+
+class LocalShardExecutor(object):
+    """
+    Runs shard imports on a thread pool of this process
+
+    :meth:`run` returns the result of every shard in order, or the exception it failed with.
+    """
+
+    def __init__(self, concurrency=SHARD_CONCURRENCY):
+        self.concurrency = concurrency
+
+    def run(self, shard_events):
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            invoke = metrics.bind(self.invoke)
+            futures = [executor.submit(invoke, shard_event) for shard_event in shard_events]
+
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except (Exception, SystemExit) as e:
+                results.append(e)
+        return results
+
+    def invoke(self, shard_event):
+        return lambda_handler(shard_event, None)
+
+
+class LambdaShardExecutor(LocalShardExecutor):
+    """
+    Runs shard imports as synchronous invocations of a Lambda function
+    """
+
+    def __init__(self, function_name, concurrency=SHARD_CONCURRENCY):
+        LocalShardExecutor.__init__(self, concurrency)
+        self.function_name = function_name
+        self.client = get_lambda_client()
+
+    def invoke(self, shard_event):
+        response = self.client.invoke(FunctionName=self.function_name,
+                                      InvocationType='RequestResponse',
+                                      Payload=json.dumps(shard_event).encode('utf-8'))
+        payload = json.loads(response['Payload'].read().decode('utf-8'))
+        if 'FunctionError' in response:
+            raise RuntimeError(payload.get('errorMessage', payload) if isinstance(payload, dict) else payload)
+        return payload
+
+
+def store_metadata(root, event, our_key, our_cert, feed_state=None):
     """
     Save attributes that match the event object's value stored under the 'descriptorType' key
 
@@ -125,42 +1095,623 @@ def store_metadata(root, event, our_key, our_cert):
     :param event: data representing the captured activity
     :param our_key: Our signing key
     :param our_cert: Our signing certificate
+    :param feed_state: receives 'renewBy' when signatures are renewed on a schedule
     :type root: byte string
     :type event: dict
     :type our_key: binary
     :type our_cert: string
+    :type feed_state: dict
     :return: success
     :rtype: bool
     """
 
-    now = (datetime.datetime.utcnow().replace(tzinfo=pytz.utc) - datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)).total_seconds()
+    timestamp = current_timestamp()
+    results = {}
+    success = store_entities(root.iter(URN + "EntityDescriptor"), root.attrib['validUntil'], event, our_key, our_cert,
+                             feed_state, results, timestamp)
+    finish_import(event, timestamp, results.get('failed', 0))
+    return success
+
+
+def store_entities(entities, valid_until, event, our_key, our_cert, feed_state=None, results=None, timestamp=None):
+    """
+    Sign and save the given entities that match the event object's 'descriptorType'
+
+    :param entities: EntityDescriptor elements of a verified aggregate
+    :param valid_until: the validUntil of the aggregate
+    :param event: data representing the captured activity
+    :param our_key: Our signing key
+    :param our_cert: Our signing certificate
+    :param feed_state: receives 'renewBy', the time the first signature of this provider is due for
+        renewal, when the event specifies a signatureValidity
+    :param results: receives the number of 'changed', 'renewed' and 'unchanged' entities and the
+        MetadataWriter counts
+    :param timestamp: Time stamp of the import, now when None
+    :type entities: iterable of XML nodes
+    :type valid_until: string
+    :type event: dict
+    :type our_key: binary
+    :type our_cert: string
+    :type feed_state: dict
+    :type results: dict
+    :type timestamp: float
+    :return: success
+    :rtype: bool
+    """
 
-    xml_signer = signxml.XMLSigner(method=signxml.methods.enveloped,
-                                   signature_algorithm=u'rsa-sha256',
-                                   digest_algorithm=u'sha256',
-                                   c14n_algorithm=u'http://www.w3.org/2001/10/xml-exc-c14n#')
+    now = current_timestamp() if timestamp is None else timestamp
 
-    valid_until = root.attrib['validUntil']
+    workers = int(event.get('signingWorkers', 1))
 
     if 'descriptorType' in event:
-        for item in root.iter(URN + "EntityDescriptor"):
-            if item.find(URN + event['descriptorType']) is not None:
-                entity_id = item.attrib['entityID']
-                standalone = create_standalone_fragment(item, entity_id, valid_until)
-                xml = sign_fragment(standalone, xml_signer, our_key, our_cert)
-                doc = create_document(xml)
-                update_dynamodb(entity_id, event['providerName'], doc, now)
+        store = get_metadata_store(event)
+
+        provider = event['providerName']
+        force_resign = event.get('forceResign', False)
+        renewal = None
+        expiries = {}
+        published_until = parse_xml_datetime(valid_until)
+        if 'signatureValidity' in event:
+            renewal = RenewalSchedule(now, float(event['signatureValidity']) * 3600,
+                                      float(event.get('renewBefore', float(event['signatureValidity']) / 4)) * 3600,
+                                      valid_until, expiries)
+            # The validUntil is stamped on the fragments after their source digest is taken
+            valid_until = None
+            published_until = renewal.valid_until
+
+        writer = MetadataWriter(store, now, int(event.get('writeConcurrency', WRITE_CONCURRENCY)),
+                                get_document_bucket(event), create_publisher(event, published_until),
+                                not event.get('publishOnly', False), event['descriptorType'])
+
+        stored_digests = {} if force_resign else load_source_digests(provider, store, expiries)
+        counts = {'changed': 0, 'unchanged': 0, 'renewed': 0}
+
+        try:
+            fragments = select_fragments(entities, event['descriptorType'], valid_until)
+            changed = select_changed_fragments(fragments, stored_digests, counts, our_cert, writer, renewal)
+            expires = renewal.valid_until if renewal is not None else None
+            for (entity_id, digest), doc in sign_documents(changed, our_key, our_cert, workers):
+                # Records written before source digests existed may hold this very document, so
+                # they keep the etag condition that leaves last_changed alone in that case.
+                if force_resign or stored_digests.get(entity_id, '') is None:
+                    writer.update(entity_id, provider, doc, digest, expires)
+                else:
+                    writer.put(entity_id, provider, doc, digest, expires)
+        finally:
+            write_counts = writer.close()
+
+        if results is not None:
+            results.update(counts)
+            results.update(write_counts)
+
+        print("Signed %d changed entities, renewed %d signatures, %d unchanged" % (
+            counts['changed'], counts['renewed'], counts['unchanged']))
+        recorder = metrics.current()
+        for name in ('changed', 'renewed', 'unchanged'):
+            recorder.count(name.capitalize(), counts[name])
+        recorder.count('Failed', write_counts['failed'])
+
+        if renewal is not None and feed_state is not None and renewal.next_renewal is not None:
+            feed_state['renewBy'] = renewal.next_renewal
 
     return True
 
 
+def current_timestamp():
+    return (datetime.datetime.utcnow().replace(tzinfo=pytz.utc) - datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)).total_seconds()
+
+
+def refresh_last_seen(provider, timestamp, store=None):
+    """
+    Marks all stored entities of a provider as seen, for runs that find the aggregate unchanged
+
+    :param provider: Name of provider of XML metadata
+    :param timestamp: Time stamp of this import
+    :param store: MetadataStore to use, the DynamoDb table when None
+    :return: number of items 'touched' and 'failed'
+    :rtype: dict
+    """
+
+    if store is None:
+        store = get_metadata_store({})
+    writer = MetadataWriter(store, timestamp)
+    try:
+        for entity_id in load_source_digests(provider, store):
+            writer.touch(entity_id)
+    finally:
+        counts = writer.close()
+    return counts
+
+
+def finish_import(event, timestamp, failed):
+    """
+    Sweeps the stale entities of the event's provider and publishes the entity filter after a
+    complete import
+
+    :param event: data representing the captured activity
+    :param timestamp: Time stamp the import started with
+    :param failed: number of failed writes of the import
+    """
+
+    sweep_after_import(event, timestamp, failed)
+    if 'filterBucket' in event:
+        publish_entity_filter(event['filterBucket'],
+                              float(event.get('filterFalsePositiveRate', DEFAULT_FALSE_POSITIVE_RATE)),
+                              int(event.get('filterMaxBytes', ENTITY_FILTER_MAX_BYTES)), get_metadata_store(event))
+
+
+def publish_entity_filter(bucket, false_positive_rate=DEFAULT_FALSE_POSITIVE_RATE,
+                          max_bytes=ENTITY_FILTER_MAX_BYTES, store=None):
+    """
+    Builds a Bloom filter over the identifiers of all stored entities and makes it the current one
+
+    The entityIDs are read from the provider index, which holds the small records only. The filter is
+    uploaded under its SHA-256 before the manifest is replaced, so a reader never finds a manifest
+    naming a filter that is not there yet.
+
+    :param bucket: S3 bucket to publish to
+    :param false_positive_rate: share of unknown identifiers the filter lets through
+    :param max_bytes: upper bound of the filter's size
+    :param store: MetadataStore to use, the DynamoDb table when None
+    :return: the manifest of the filter, None when the entityIDs could not be read
+    :rtype: dict
+    """
+
+    if store is None:
+        store = get_metadata_store({})
+
+    started = time.time()
+    try:
+        entity_ids = list(store.entity_ids())
+    except StoreError as e:
+        print("Could not read the stored entityIDs: %s" % e.message)
+        return None
+
+    entity_filter = BloomFilter.for_capacity(2 * len(entity_ids), false_positive_rate, max_bytes)
+    for entity_id in entity_ids:
+        entity_filter.add(entity_id)
+        entity_filter.add(create_alias_item(entity_id)['entityID']['S'])
+    body = entity_filter.to_bytes()
+
+    key = ENTITY_FILTER_PREFIX + hashlib.sha256(body).hexdigest() + '.bloom'
+    manifest = {'key': key, 'entities': len(entity_ids), 'bytes': len(body),
+                'falsePositiveRate': entity_filter.false_positive_rate, 'timestamp': current_timestamp()}
+    s3 = get_s3_client()
+    s3.put_object(Bucket=bucket, Key=key, Body=body, ContentType='application/octet-stream')
+    s3.put_object(Bucket=bucket, Key=ENTITY_FILTER_MANIFEST, Body=json.dumps(manifest).encode('utf-8'),
+                  ContentType='application/json')
+    print("Published an entity filter of %d entities, %d bytes, false positive rate %.5f in %.2fs" % (
+        len(entity_ids), len(body), entity_filter.false_positive_rate, time.time() - started))
+    return manifest
+
+
+def sweep_after_import(event, timestamp, failed):
+    """
+    Sweeps the stale entities of the event's provider after a complete import
+
+    Entities whose last_seen refresh failed would look stale, so nothing is swept when any write
+    of the import failed.
+
+    :param event: data representing the captured activity
+    :param timestamp: Time stamp the import started with
+    :param failed: number of failed writes of the import
+    :return: counts of the sweep, None when it did not run
+    :rtype: dict
+    """
+
+    if 'descriptorType' not in event or not event.get('sweepStale', False):
+        return None
+    if failed:
+        print("Not sweeping stale entities of %s, %d writes failed" % (event['providerName'], failed))
+        return None
+    return sweep_stale_entities(event['providerName'], event['descriptorType'], timestamp, get_metadata_store(event),
+                                create_publisher(event))
+
+
+def sweep_stale_entities(provider, descriptor_type, timestamp, store=None, publisher=None):
+    """
+    Deletes the entities of a provider and descriptor type that were not seen since the given time stamp
+
+    Candidates are looked up in the provider index instead of scanning the table. As the index may
+    lag behind, their records are read again, consistently, before the record, document and alias
+    of each stale entity are deleted in batches.
+
+    :param provider: Name of provider of XML metadata
+    :param descriptor_type: 'SPSSODescriptor' or 'IDPSSODescriptor', the import that saw the entities
+    :param timestamp: Time stamp of the import that saw the provider's current entities
+    :param store: MetadataStore to use, the DynamoDb table when None
+    :param publisher: DocumentPublisher whose objects of stale entities are deleted too
+    :return: number of entities 'deleted' and 'failed'
+    :rtype: dict
+    """
+
+    if store is None:
+        store = get_metadata_store({})
+
+    started = time.time()
+    try:
+        candidates = list(store.stale_entity_ids(provider, descriptor_type, timestamp))
+    except StoreError as e:
+        print("Could not query stale entities of %s: %s" % (provider, e.message))
+        return {'deleted': 0, 'failed': 0}
+
+    writer = MetadataWriter(store, timestamp, publisher=publisher)
+    try:
+        for start in range(0, len(candidates), BATCH_GET_SIZE):
+            records = store.batch_get_items(candidates[start:start + BATCH_GET_SIZE],
+                                            ['provider', 'descriptor_type', 'last_seen'], consistent=True)
+            for item in records.values():
+                if item.get('provider', {}).get('S') == provider and \
+                        item.get('descriptor_type', {}).get('S') == descriptor_type and \
+                        float(item['last_seen']['N']) < timestamp:
+                    writer.delete(item['entityID']['S'])
+    finally:
+        counts = writer.close()
+
+    print("Swept %d stale entities of %s %s (%d candidates, %d failed) in %.2fs" % (
+        counts['deleted'], provider, descriptor_type, len(candidates), counts['failed'], time.time() - started))
+    metrics.current().count('Swept', counts['deleted'])
+    metrics.current().count('Failed', counts['failed'])
+    return {'deleted': counts['deleted'], 'failed': counts['failed']}
+
+
+def create_xml_signer():
+    return signxml.XMLSigner(method=signxml.methods.enveloped,
+                             signature_algorithm=u'rsa-sha256',
+                             digest_algorithm=u'sha256',
+                             c14n_algorithm=C14N_ALGORITHM)
+
+
+class EntitySigner(object):
+    """
+    Turns standalone entity fragments into signed documents
+
+    Produces the same bytes as sign_fragment followed by create_document, with the XMLSigner's
+    configuration, but builds the enveloped signature directly on the fragment: XMLSigner
+    serializes and re-parses its input twice per call, and the result is serialized once more.
+    Here the fragment is canonicalized once for the digest and serialized once for the document.
+    """
+
+    def __init__(self, our_key, our_cert):
+        """
+        :param our_key: Our signing key
+        :param our_cert: Our signing certificate (chain)
+        """
+        self.key = load_signing_key(our_key)
+        self.cert_chain = load_cert_chain(our_cert)
+
+    def sign(self, fragment):
+        """
+        Signs a standalone fragment and serializes it; the fragment is modified in place
+
+        :param fragment: XML fragment as returned by create_standalone_fragment
+        :return: the signed XML document
+        :rtype: bytes
+        """
+        payload = etree.tostring(fragment, method='c14n', exclusive=True, with_comments=False)
+
+        signature = etree.Element(DS + 'Signature', nsmap=NSMAP)
+        fragment.insert(0, signature)
+
+        # Built in place, like XMLSigner does, so the namespace declarations come out the same
+        signed_info = etree.SubElement(signature, DS + 'SignedInfo', nsmap={'ds': NSMAP[None]})
+        etree.SubElement(signed_info, DS + 'CanonicalizationMethod', Algorithm=C14N_ALGORITHM)
+        etree.SubElement(signed_info, DS + 'SignatureMethod', Algorithm=SIGNATURE_METHOD)
+        reference = etree.SubElement(signed_info, DS + 'Reference', URI='#' + fragment.get('ID'))
+        transforms = etree.SubElement(reference, DS + 'Transforms')
+        etree.SubElement(transforms, DS + 'Transform', Algorithm=ENVELOPED_SIGNATURE)
+        etree.SubElement(transforms, DS + 'Transform', Algorithm=C14N_ALGORITHM)
+        etree.SubElement(reference, DS + 'DigestMethod', Algorithm=DIGEST_METHOD)
+        etree.SubElement(reference, DS + 'DigestValue').text = b64encode(hashlib.sha256(payload).digest()).decode()
+
+        signature_value = etree.SubElement(signature, DS + 'SignatureValue')
+        key_info = etree.SubElement(signature, DS + 'KeyInfo')
+        x509_data = etree.SubElement(key_info, DS + 'X509Data')
+        for cert in self.cert_chain:
+            etree.SubElement(x509_data, DS + 'X509Certificate').text = cert
+
+        signed_info_c14n = etree.tostring(signed_info, method='c14n', exclusive=True, with_comments=False)
+        signature_value.text = b64encode(self.key.sign(signed_info_c14n, padding.PKCS1v15(), hashes.SHA256())).decode()
+
+        return etree.tostring(fragment,
+                              pretty_print=False,
+                              xml_declaration=True,
+                              encoding="UTF-8",
+                              standalone=True,
+                              with_tail=False)
+
+
+def select_fragments(entities, descriptor_type, valid_until):
+    """
+    Create standalone fragments for the entities that carry the given descriptor type
+
+    :param entities: EntityDescriptor elements
+    :param descriptor_type: 'SPSSODescriptor' or 'IDPSSODescriptor'
+    :param valid_until: the date the metadata is valid until
+    :return: (entity_id, fragment) pairs in document order
+    :rtype: generator
+    """
+
+    for item in entities:
+        if item.find(URN + descriptor_type) is not None:
+            entity_id = item.attrib['entityID']
+            yield entity_id, create_standalone_fragment(item, entity_id, valid_until)
+
+
+def select_changed_fragments(fragments, stored_digests, counts, our_cert, writer, renewal=None):
+    """
+    Pass on only the fragments whose source changed since the last import
+
+    Unchanged entities get their last_seen refreshed instead of being signed and written again,
+    unless their signature is due for renewal.
+
+    :param fragments: (entity_id, fragment) pairs
+    :param stored_digests: entityID -> source digest of the stored records
+    :param counts: receives the number of 'changed', 'renewed' and 'unchanged' entities
+    :param our_cert: Our signing certificate
+    :param writer: MetadataWriter of this import
+    :param renewal: RenewalSchedule of the import, None when fragments carry the aggregate's validUntil
+    :return: ((entity_id, source digest), fragment) pairs that need signing. The digest travels with
+        its fragment, as an aggregate may list an entityID more than once.
+    :rtype: generator
+    """
+
+    for entity_id, fragment in fragments:
+        digest = entity_digest(fragment, our_cert)
+        if stored_digests.get(entity_id) == digest:
+            if renewal is None or not renewal.is_due(entity_id):
+                writer.touch(entity_id)
+                counts['unchanged'] += 1
+                continue
+            counts['renewed'] += 1
+        else:
+            counts['changed'] += 1
+
+        if renewal is not None:
+            renewal.stamp(fragment)
+        yield (entity_id, digest), fragment
+
+
+class RenewalSchedule(object):
+    """
+    Decides which unchanged entities need a new signature when we sign with our own validity window
+
+    Every signature made by an import expires at the same time, the end of our window or the
+    aggregate's validUntil if that comes first. A stored signature is due for renewal once it
+    expires within the renewal margin. The schedule also tracks when the earliest signature of
+    the entities seen by the import comes due, so that the next run knows when it has work to do.
+    """
+
+    def __init__(self, now, validity, renew_before, aggregate_valid_until, expiries):
+        """
+        :param now: Time stamp of the import
+        :param validity: seconds our signatures are valid for
+        :param renew_before: seconds before expiry a signature is renewed
+        :param aggregate_valid_until: the validUntil of the aggregate, None or unparsable for no limit
+        :param expiries: entityID -> expiry time stamp of the stored signatures
+        """
+        self.now = now
+        self.renew_before = renew_before
+        self.expiries = expiries
+        self.valid_until = now + validity
+        aggregate_expiry = parse_xml_datetime(aggregate_valid_until)
+        if aggregate_expiry is not None:
+            self.valid_until = min(self.valid_until, aggregate_expiry)
+        self.valid_until_text = format_xml_datetime(self.valid_until)
+        self.next_renewal = None
+
+    def is_due(self, entity_id):
+        """
+        :return: whether the stored signature of an entity expires within the renewal margin
+        :rtype: bool
+        """
+        expiry = self.expiries.get(entity_id)
+        if expiry is None or expiry - self.renew_before <= self.now:
+            return True
+        self._schedule(expiry - self.renew_before)
+        return False
+
+    def stamp(self, fragment):
+        """
+        Stamps our validity window on a fragment that is about to be signed
+        """
+        fragment.attrib['validUntil'] = self.valid_until_text
+        self._schedule(self.valid_until - self.renew_before)
+
+    def _schedule(self, renewal):
+        if self.next_renewal is None or renewal < self.next_renewal:
+            self.next_renewal = renewal
+
+
+def parse_xml_datetime(value):
+    """
+    Converts an xsd:dateTime in UTC, like a validUntil attribute, to a time stamp
+
+    :return: seconds since the epoch, None when the value is missing or not understood
+    :rtype: float
+    """
+
+    if not value:
+        return None
+    text = value.strip().rstrip('Z')
+    for pattern in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M:%S.%f'):
+        try:
+            parsed = datetime.datetime.strptime(text, pattern).replace(tzinfo=pytz.utc)
+        except ValueError:
+            continue
+        return (parsed - datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)).total_seconds()
+    return None
+
+
+def format_xml_datetime(timestamp):
+    return datetime.datetime.fromtimestamp(int(timestamp), pytz.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def entity_digest(fragment, our_cert):
+    """
+    Digest of everything that goes into an entity's signed document
+
+    Covers the canonicalized fragment, including the ID, cacheDuration and validUntil stamped on it,
+    and the certificate it is signed with.
+
+    :param fragment: standalone XML fragment, not signed yet
+    :param our_cert: Our signing certificate
+    :return: hex SHA-256 digest
+    :rtype: string
+    """
+
+    digest = hashlib.sha256(etree.tostring(fragment, method='c14n', exclusive=True))
+    digest.update(our_cert.encode('utf-8') if isinstance(our_cert, str) else our_cert)
+    return digest.hexdigest()
+
+
+def sign_documents(fragments, our_key, our_cert, workers=1):
+    """
+    Sign fragments and turn them into standalone documents, keeping their order
+
+    :param fragments: (entity_id, fragment) pairs; entity_id may be any picklable value, it is
+        handed back with the document unchanged
+    :param our_key: Our signing key
+    :param our_cert: Our signing certificate
+    :param workers: number of worker processes, 1 signs in this process
+    :return: (entity_id, document) pairs in the order of the fragments
+    :rtype: generator
+    """
+
+    if workers > 1:
+        yield from sign_documents_parallel(fragments, our_key, our_cert, workers)
+        return
+
+    recorder = metrics.current()
+    signer = EntitySigner(our_key, our_cert)
+    for entity_id, fragment in fragments:
+        with recorder.timer('SignTime'):
+            document = signer.sign(fragment)
+        yield entity_id, document
+
+
+def sign_documents_parallel(fragments, our_key, our_cert, workers):
+    """
+    Sign fragments in a pool of worker processes
+
+    Fragments are serialized and sent in batches, round robin, with at most one batch in flight per
+    worker, so collecting the batches in submission order returns the documents in entity order.
+    The pool is built from Process and Pipe because Lambda has no /dev/shm, which
+    multiprocessing.Pool and its queues need. Workers are started with SIGNING_START_METHOD, so
+    the pool may be used from any thread.
+
+    :param fragments: (entity_id, fragment) pairs
+    :param our_key: Our signing key
+    :param our_cert: Our signing certificate
+    :param workers: number of worker processes
+    :return: (entity_id, document) pairs in the order of the fragments
+    :rtype: generator
+    """
+
+    # Fail here rather than in every worker when the key is unusable
+    load_signing_key(our_key)
+
+    context = multiprocessing.get_context(SIGNING_START_METHOD)
+    if SIGNING_START_METHOD == 'forkserver':
+        # The fork server would otherwise import __main__, the Lambda runtime, to start from
+        context.set_forkserver_preload([__name__])
+
+    pool = []
+    for _ in range(workers):
+        connection, worker_connection = context.Pipe()
+        process = context.Process(target=signing_worker, args=(worker_connection, our_key, our_cert))
+        process.daemon = True
+        process.start()
+        worker_connection.close()
+        pool.append((process, connection))
+
+    pending = []
+    try:
+        for batch_number, batch in enumerate(serialize_in_batches(fragments, SIGNING_BATCH_SIZE)):
+            if len(pending) == workers:
+                yield from collect_signed_batch(pending.pop(0))
+            pending.append(send_signing_batch(pool[batch_number % workers][1], batch))
+
+        while pending:
+            yield from collect_signed_batch(pending.pop(0))
+    finally:
+        for process, connection in pool:
+            try:
+                connection.send(None)
+            except (OSError, ValueError):
+                pass
+            connection.close()
+        for process, connection in pool:
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+
+
+def serialize_in_batches(fragments, size):
+    batch = []
+    for entity_id, fragment in fragments:
+        batch.append((entity_id, etree.tostring(fragment, with_tail=False)))
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def send_signing_batch(connection, batch):
+    connection.send([fragment for _, fragment in batch])
+    return connection, [entity_id for entity_id, _ in batch]
+
+
+def collect_signed_batch(sent):
+    connection, entity_ids = sent
+    documents = connection.recv()
+    if isinstance(documents, Exception):
+        raise documents
+    return zip(entity_ids, documents)
+
+
+def signing_worker(connection, our_key, our_cert):
+    """
+    Worker process loop: receives batches of serialized fragments and sends back signed documents
+
+    A None batch stops the worker. Signing errors are sent back to be raised in the parent.
+
+    :param connection: the worker end of the pipe
+    :param our_key: Our signing key, as PEM since parsed keys cannot be sent to a process
+    :param our_cert: Our signing certificate
+    """
+
+    signer = EntitySigner(our_key, our_cert)
+    while True:
+        try:
+            batch = connection.recv()
+        except EOFError:
+            break
+        if batch is None:
+            break
+
+        try:
+            documents = [signer.sign(etree.fromstring(fragment)) for fragment in batch]
+        except Exception as e:
+            documents = e
+
+        try:
+            connection.send(documents)
+        except OSError:
+            # The parent stopped listening
+            break
+
+    connection.close()
+
+
 def create_standalone_fragment(node, entity_id, valid_until):
     """
     Take an XML node and creates a standalone XML fragment
 
     :param node: the element being worked on
     :param entity_id: the entityId of the provider
-    :param valid_until: the date the metadata is valid until
+    :param valid_until: the date the metadata is valid until, None to stamp it later
     :type node: XML node
     :type entity_id: string
     :type valid_until: string
@@ -171,8 +1722,9 @@ def create_standalone_fragment(node, entity_id, valid_until):
 
     copy = deepcopy(node)
     copy.attrib['ID'] = '_' + id_attribute
-    copy.attrib['cacheDuration'] = 'P0Y0M0DT6H0M0.000S'
-    copy.attrib['validUntil'] = valid_until
+    copy.attrib['cacheDuration'] = CACHE_DURATION
+    if valid_until is not None:
+        copy.attrib['validUntil'] = valid_until
     return copy
 
 
@@ -187,7 +1739,7 @@ def sign_fragment(fragment, xml_signer, key, cert):
     :return: Signed fragment
     """
 
-    fragment.insert(0, etree.Element("Signature", Id="placeholder", nsmap=NSMAP))
+    fragment.insert(0, etree.Element("{%s}Signature" % NSMAP[None], Id="placeholder", nsmap=NSMAP))
     return xml_signer.sign(fragment, key=key, cert=cert)
 
 
@@ -207,48 +1759,485 @@ def create_document(fragment):
     return doc
 
 
-def update_dynamodb(entity_id, provider, document, timestamp):
+def update_dynamodb(entity_id, provider, document, timestamp, source_digest=None, store=None, valid_until=None,
+                    document_bucket=None, store_document=True, descriptor_type=None):
     """
-    Stores a provider's metadata (XML Document) in DynamoDb
+    Stores a provider's metadata (XML Document) in the metadata store, unless the stored document has the same etag
+
+    The document item and the {sha1} alias are written first, so that a reader never finds an etag
+    whose document is not stored yet. Records of the old layout lose the document they held inline.
 
     :param entity_id: Entity Id from original XML node
     :param provider: Name of provider of XML metadata
     :param document: XML document of node
     :param timestamp: Time stamp
-    :return:
+    :param source_digest: digest of the source the document was signed from
+    :param store: MetadataStore to use, the DynamoDb table when None
+    :param valid_until: expiry time stamp of our signature, when we sign with our own validity window
+    :param document_bucket: S3 bucket for a document too large for its item
+    :param store_document: false to only keep the record, for documents published to S3 instead
+    :param descriptor_type: descriptor type of the import, that only sweeps its own entities
+    :return: success, None when the entity could not be stored
+    """
+
+    if store is None:
+        store = get_metadata_store({})
+
+    values = {
+        "provider": {"S": provider},
+        "etag": {"S": hashlib.md5(document).hexdigest()},
+        "last_changed": {"N": str(timestamp)},
+        "last_seen": {"N": str(timestamp)}
+    }
+    if source_digest is not None:
+        values["source_digest"] = {"S": source_digest}
+    if valid_until is not None:
+        values["valid_until"] = {"N": str(valid_until)}
+    if descriptor_type is not None:
+        values["descriptor_type"] = {"S": descriptor_type}
+
+    try:
+        with metrics.current().timer('WriteLatency'):
+            if store_document:
+                store.put_item(create_document_item(entity_id, document, document_bucket))
+                store.put_item(create_alias_item(entity_id))
+            updated = store.update_record(entity_id, values, ['metadata'], unless_etag=values["etag"]["S"])
+    except StoreError as e:
+        print(e.message)
+        return None
+
+    if not updated:
+        # The document did not change. Setting the last seen flag, so we don't delete it.
+        return touch_last_seen(entity_id, timestamp, source_digest, store, descriptor_type)
+    return True
+
+
+def touch_last_seen(entity_id, timestamp, source_digest=None, store=None, descriptor_type=None):
+    """
+    Marks a stored entity as still present in the provider's metadata
+
+    :param entity_id: Entity Id of the stored record
+    :param timestamp: Time stamp
+    :param source_digest: digest of the source to record along the way
+    :param store: MetadataStore to use, the DynamoDb table when None
+    :param descriptor_type: descriptor type of the import that saw the entity, recorded along the way
+    :return: success, None when there is no such record or it could not be written
     """
 
-    dynamo_db = get_dynamodb_client()
+    if store is None:
+        store = get_metadata_store({})
+
+    values = {"last_seen": {"N": str(timestamp)}}
+    if source_digest is not None:
+        values["source_digest"] = {"S": source_digest}
+    if descriptor_type is not None:
+        values["descriptor_type"] = {"S": descriptor_type}
 
     try:
+        with metrics.current().timer('WriteLatency'):
+            touched = store.touch_record(entity_id, values)
+        if touched:
+            return True
+        print("No record to touch for entity_id:", entity_id)
+    except StoreError as e:
+        print(e.message)
+    return None
+
+
+def load_source_digests(provider, store=None, expiries=None):
+    """
+    Reads the source digests of a provider's stored entities
+
+    :param provider: Name of provider of XML metadata
+    :param store: MetadataStore to use, the DynamoDb table when None
+    :param expiries: receives entityID -> expiry time stamp of the records signed with our own
+        validity window
+    :return: entityID -> source digest, None for records stored without one
+    :rtype: dict
+    """
+
+    if store is None:
+        store = get_metadata_store({})
+    digests = {}
+
+    for item in store.provider_records(provider, ['source_digest', 'valid_until']):
+        digests[item['entityID']['S']] = item['source_digest']['S'] if 'source_digest' in item else None
+        if expiries is not None and 'valid_until' in item:
+            expiries[item['entityID']['S']] = float(item['valid_until']['N'])
+
+    return digests
+
+
+def create_metadata_item(entity_id, provider, document, timestamp, source_digest, valid_until=None,
+                         descriptor_type=None):
+    """
+    Builds the DynamoDb record of an entity with a freshly signed document, without the document
+
+    The record replaces one that may still hold the document inline as 'metadata', which is all a
+    query handler from before document items reads. Deploy queryMetadata before this importer (see
+    the README).
+
+    :return: item in DynamoDb attribute value format
+    :rtype: dict
+    """
+
+    item = {
+        "entityID": {"S": entity_id},
+        "provider": {"S": provider},
+        "etag": {"S": hashlib.md5(document).hexdigest()},
+        "last_changed": {"N": str(timestamp)},
+        "last_seen": {"N": str(timestamp)},
+        "source_digest": {"S": source_digest}
+    }
+    if valid_until is not None:
+        item["valid_until"] = {"N": str(valid_until)}
+    if descriptor_type is not None:
+        item["descriptor_type"] = {"S": descriptor_type}
+    return item
+
+
+def create_document_item(entity_id, document, document_bucket=None):
+    """
+    Builds the DynamoDb item holding the signed document of an entity
+
+    The document is gzip-compressed; the etag is the one of the uncompressed document. A compressed
+    document larger than DOCUMENT_OFFLOAD_SIZE is uploaded to the document bucket first, and the item
+    holds its 's3_bucket' and 's3_key' instead.
+
+    :param entity_id: Entity Id of the document
+    :param document: signed XML document
+    :param document_bucket: S3 bucket for a document too large for its item; without one the
+        document stays in the item, however large
+    :return: item in DynamoDb attribute value format
+    :rtype: dict
+    """
+
+    compressed = gzip.compress(document, mtime=0)
+    item = {
+        "entityID": {"S": DOCUMENT_KEY_PREFIX + entity_id},
+        "codec": {"S": DOCUMENT_CODEC},
+        "etag": {"S": hashlib.md5(document).hexdigest()}
+    }
+    if document_bucket is not None and len(compressed) > DOCUMENT_OFFLOAD_SIZE:
+        item["s3_bucket"] = {"S": document_bucket}
+        item["s3_key"] = {"S": offload_document(compressed, document_bucket)}
+    else:
+        item["metadata"] = {"B": compressed}
+    return item
+
+
+def offload_document(compressed, bucket):
+    """
+    Uploads a compressed document under a key derived from its content
+
+    Identical documents share one object, and an object is never replaced by other content, so a
+    reader following an older item's pointer still finds the document it expects. Objects nothing
+    points to any more are left to the bucket's lifecycle rules.
+
+    :param compressed: gzip-compressed signed document
+    :param bucket: S3 bucket to upload to
+    :return: key of the object
+    :rtype: string
+    """
+
+    key = DOCUMENT_OBJECT_PREFIX + hashlib.sha256(compressed).hexdigest() + '.xml.gz'
+    get_s3_client().put_object(Bucket=bucket, Key=key, Body=compressed, ContentEncoding=DOCUMENT_CODEC,
+                               ContentType='application/samlmetadata+xml')
+    print("Offloaded a document of %d compressed bytes to s3://%s/%s" % (len(compressed), bucket, key))
+    return key
+
+
+def create_alias_item(entity_id):
+    """
+    Builds the DynamoDb item that resolves the {sha1} identifier of an entity
+
+    :return: item in DynamoDb attribute value format
+    :rtype: dict
+    """
+
+    return {
+        "entityID": {"S": SHA1_PREFIX + hashlib.sha1(entity_id.encode('utf-8')).hexdigest()},
+        "entity": {"S": entity_id}
+    }
+
+
+def create_publisher(event, expires=None):
+    """
+    :param event: data representing the captured activity
+    :param expires: time stamp the published documents expire at
+    :return: DocumentPublisher for the event's publishBucket, None without one
+    :rtype: DocumentPublisher
+    """
+
+    if 'publishBucket' not in event:
+        return None
+    return DocumentPublisher(get_s3_client(), event['publishBucket'], expires)
+
+
+def get_entity_object_keys(entity_id):
+    """
+    :return: the keys a document is published at, for its entityID and for its {sha1} identifier
+    :rtype: list
+    """
+
+    return [ENTITY_OBJECT_PREFIX + parse.quote(entity_id, safe=''),
+            ENTITY_OBJECT_PREFIX + create_alias_item(entity_id)['entityID']['S']]
+
+
+def parse_xml_duration(value):
+    """
+    Converts an xsd:duration, like a cacheDuration attribute, to seconds; years and months are taken
+    as 365 and 30 days
+
+    :return: seconds, None when the value is not understood
+    :rtype: float
+    """
+
+    match = XML_DURATION.match(value)
+    if match is None:
+        return None
+    years, months, days, hours, minutes, seconds = (float(part or 0) for part in match.groups())
+    return (((years * 365 + months * 30 + days) * 24 + hours) * 60 + minutes) * 60 + seconds
+
+
+class DocumentPublisher(object):
+    """
+    Publishes signed documents to S3 for a CDN to serve them without invoking the query Lambda
+
+    Objects carry the document's Content-Type, its etag (S3 makes the ETag the MD5 of the body too,
+    unless the bucket encrypts with KMS) and a Cache-Control that ends with the cacheDuration or the
+    signature, whichever comes first. An object whose stored etag matches the document is not
+    uploaded again. Methods run on the MetadataWriter's threads.
+    """
+
+    def __init__(self, s3, bucket, expires=None, cache_duration=CACHE_DURATION):
+        """
+        :param s3: S3 client shared by all uploads
+        :param bucket: S3 bucket to publish to
+        :param expires: time stamp the documents published by this run expire at
+        :param cache_duration: xsd:duration documents may be cached for
+        """
+        self.s3 = s3
+        self.bucket = bucket
+        self.expires = expires
+        self.max_age = parse_xml_duration(cache_duration)
+        self.lock = threading.Lock()
+        self.counts = {'published': 0, 'skipped': 0}
+
+    def cache_control(self):
+        max_age = self.max_age
+        if self.expires is not None:
+            max_age = min(max_age, self.expires - current_timestamp())
+        return 'public, max-age=%d' % max(max_age, 0)
+
+    def publish(self, entity_id, document):
+        """
+        :return: True once the document is published, None when an upload failed
+        """
         etag = hashlib.md5(document).hexdigest()
-        response = dynamo_db.update_item(
-            TableName='metadata',
-            Key={"entityID": {"S": entity_id}},
-            UpdateExpression='SET metadata=:metadata, provider=:provider, etag=:etag, last_changed=:changed, last_seen=:changed',
-            ExpressionAttributeValues={
-                ":metadata": {"S": document.decode()},
-                ":provider": {"S": provider},
-                ":etag": {"S": etag},
-                ":changed": {"N": str(timestamp)}
-            }, ConditionExpression="etag <> :etag"
-        )
-    except botocore.exceptions.ClientError as e:
-        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
-            # Setting the last seen flag, so we don't delete it even though it hasn't changed.
-            response = dynamo_db.update_item(
-                TableName='metadata',
-                Key={"entityID": {"S": entity_id}},
-                UpdateExpression='SET last_seen=:changed',
-                ExpressionAttributeValues={
-                    ":changed": {"N": str(timestamp)}
-                },
-                ConditionExpression="etag <> :etag"
-            )
-
-        print(e.response['Error']['Message'])
-
-    return response
+        for key in get_entity_object_keys(entity_id):
+            try:
+                try:
+                    if self.s3.head_object(Bucket=self.bucket, Key=key)['Metadata'].get('etag') == etag:
+                        self._count('skipped')
+                        continue
+                except exceptions.ClientError as e:
+                    if e.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NotFound'):
+                        raise
+                self.s3.put_object(Bucket=self.bucket, Key=key, Body=document, Metadata={'etag': etag},
+                                   ContentType='application/samlmetadata+xml', CacheControl=self.cache_control())
+                self._count('published')
+            except exceptions.ClientError as e:
+                print("Could not publish %s: %s" % (key, e.response['Error']['Message']))
+                return None
+        return True
+
+    def unpublish(self, entity_id):
+        """
+        :return: True once the documents of the entity are deleted, None when a deletion failed
+        """
+        try:
+            self.s3.delete_objects(Bucket=self.bucket, Delete={
+                'Objects': [{'Key': key} for key in get_entity_object_keys(entity_id)], 'Quiet': True})
+        except exceptions.ClientError as e:
+            print("Could not unpublish %s: %s" % (entity_id, e.response['Error']['Message']))
+            return None
+        return True
+
+    def _count(self, kind):
+        with self.lock:
+            self.counts[kind] += 1
+
+
+def get_request_key(request):
+    if 'PutRequest' in request:
+        return request['PutRequest']['Item']['entityID']['S']
+    return request['DeleteRequest']['Key']['entityID']['S']
+
+
+def count_entity_records(requests, kind='PutRequest'):
+    # Only the keys of entity records, not those of documents and aliases, are plain entity IDs
+    return sum(1 for request in requests if kind in request and
+               not get_request_key(request).startswith((DOCUMENT_KEY_PREFIX, SHA1_PREFIX)))
+
+
+class MetadataWriter(object):
+    """
+    Writes the results of an import to DynamoDb with one client and as few round trips as possible
+
+    Puts and deletes, three items per entity, are grouped into BatchWriteItem calls of up to
+    BATCH_WRITE_SIZE, and unprocessed items are sent again with exponential backoff. Writes that need
+    a condition, and last_seen refreshes, cannot be batched; they run concurrently on a small thread
+    pool instead.
+    """
+
+    def __init__(self, store, timestamp, concurrency=WRITE_CONCURRENCY, document_bucket=None, publisher=None,
+                 store_documents=True, descriptor_type=None):
+        """
+        :param store: MetadataStore shared by all writes
+        :param timestamp: Time stamp of the import
+        :param concurrency: number of concurrent conditional writes
+        :param document_bucket: S3 bucket for documents too large for their item
+        :param publisher: DocumentPublisher that also publishes the documents, and unpublishes
+            deleted entities
+        :param store_documents: false to only write the entity records
+        :param descriptor_type: descriptor type of the import, recorded on every record written or
+            touched so that its sweep leaves the other descriptor type's entities alone
+        """
+        self.store = store
+        self.timestamp = timestamp
+        self.concurrency = concurrency
+        self.document_bucket = document_bucket
+        self.publisher = publisher
+        self.store_documents = store_documents
+        self.descriptor_type = descriptor_type
+        # The pool threads do not inherit the recorder of the invocation, the writes are bound to it
+        self.recorder = metrics.current()
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.pending = deque()
+        self.batch = []
+        self.counts = {'put': 0, 'updated': 0, 'touched': 0, 'deleted': 0, 'failed': 0}
+        self.started = time.time()
+
+    def put(self, entity_id, provider, document, source_digest, valid_until=None):
+        """
+        Queues an unconditional write of a changed or new entity
+        """
+        self._publish(entity_id, document)
+        self._reserve(entity_id)
+
+        item = create_metadata_item(entity_id, provider, document, self.timestamp, source_digest, valid_until,
+                                    self.descriptor_type)
+        if self.store_documents:
+            self.batch.append({'PutRequest': {'Item': create_document_item(entity_id, document,
+                                                                           self.document_bucket)}})
+            self.batch.append({'PutRequest': {'Item': create_alias_item(entity_id)}})
+        self.batch.append({'PutRequest': {'Item': item}})
+
+    def update(self, entity_id, provider, document, source_digest, valid_until=None):
+        """
+        Queues a write that only replaces the stored document if its etag differs
+        """
+        self._publish(entity_id, document)
+        self._submit('updated', update_dynamodb, entity_id, provider, document, self.timestamp,
+                     source_digest, self.store, valid_until, self.document_bucket, self.store_documents,
+                     self.descriptor_type)
+
+    def touch(self, entity_id):
+        """
+        Queues a last_seen refresh of an unchanged entity
+        """
+        self._submit('touched', touch_last_seen, entity_id, self.timestamp, None, self.store, self.descriptor_type)
+
+    def delete(self, entity_id):
+        """
+        Queues the deletion of an entity's record, document and alias
+        """
+        if self.publisher is not None:
+            self._submit('unpublished', self.publisher.unpublish, entity_id)
+        self._reserve(entity_id)
+
+        for key in (DOCUMENT_KEY_PREFIX + entity_id, create_alias_item(entity_id)['entityID']['S'], entity_id):
+            self.batch.append({'DeleteRequest': {'Key': {'entityID': {'S': key}}}})
+
+    def flush(self):
+        """
+        Sends the queued puts and deletes, resending unprocessed items with backoff
+        """
+        requests = self.batch
+        self.batch = []
+
+        recorder = self.recorder
+        attempt = 0
+        while requests:
+            try:
+                with recorder.timer('BatchWriteLatency'):
+                    unprocessed = self.store.batch_write(requests)
+            except StoreError as e:
+                print(e.message)
+                self.counts['failed'] += count_entity_records(requests) + \
+                    count_entity_records(requests, 'DeleteRequest')
+                return
+
+            for kind, request_kind in (('put', 'PutRequest'), ('deleted', 'DeleteRequest')):
+                self.counts[kind] += count_entity_records(requests, request_kind) - \
+                    count_entity_records(unprocessed, request_kind)
+            requests = unprocessed
+
+            if requests:
+                attempt += 1
+                if attempt == BATCH_WRITE_ATTEMPTS:
+                    print("Giving up on %d unprocessed items" % len(requests))
+                    self.counts['failed'] += count_entity_records(requests) + \
+                        count_entity_records(requests, 'DeleteRequest')
+                    return
+                time.sleep(BATCH_WRITE_BACKOFF * 2 ** (attempt - 1))
+
+    def close(self):
+        """
+        Sends everything still queued, waits for the conditional writes and reports throughput
+
+        :return: number of entities 'put', 'updated', 'touched', 'deleted' and 'failed', and with a
+            publisher the number of entities 'unpublished' and of objects 'published' and 'skipped'
+        :rtype: dict
+        """
+        self.flush()
+        while self.pending:
+            self._collect()
+        self.executor.shutdown()
+        if self.publisher is not None:
+            self.counts.update(self.publisher.counts)
+            print("Published %(published)d objects, skipped %(skipped)d unchanged ones" % self.publisher.counts)
+
+        elapsed = time.time() - self.started
+        written = self.counts['put'] + self.counts['updated'] + self.counts['touched'] + self.counts['deleted']
+        print("Wrote %d items (%d put, %d updated, %d touched, %d deleted, %d failed) in %.2fs, %.1f items/s" % (
+            written, self.counts['put'], self.counts['updated'], self.counts['touched'], self.counts['deleted'],
+            self.counts['failed'], elapsed, written / elapsed if elapsed else 0.0))
+        return self.counts
+
+    def _publish(self, entity_id, document):
+        if self.publisher is not None:
+            # Publications count as failed writes when they fail, and as nothing otherwise
+            self._submit(None, self.publisher.publish, entity_id, document)
+
+    def _reserve(self, entity_id):
+        if len(self.batch) + 3 > BATCH_WRITE_SIZE or \
+                any(get_request_key(request) == entity_id for request in self.batch):
+            # The items of an entity go into the same batch, which must not hold a key twice
+            self.flush()
+
+    def _submit(self, kind, function, *args):
+        if len(self.pending) >= 4 * self.concurrency:
+            self._collect()
+        self.pending.append((kind, self.executor.submit(metrics.bind(function, self.recorder), *args)))
+
+    def _collect(self):
+        kind, future = self.pending.popleft()
+        if future.result() is None:
+            self.counts['failed'] += 1
+        elif kind is not None:
+            self.counts[kind] = self.counts.get(kind, 0) + 1
 
 
 def read_file_from_s3(filename, bucket):
@@ -262,7 +2251,7 @@ def read_file_from_s3(filename, bucket):
     s3 = get_s3_client()
     try:
         response = s3.get_object(Bucket=bucket, Key=filename)
-    except botocore.exceptions.ClientError as e:
+    except exceptions.ClientError as e:
         error_code = e.response['Error']['Code']
         if error_code == 'NoSuchBucket':
             print("%s bucket is missing from S3" % bucket)
@@ -275,9 +2264,98 @@ def read_file_from_s3(filename, bucket):
     return response['Body'].read()
 
 
+def read_cached_file_from_s3(filename, bucket, ttl=S3_CACHE_TTL):
+    """
+    Reads a document from S3, reusing the copy read by an earlier (warm) invocation
+
+    Within the TTL the cached copy is returned without calling S3. After that S3 is asked for the
+    object only if its ETag changed.
+
+    :param filename: name of file to read
+    :param bucket: S3 bucket to pull from
+    :param ttl: seconds the cached copy is used without revalidation
+    :return: data from file
+    """
+    cached = S3_FILE_CACHE.get((bucket, filename))
+    now = time.time()
+    if cached is not None and now - cached[2] < ttl:
+        return cached[1]
+
+    s3 = get_s3_client()
+    try:
+        if cached is None:
+            response = s3.get_object(Bucket=bucket, Key=filename)
+        else:
+            response = s3.get_object(Bucket=bucket, Key=filename, IfNoneMatch=cached[0])
+    except exceptions.ClientError as e:
+        if cached is not None and e.response['Error']['Code'] in ('304', 'NotModified'):
+            S3_FILE_CACHE[(bucket, filename)] = (cached[0], cached[1], now)
+            return cached[1]
+        # Let the uncached read report the error
+        return read_file_from_s3(filename, bucket)
+
+    body = response['Body'].read()
+    S3_FILE_CACHE[(bucket, filename)] = (response['ETag'], body, now)
+    return body
+
+
+def load_signing_key(pem):
+    """
+    Parses a PEM private key once per container
+
+    :param pem: the private key
+    :return: private key object, accepted by XMLSigner in place of the PEM
+    """
+    return _parse_cached('key', pem, lambda data: serialization.load_pem_private_key(
+        data, password=None, backend=backends.default_backend()))
+
+
+def load_x509_certificate(pem):
+    """
+    Parses a PEM certificate once per container
+
+    :param pem: the certificate
+    :return: certificate object, accepted by XMLVerifier in place of the PEM
+    """
+    return _parse_cached('certificate', pem, lambda data: crypto.load_certificate(crypto.FILETYPE_PEM, data))
+
+
+def load_cert_chain(pem):
+    """
+    Splits a PEM certificate chain once per container
+
+    :param pem: one or more certificates
+    :return: base64 bodies of the certificates, as XMLSigner would extract them on every call
+    :rtype: list
+    """
+    return _parse_cached('chain', pem, lambda data: [cert.replace('\r', '') for cert in CERT_PEM.findall(data.decode('ascii'))])
+
+
+def _parse_cached(kind, pem, parse_pem):
+    if not isinstance(pem, bytes):
+        pem = pem.encode('ascii')
+    cache_key = (kind, hashlib.sha256(pem).hexdigest())
+    if cache_key not in PARSED_KEY_CACHE:
+        PARSED_KEY_CACHE[cache_key] = parse_pem(pem)
+    return PARSED_KEY_CACHE[cache_key]
+
+
 def get_s3_client():
-    return boto3.client('s3')
+    return get_client('s3')
+
+
+def get_metadata_store(event):
+    """
+    :return: the MetadataStore named by the event's metadataStore, holding its tableName
+    :rtype: MetadataStore
+    """
+    return open_store(event.get('metadataStore', 'dynamodb'), event.get('tableName', DEFAULT_TABLE),
+                      get_dynamodb_client)
 
 
 def get_dynamodb_client():
-    return boto3.client('dynamodb')
+    return get_client('dynamodb')
+
+
+def get_lambda_client():
+    return get_client('lambda', config=config.Config(read_timeout=LAMBDA_INVOKE_TIMEOUT, retries={'max_attempts': 0}))
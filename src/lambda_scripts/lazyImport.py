@@ -0,0 +1,46 @@
+"""
+Modules imported on first use, so that a handler only pays for the dependencies its path needs
+
+A Lambda container imports its handler's module before the first invocation. Paths that never touch
+a heavy dependency, such as queryMetadata with a local store or an import of an unchanged aggregate,
+then start without loading it.
+"""
+
+from __future__ import print_function
+
+import importlib
+import threading
+
+
+class LazyModule(object):
+    """
+    Stands in for a module and imports it when one of its attributes is first read
+
+    The import is done under a lock: threads of a handler may reach a module at the same time.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, attribute):
+        module = self._module
+        if module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+                module = self._module
+        return getattr(module, attribute)
+
+    def __repr__(self):
+        return '<lazy module %r%s>' % (self._name, '' if self._module is None else ', loaded')
+
+
+def lazy_import(name):
+    """
+    :param name: absolute name of the module, such as 'lxml.etree'
+    :return: a stand-in importing the module when it is first used
+    :rtype: LazyModule
+    """
+    return LazyModule(name)
@@ -0,0 +1,541 @@
+"""
+Storage backends of the metadata table: DynamoDb, SQLite and in memory
+
+Items are exchanged in DynamoDb attribute value format, keyed by their 'entityID'. Entity records are
+the items with a 'provider'; only they take part in the provider/last_seen lookups, like in the
+sparse provider index of the DynamoDb table.
+"""
+
+from __future__ import print_function
+
+import abc
+import base64
+import itertools
+import json
+import sqlite3
+import threading
+import time
+
+from .lazyImport import lazy_import
+
+# Only the DynamoDb backend and the AWS clients need boto3 and botocore
+boto3 = lazy_import('boto3')
+exceptions = lazy_import('botocore.exceptions')
+
+DEFAULT_TABLE = 'metadata'
+# Global secondary index of the DynamoDb table with the 'provider' as hash key and 'last_seen' as
+# range key. It projects the attributes import runs compare (an INCLUDE projection of
+# PROVIDER_INDEX_ATTRIBUTES), so that they query a provider's records instead of scanning the table.
+PROVIDER_INDEX = 'provider-last_seen-index'
+PROVIDER_INDEX_ATTRIBUTES = ['source_digest', 'valid_until', 'descriptor_type']
+# Signed documents are stored apart from the small record of their entity, under this prefix and
+# the entityID, so that conditional queries only read the record. Entity IDs are absolute URIs and
+# never start with '#'.
+DOCUMENT_KEY_PREFIX = '#document#'
+# MDQ clients may ask for an entity by '{sha1}' and the hex SHA-1 of its entityID. An alias item under
+# that very key names the entity.
+SHA1_PREFIX = '{sha1}'
+# Documents are stored compressed, as binary, with the codec named on their item
+DOCUMENT_CODEC = 'gzip'
+# Bloom filters over all stored identifiers are uploaded under their SHA-256, and the manifest names
+# the current one
+ENTITY_FILTER_PREFIX = 'filters/'
+ENTITY_FILTER_MANIFEST = ENTITY_FILTER_PREFIX + 'entities.json'
+# BatchGetItem accepts at most 100 keys
+BATCH_GET_SIZE = 100
+BATCH_GET_ATTEMPTS = 8
+BATCH_GET_BACKOFF = 0.05
+
+# Survive warm invocations of the container: table -> MemoryStore, (path, table) -> SQLiteStore
+MEMORY_STORES = {}
+SQLITE_STORES = {}
+STORES_LOCK = threading.Lock()
+# Survive warm invocations of the container too: service -> boto3 client, see get_client
+CLIENTS = {}
+CLIENTS_LOCK = threading.Lock()
+
+
+class StoreError(Exception):
+    """
+    A store operation failed; 'code' and 'message' are the ones of the backend
+    """
+
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+        self.message = message
+
+
+def open_store(spec, table=DEFAULT_TABLE, dynamodb_client=None):
+    """
+    Opens the store a deployment is configured with
+
+    :param spec: 'dynamodb', 'memory' or 'sqlite:' followed by the path of the database file
+    :param table: name of the DynamoDb or SQLite table
+    :param dynamodb_client: function returning a DynamoDb client, for 'dynamodb'
+    :return: the store; memory and SQLite stores are shared by everything opening the same table
+    :rtype: MetadataStore
+    """
+
+    if spec == 'dynamodb':
+        return DynamoDbStore(dynamodb_client(), table)
+
+    with STORES_LOCK:
+        if spec == 'memory':
+            if table not in MEMORY_STORES:
+                MEMORY_STORES[table] = MemoryStore()
+            return MEMORY_STORES[table]
+        if spec.startswith('sqlite:'):
+            key = (spec[len('sqlite:'):], table)
+            if key not in SQLITE_STORES:
+                SQLITE_STORES[key] = SQLiteStore(key[0], table)
+            return SQLITE_STORES[key]
+
+    raise ValueError('Unknown metadata store: %s' % spec)
+
+
+def get_client(service, **options):
+    """
+    Creates the client of a service once per container, for all invocations and threads
+
+    Creating a client costs more than most requests, and boto3 does not create clients safely from
+    several threads at once, so clients are created under a lock.
+
+    :param service: name of the AWS service, such as 's3'
+    :param options: passed to boto3.client by the call that creates the client
+    :return: the boto3 client of the service
+    """
+    client = CLIENTS.get(service)
+    if client is None:
+        with CLIENTS_LOCK:
+            if service not in CLIENTS:
+                CLIENTS[service] = boto3.client(service, **options)
+            client = CLIENTS[service]
+    return client
+
+
+def project(item, attributes):
+    if attributes is None:
+        return dict(item)
+    return dict((name, value) for name, value in item.items() if name == 'entityID' or name in attributes)
+
+
+class MetadataStore(abc.ABC):
+    """
+    Operations the handlers need from the metadata table; a backend implements all of them
+    """
+
+    @abc.abstractmethod
+    def get_item(self, key, attributes=None, consistent=False):
+        """
+        :param key: entityID of the item
+        :param attributes: attributes to read, all when None; the entityID is always read
+        :param consistent: read the latest write, where the backend may lag behind
+        :return: the item, None when there is none
+        :rtype: dict
+        """
+
+    @abc.abstractmethod
+    def batch_get_items(self, keys, attributes=None, consistent=False):
+        """
+        :return: entityID -> item, without the keys that have no item
+        :rtype: dict
+        """
+
+    @abc.abstractmethod
+    def put_item(self, item):
+        pass
+
+    @abc.abstractmethod
+    def batch_write(self, requests):
+        """
+        Applies up to 25 PutRequests and DeleteRequests, as in a BatchWriteItem call
+
+        :return: the requests that were not processed and should be sent again
+        :rtype: list
+        """
+
+    @abc.abstractmethod
+    def update_record(self, entity_id, values, remove=(), unless_etag=None):
+        """
+        Sets attributes of an entity record, creating it when missing
+
+        :param values: attribute name -> value
+        :param remove: attributes to remove
+        :param unless_etag: leave the record alone when it has this etag
+        :return: False when the record had the etag, True otherwise
+        :rtype: bool
+        """
+
+    @abc.abstractmethod
+    def touch_record(self, entity_id, values):
+        """
+        Sets attributes of an existing entity record
+
+        :return: False when there is no such record
+        :rtype: bool
+        """
+
+    @abc.abstractmethod
+    def provider_records(self, provider, attributes):
+        """
+        :param attributes: attributes to read, among PROVIDER_INDEX_ATTRIBUTES
+        :return: the entity records of a provider, with the given attributes
+        :rtype: iterator
+        """
+
+    @abc.abstractmethod
+    def entity_ids(self):
+        """
+        :return: the entityIDs of all entity records
+        :rtype: iterator
+        """
+
+    @abc.abstractmethod
+    def stale_entity_ids(self, provider, descriptor_type, before):
+        """
+        :param descriptor_type: only records imported from this descriptor type; records stored
+            without one are never stale
+        :return: the entityIDs of a provider's records last seen before a time stamp; the
+            lookup may lag behind, callers confirm with a consistent read
+        :rtype: iterator
+        """
+
+
+class DynamoDbStore(MetadataStore):
+    """
+    The metadata table in DynamoDb
+    """
+
+    def __init__(self, client, table=DEFAULT_TABLE):
+        """
+        :param client: DynamoDb client shared by all operations
+        :param table: name of the table
+        """
+        self.client = client
+        self.table = table
+
+    def get_item(self, key, attributes=None, consistent=False):
+        request = {'TableName': self.table, 'Key': {'entityID': {'S': key}}}
+        if attributes is not None:
+            request['AttributesToGet'] = ['entityID'] + [name for name in attributes if name != 'entityID']
+        if consistent:
+            request['ConsistentRead'] = True
+        try:
+            return self.client.get_item(**request).get('Item')
+        except exceptions.ClientError as e:
+            raise StoreError(e.response['Error']['Code'], e.response['Error']['Message'])
+
+    def batch_get_items(self, keys, attributes=None, consistent=False):
+        """
+        Reads the items in BatchGetItem calls of BATCH_GET_SIZE keys; unprocessed keys are asked
+        for again with exponential backoff
+        """
+        items = {}
+        for start in range(0, len(keys), BATCH_GET_SIZE):
+            request = {'Keys': [{'entityID': {'S': key}} for key in keys[start:start + BATCH_GET_SIZE]]}
+            if attributes is not None:
+                request['AttributesToGet'] = ['entityID'] + [name for name in attributes if name != 'entityID']
+            if consistent:
+                request['ConsistentRead'] = True
+            request = {self.table: request}
+            attempt = 0
+            while request:
+                try:
+                    response = self.client.batch_get_item(RequestItems=request)
+                except exceptions.ClientError as e:
+                    print(e.response['Error']['Code'])
+                    break
+
+                for item in response['Responses'].get(self.table, []):
+                    items[item['entityID']['S']] = item
+                request = response.get('UnprocessedKeys')
+
+                if request:
+                    attempt += 1
+                    if attempt == BATCH_GET_ATTEMPTS:
+                        print("Giving up on %d unprocessed keys" % len(request[self.table]['Keys']))
+                        break
+                    time.sleep(BATCH_GET_BACKOFF * 2 ** (attempt - 1))
+        return items
+
+    def put_item(self, item):
+        try:
+            self.client.put_item(TableName=self.table, Item=item)
+        except exceptions.ClientError as e:
+            raise StoreError(e.response['Error']['Code'], e.response['Error']['Message'])
+
+    def batch_write(self, requests):
+        try:
+            response = self.client.batch_write_item(RequestItems={self.table: requests})
+        except exceptions.ClientError as e:
+            raise StoreError(e.response['Error']['Code'], e.response['Error']['Message'])
+        return response.get('UnprocessedItems', {}).get(self.table, [])
+
+    def update_record(self, entity_id, values, remove=(), unless_etag=None):
+        request = self._update_request(entity_id, values, remove)
+        if unless_etag is not None:
+            request['ConditionExpression'] = '#etag <> :unless_etag'
+            request['ExpressionAttributeNames']['#etag'] = 'etag'
+            request['ExpressionAttributeValues'][':unless_etag'] = {'S': unless_etag}
+        return self._update(request)
+
+    def touch_record(self, entity_id, values):
+        request = self._update_request(entity_id, values)
+        request['ConditionExpression'] = 'attribute_exists(entityID)'
+        return self._update(request)
+
+    def provider_records(self, provider, attributes):
+        names = dict(('#a%d' % number, name) for number, name in enumerate(['entityID'] + list(attributes)))
+        names['#provider'] = 'provider'
+        request = {'TableName': self.table,
+                   'ProjectionExpression': ', '.join(name for name in names if name != '#provider'),
+                   'ExpressionAttributeNames': names, 'ExpressionAttributeValues': {':provider': {'S': provider}}}
+
+        records = self._items('query', IndexName=PROVIDER_INDEX, KeyConditionExpression='#provider = :provider',
+                              **request)
+        try:
+            first = next(records, None)
+        except StoreError as e:
+            # Tables without the index, or with one projecting fewer attributes, are still read. A
+            # missing table fails the scan as well.
+            if e.code not in ('ValidationException', 'ResourceNotFoundException'):
+                raise
+            print("WARNING: cannot query %s of %s (%s), scanning the table instead" % (PROVIDER_INDEX, self.table,
+                                                                                    e.message))
+            return self._items('scan', FilterExpression='#provider = :provider', **request)
+        return iter(()) if first is None else itertools.chain([first], records)
+
+    def entity_ids(self):
+        for item in self._items('scan', TableName=self.table, IndexName=PROVIDER_INDEX,
+                                ProjectionExpression='entityID'):
+            yield item['entityID']['S']
+
+    def stale_entity_ids(self, provider, descriptor_type, before):
+        for item in self._items('query', TableName=self.table, IndexName=PROVIDER_INDEX,
+                                KeyConditionExpression='#provider = :provider AND last_seen < :before',
+                                FilterExpression='descriptor_type = :type',
+                                ProjectionExpression='entityID',
+                                ExpressionAttributeNames={'#provider': 'provider'},
+                                ExpressionAttributeValues={':provider': {'S': provider},
+                                                           ':type': {'S': descriptor_type},
+                                                           ':before': {'N': str(before)}}):
+            yield item['entityID']['S']
+
+    def _update_request(self, entity_id, values, remove=()):
+        names = {}
+        expression_values = {}
+        assignments = []
+        for number, (name, value) in enumerate(values.items()):
+            names['#s%d' % number] = name
+            expression_values[':s%d' % number] = value
+            assignments.append('#s%d=:s%d' % (number, number))
+        expression = 'SET ' + ', '.join(assignments)
+        if remove:
+            for number, name in enumerate(remove):
+                names['#r%d' % number] = name
+            expression += ' REMOVE ' + ', '.join('#r%d' % number for number in range(len(remove)))
+        return {'TableName': self.table, 'Key': {'entityID': {'S': entity_id}}, 'UpdateExpression': expression,
+                'ExpressionAttributeNames': names, 'ExpressionAttributeValues': expression_values}
+
+    def _update(self, request):
+        try:
+            self.client.update_item(**request)
+        except exceptions.ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            raise StoreError(e.response['Error']['Code'], e.response['Error']['Message'])
+        return True
+
+    def _items(self, operation, **request):
+        try:
+            for page in self.client.get_paginator(operation).paginate(**request):
+                for item in page['Items']:
+                    yield item
+        except exceptions.ClientError as e:
+            raise StoreError(e.response['Error']['Code'], e.response['Error']['Message'])
+
+
+class MemoryStore(MetadataStore):
+    """
+    The metadata table in a dictionary of this process, for tests and benchmarks
+    """
+
+    def __init__(self):
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def get_item(self, key, attributes=None, consistent=False):
+        item = self.items.get(key)
+        return None if item is None else project(item, attributes)
+
+    def batch_get_items(self, keys, attributes=None, consistent=False):
+        items = self.items
+        return dict((key, project(items[key], attributes)) for key in keys if key in items)
+
+    def put_item(self, item):
+        self.items[item['entityID']['S']] = dict(item)
+
+    def batch_write(self, requests):
+        with self.lock:
+            for request in requests:
+                if 'PutRequest' in request:
+                    self.put_item(request['PutRequest']['Item'])
+                else:
+                    self.items.pop(request['DeleteRequest']['Key']['entityID']['S'], None)
+        return []
+
+    def update_record(self, entity_id, values, remove=(), unless_etag=None):
+        with self.lock:
+            item = self.items.get(entity_id)
+            if unless_etag is not None and item is not None and item.get('etag') == {'S': unless_etag}:
+                return False
+            item = dict(item or {'entityID': {'S': entity_id}}, **values)
+            for name in remove:
+                item.pop(name, None)
+            self.items[entity_id] = item
+        return True
+
+    def touch_record(self, entity_id, values):
+        with self.lock:
+            if entity_id not in self.items:
+                return False
+            self.items[entity_id] = dict(self.items[entity_id], **values)
+        return True
+
+    def provider_records(self, provider, attributes):
+        return [project(item, attributes) for item in list(self.items.values())
+                if item.get('provider') == {'S': provider}]
+
+    def entity_ids(self):
+        return [key for key, item in list(self.items.items()) if 'provider' in item]
+
+    def stale_entity_ids(self, provider, descriptor_type, before):
+        return [key for key, item in list(self.items.items())
+                if item.get('provider') == {'S': provider} and item.get('descriptor_type') == {'S': descriptor_type}
+                and float(item['last_seen']['N']) < before]
+
+
+class SQLiteStore(MetadataStore):
+    """
+    The metadata table in a SQLite database, in WAL mode so that readers do not wait for an import
+
+    Each item is kept as JSON next to the columns it is looked up by; a partial index over the
+    provider and last_seen of entity records stands in for the DynamoDb provider index.
+    """
+
+    def __init__(self, path, table=DEFAULT_TABLE):
+        """
+        :param path: database file, ':memory:' for a private database
+        :param table: name of the table, created when missing
+        """
+        self.table = '"%s"' % table.replace('"', '""')
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS %s (entityID TEXT PRIMARY KEY, provider TEXT, '
+                                'last_seen REAL, item TEXT NOT NULL)' % self.table)
+        self.connection.execute('CREATE INDEX IF NOT EXISTS "%s" ON %s (provider, last_seen) '
+                                'WHERE provider IS NOT NULL' % (table.replace('"', '""') + '_provider_last_seen',
+                                                                self.table))
+
+    def get_item(self, key, attributes=None, consistent=False):
+        with self.lock:
+            row = self.connection.execute('SELECT item FROM %s WHERE entityID = ?' % self.table, (key,)).fetchone()
+        return None if row is None else project(self._decode(row[0]), attributes)
+
+    def batch_get_items(self, keys, attributes=None, consistent=False):
+        items = {}
+        for start in range(0, len(keys), BATCH_GET_SIZE):
+            chunk = keys[start:start + BATCH_GET_SIZE]
+            with self.lock:
+                rows = self.connection.execute('SELECT entityID, item FROM %s WHERE entityID IN (%s)' % (
+                    self.table, ', '.join('?' * len(chunk))), chunk).fetchall()
+            for key, item in rows:
+                items[key] = project(self._decode(item), attributes)
+        return items
+
+    def put_item(self, item):
+        with self.lock:
+            self._put(item)
+
+    def batch_write(self, requests):
+        with self.lock:
+            self.connection.execute('BEGIN')
+            try:
+                for request in requests:
+                    if 'PutRequest' in request:
+                        self._put(request['PutRequest']['Item'])
+                    else:
+                        self.connection.execute('DELETE FROM %s WHERE entityID = ?' % self.table,
+                                                (request['DeleteRequest']['Key']['entityID']['S'],))
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+        return []
+
+    def update_record(self, entity_id, values, remove=(), unless_etag=None):
+        with self.lock:
+            row = self.connection.execute('SELECT item FROM %s WHERE entityID = ?' % self.table,
+                                          (entity_id,)).fetchone()
+            item = self._decode(row[0]) if row is not None else {'entityID': {'S': entity_id}}
+            if unless_etag is not None and item.get('etag') == {'S': unless_etag}:
+                return False
+            item.update(values)
+            for name in remove:
+                item.pop(name, None)
+            self._put(item)
+        return True
+
+    def touch_record(self, entity_id, values):
+        with self.lock:
+            row = self.connection.execute('SELECT item FROM %s WHERE entityID = ?' % self.table,
+                                          (entity_id,)).fetchone()
+            if row is None:
+                return False
+            item = self._decode(row[0])
+            item.update(values)
+            self._put(item)
+        return True
+
+    def provider_records(self, provider, attributes):
+        with self.lock:
+            rows = self.connection.execute('SELECT item FROM %s WHERE provider = ?' % self.table,
+                                           (provider,)).fetchall()
+        return [project(self._decode(row[0]), attributes) for row in rows]
+
+    def entity_ids(self):
+        with self.lock:
+            rows = self.connection.execute('SELECT entityID FROM %s WHERE provider IS NOT NULL' %
+                                           self.table).fetchall()
+        return [row[0] for row in rows]
+
+    def stale_entity_ids(self, provider, descriptor_type, before):
+        with self.lock:
+            rows = self.connection.execute('SELECT entityID, item FROM %s WHERE provider = ? AND last_seen < ?' %
+                                           self.table, (provider, before)).fetchall()
+        return [row[0] for row in rows if self._decode(row[1]).get('descriptor_type') == {'S': descriptor_type}]
+
+    def close(self):
+        self.connection.close()
+
+    def _put(self, item):
+        provider = item['provider']['S'] if 'provider' in item else None
+        last_seen = float(item['last_seen']['N']) if 'last_seen' in item else None
+        self.connection.execute('INSERT OR REPLACE INTO %s (entityID, provider, last_seen, item) VALUES (?, ?, ?, ?)' %
+                                self.table, (item['entityID']['S'], provider, last_seen, self._encode(item)))
+
+    @staticmethod
+    def _encode(item):
+        return json.dumps(dict((name, {'B': base64.b64encode(value['B']).decode('ascii')} if 'B' in value else value)
+                               for name, value in item.items()))
+
+    @staticmethod
+    def _decode(text):
+        item = json.loads(text)
+        for name, value in item.items():
+            if 'B' in value:
+                item[name] = {'B': base64.b64decode(value['B'])}
+        return item
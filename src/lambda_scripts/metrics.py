@@ -0,0 +1,251 @@
+"""
+Metrics of the handlers as CloudWatch embedded metric format (EMF) log lines
+
+A handler wrapped in metric_scope collects the metrics of an invocation in a MetricsRecorder and
+prints them as JSON lines when it returns; CloudWatch Logs turns them into metrics of
+METRICS_NAMESPACE. Unless METRICS_ENABLED is set, code records into NULL_RECORDER, whose methods do
+nothing.
+
+The recorder of an invocation is held in a context variable, so that handlers running at the same
+time on different threads each record into their own. Threads started by a handler do not inherit
+it: work handed to them is wrapped with bind.
+"""
+
+from __future__ import print_function
+
+import contextvars
+import functools
+import json
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '').lower() in ('1', 'true', 'yes')
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'MDQ')
+# Values kept per metric and invocation; beyond that a uniform sample of them is kept
+METRICS_MAX_VALUES = int(os.environ.get('METRICS_MAX_VALUES', 1000))
+# EMF takes up to 100 values per metric and log line
+EMF_MAX_VALUES = 100
+
+
+class MetricsRecorder(object):
+    """
+    Metrics of one invocation; all methods may be called from several threads
+    """
+
+    def __init__(self, namespace, dimensions, max_values=METRICS_MAX_VALUES):
+        """
+        :param namespace: CloudWatch namespace of the metrics
+        :param dimensions: name -> value of the dimensions of all metrics
+        :param max_values: values kept per metric
+        """
+        self.namespace = namespace
+        self.dimensions = OrderedDict(dimensions)
+        self.properties = {}
+        self.max_values = max_values
+        self.metrics = OrderedDict()
+        self.lock = threading.Lock()
+        self.sample = random.Random()
+
+    def put(self, name, value, unit='None'):
+        """
+        Adds a value of a metric, such as a latency, whose distribution is of interest
+        """
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = {'unit': unit, 'values': [], 'seen': 0}
+            metric['seen'] += 1
+            if len(metric['values']) < self.max_values:
+                metric['values'].append(value)
+            else:
+                # Reservoir sampling keeps every value with the same probability
+                slot = self.sample.randrange(metric['seen'])
+                if slot < self.max_values:
+                    metric['values'][slot] = value
+
+    def count(self, name, value=1):
+        """
+        Adds to a counter, which is sent as one sum
+        """
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = {'unit': 'Count', 'values': [0], 'seen': 1}
+            metric['values'][0] += value
+
+    def timer(self, name):
+        """
+        :return: context manager putting the milliseconds it was entered for as a value of name
+        """
+        return Timer(self, name)
+
+    def set_dimension(self, name, value):
+        self.dimensions[name] = value
+
+    def set_property(self, name, value):
+        self.properties[name] = value
+
+    def records(self, timestamp=None):
+        """
+        :return: the EMF records of the metrics, as many as their values need
+        :rtype: list
+        """
+        timestamp = int((time.time() if timestamp is None else timestamp) * 1000)
+        with self.lock:
+            metrics = [(name, metric['unit'], list(metric['values'])) for name, metric in self.metrics.items()]
+
+        records = []
+        while any(values for _, _, values in metrics):
+            record = dict(self.properties)
+            record.update(self.dimensions)
+            definitions = []
+            for name, unit, values in metrics:
+                if values:
+                    chunk = values[:EMF_MAX_VALUES]
+                    del values[:EMF_MAX_VALUES]
+                    record[name] = chunk[0] if len(chunk) == 1 else chunk
+                    definitions.append({'Name': name, 'Unit': unit})
+            record['_aws'] = {'Timestamp': timestamp, 'CloudWatchMetrics': [{
+                'Namespace': self.namespace, 'Dimensions': [list(self.dimensions)], 'Metrics': definitions}]}
+            records.append(record)
+        return records
+
+    def flush(self):
+        for record in self.records():
+            emit_record(record)
+        with self.lock:
+            self.metrics.clear()
+
+
+class Timer(object):
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.recorder.put(self.name, (time.perf_counter() - self.started) * 1000, 'Milliseconds')
+        return False
+
+
+class NullRecorder(object):
+    """
+    Recorder of handlers running without metrics
+    """
+
+    def put(self, name, value, unit='None'):
+        pass
+
+    def count(self, name, value=1):
+        pass
+
+    def timer(self, name):
+        return NULL_TIMER
+
+    def set_dimension(self, name, value):
+        pass
+
+    def set_property(self, name, value):
+        pass
+
+    def flush(self):
+        pass
+
+
+class NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_RECORDER = NullRecorder()
+NULL_TIMER = NullTimer()
+_current = contextvars.ContextVar('metrics_recorder', default=NULL_RECORDER)
+
+
+def current():
+    """
+    :return: the recorder of the running invocation
+    :rtype: MetricsRecorder or NullRecorder
+    """
+    return _current.get()
+
+
+@contextmanager
+def recording(recorder):
+    """
+    :return: context manager making recorder the current one of this thread while it is entered
+    """
+    token = _current.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _current.reset(token)
+
+
+def bind(function, recorder=None):
+    """
+    :param function: work to run on another thread
+    :param recorder: recorder the work records into, the current one by default
+    :return: function running with the given recorder as the current one, on whatever thread calls it
+    """
+    if recorder is None:
+        recorder = current()
+
+    @functools.wraps(function)
+    def bound(*args, **kwargs):
+        with recording(recorder):
+            return function(*args, **kwargs)
+    return bound
+
+
+def metric_scope(function):
+    """
+    Decorates a Lambda handler to record the metrics of each invocation under a Function dimension
+
+    Besides what the handler records, the scope puts its 'Duration' and counts 'Status' and the
+    status of API Gateway responses, whether returned or raised as an exception, and 'Errors'.
+    """
+
+    def decorate(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            if not METRICS_ENABLED:
+                return handler(event, context)
+
+            recorder = MetricsRecorder(METRICS_NAMESPACE, {'Function': function})
+            token = _current.set(recorder)
+            started = time.perf_counter()
+            try:
+                response = handler(event, context)
+                if isinstance(response, dict) and 'status' in response:
+                    recorder.count('Status%s' % response['status'])
+                return response
+            except Exception as e:
+                recorder.count('Status%s' % e if str(e).isdigit() else 'Errors')
+                raise
+            except SystemExit as e:
+                if e.code:
+                    recorder.count('Errors')
+                raise
+            finally:
+                recorder.put('Duration', (time.perf_counter() - started) * 1000, 'Milliseconds')
+                _current.reset(token)
+                recorder.flush()
+        return wrapper
+    return decorate
+
+
+def emit_record(record):
+    print(json.dumps(record, separators=(',', ':')))
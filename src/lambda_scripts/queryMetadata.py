@@ -1,20 +1,88 @@
 from __future__ import print_function
 
+import gzip
+import hashlib
+import json
+import os
 import sys
+import threading
+import time
+from base64 import b64encode
+from collections import OrderedDict
 from urllib import parse
 
-import boto3
-from botocore import exceptions
+from . import metrics
+from .entityFilter import BloomFilter
+from .lazyImport import lazy_import
+from .metadataStore import (DEFAULT_TABLE, DOCUMENT_CODEC, DOCUMENT_KEY_PREFIX, ENTITY_FILTER_MANIFEST, SHA1_PREFIX,
+                            StoreError, get_client, open_store)
 
+# Loaded on first use, so that a container serving from a local store never imports botocore
+exceptions = lazy_import('botocore.exceptions')
 
+# Seconds a cached entity is served without asking DynamoDb, and the size of the cache
+ENTITY_CACHE_TTL = float(os.environ.get('ENTITY_CACHE_TTL', 60))
+ENTITY_CACHE_MAX_BYTES = int(os.environ.get('ENTITY_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+# Bucket of the entity filter published by importMetadata, none to read DynamoDb for every identifier,
+# and the seconds a loaded filter is used without asking S3 for a newer one
+ENTITY_FILTER_BUCKET = os.environ.get('ENTITY_FILTER_BUCKET')
+ENTITY_FILTER_TTL = float(os.environ.get('ENTITY_FILTER_TTL', 300))
+# Store and table importMetadata writes to: 'dynamodb', 'memory' or 'sqlite:' and a database path
+METADATA_STORE = os.environ.get('METADATA_STORE', 'dynamodb')
+METADATA_TABLE = os.environ.get('METADATA_TABLE', DEFAULT_TABLE)
+# Return documents gzip-compressed, base64 encoded, to clients accepting gzip. Off by default: API
+# Gateway has to be set up to decode the body and pass the Content-Encoding header on (see the README).
+GZIP_RESPONSES = os.environ.get('GZIP_RESPONSES', '').lower() in ('1', 'true', 'yes')
+
+# Attributes of a document item; documents too large for their item are in S3 at s3_bucket/s3_key
+DOCUMENT_ATTRIBUTES = ['metadata', 'codec', 'etag', 's3_bucket', 's3_key']
+
+# Entities a batch request may ask for, which keeps the response well below the Lambda payload limit
+BATCH_QUERY_LIMIT = 200
+
+ENTITIES_DESCRIPTOR_START = '<?xml version="1.0" encoding="UTF-8"?>\n' \
+                            '<md:EntitiesDescriptor xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata">'
+ENTITIES_DESCRIPTOR_END = '</md:EntitiesDescriptor>'
+
+
+@metrics.metric_scope('queryMetadata')
 def lambda_handler(event, context):
     """
     Provide an event that contains the following keys:
 
     The event object MUST specify:
-      - params.path.entityId: the entityId of the requested entity.
+      - params.path.entityId: the entityId of the requested entity, or '{sha1}' and the hex SHA-1 of it.
       - params.header.If-None-Match: a previously provided ETag to take advantage of caching.
 
+    The event object CAN specify:
+      - params.header.Accept-Encoding: with GZIP_RESPONSES (environment variable), when it accepts
+        gzip, the document is returned gzip-compressed, as stored, with no decompression in between.
+        'metadata' then holds the base64 of the compressed bytes, 'isBase64Encoded' is set and the
+        headers carry Content-Encoding: gzip. API Gateway has to be set up for it: it must decode
+        the body (CONVERT_TO_BINARY on the integration response, or binary media types for
+        */* with a proxy integration) and map the Content-Encoding header to the method response.
+        Without GZIP_RESPONSES, documents are always returned as text.
+
+    The event object CAN specify instead of params.path.entityId:
+      - body-json.entityIds: a list of entityIds or {sha1} identifiers. The entities that exist are
+        returned in one EntitiesDescriptor, in the order asked for, with an ETag combined from
+        theirs. Each entity keeps its own signature; the EntitiesDescriptor is not signed.
+
+    Entities are cached by the container for ENTITY_CACHE_TTL seconds, within ENTITY_CACHE_MAX_BYTES
+    (both environment variables).
+
+    Documents too large for their DynamoDb item are read from the S3 object the item points to, and
+    returned like any other.
+
+    With an ENTITY_FILTER_BUCKET (environment variable), identifiers the entity filter rules out are
+    answered with 404 without reading DynamoDb. Entities imported after the filter was loaded may be
+    missed for up to ENTITY_FILTER_TTL seconds.
+
+    With METRICS_ENABLED (environment variable), each invocation logs its metrics in CloudWatch
+    embedded metric format, in METRICS_NAMESPACE with the dimension Function: the number of
+    CacheHits, CacheMisses and FilterRejections, the StoreTime spent reading the store, the status
+    of the response (Status200, Status304, Status404, ...) and its Duration.
+
     :param event: data representing the captured activity
     :param context: runtime information for handler, currently not using
     :type event: dict
@@ -25,17 +93,24 @@ def lambda_handler(event, context):
     """
 
     verify_params(event)
-    dynamo = get_dynamodb_client()
+
+    # Striping single quotes until API Gateway Header JSON decoding issue fixed
+    inbound_etag = event['params']['header']['If-None-Match'].replace('W/', '').replace('"', '').replace("'", '')
+
+    gzip_accepted = GZIP_RESPONSES and accepts_gzip(event)
+
+    if is_batch_request(event):
+        return get_entities_descriptor(event['body-json']['entityIds'], inbound_etag, gzip_accepted)
 
     entity_id = event['params']['path']['entityId']
     entity_id = parse.unquote(entity_id)
     print('Current EntityId: ' + entity_id)
-
-    # Striping single quotes until API Gateway Header JSON decoding issue fixed
-    inbound_etag = event['params']['header']['If-None-Match'].replace('W/', '').replace('"', '').replace("'", '')
     print('Current Incoming ETag: ' + inbound_etag)
 
-    db_etag = get_db_record(dynamo, entity_id)
+    record = get_entity(entity_id, inbound_etag)
+    if record is None:
+        raise Exception('404')
+    db_etag, metadata = record
 
     if inbound_etag == db_etag:
         print("ETags matched!")
@@ -43,11 +118,85 @@ def lambda_handler(event, context):
 
     # TODO who is this returning to?
     # TODO since i am not sure where this was called from and where it is going what kind of error should be sent?
-    return {'metadata': metadata, 'headers': {'etag': 'W/"{0}"'.format(db_etag)}, 'status': '200'}
+    return create_response(metadata, db_etag, gzip_accepted)
     # Using single quotes until API Gateway Header JSON decoding issue fixed
     # return { 'metadata' : metadata, 'headers' : { 'etag': "W/'{0}'".format(ETag)}, 'status': '200'}
 
 
+def create_response(metadata, etag, gzip_accepted=False):
+    """
+    Builds the response for a document, compressed when the client accepts gzip
+
+    :param metadata: the document, gzip-compressed bytes or text
+    :param etag: etag of the document
+    :param gzip_accepted: whether the client accepts a gzip Content-Encoding
+    :type metadata: bytes or string
+    :type etag: string
+    :type gzip_accepted: bool
+
+    :return: metadata information
+    :rtype: dict
+    """
+    headers = {'etag': 'W/"{0}"'.format(etag), 'Vary': 'Accept-Encoding'}
+    if gzip_accepted:
+        if not isinstance(metadata, bytes):
+            metadata = gzip.compress(metadata.encode('utf-8'))
+        headers['Content-Encoding'] = 'gzip'
+        return {'metadata': b64encode(metadata).decode('ascii'), 'isBase64Encoded': True, 'headers': headers,
+                'status': '200'}
+
+    return {'metadata': decode_document(metadata), 'headers': headers, 'status': '200'}
+
+
+def accepts_gzip(event):
+    """
+    :return: whether the Accept-Encoding header of the request accepts gzip
+    :rtype: bool
+    """
+    for name, value in event['params']['header'].items():
+        if name.lower() == 'accept-encoding' and isinstance(value, str):
+            for coding in value.split(','):
+                coding = coding.split(';')
+                if coding[0].strip().lower() in ('gzip', 'x-gzip', '*') and \
+                        not any(param.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+                                for param in coding[1:]):
+                    return True
+    return False
+
+
+def read_document(item):
+    """
+    Get the document of an item, from S3 when the item only points there
+
+    :return: the document, gzip-compressed bytes when stored with the gzip codec, text otherwise;
+        None when the S3 object could not be read
+    :rtype: bytes or string
+    """
+    if 'codec' not in item:
+        return item['metadata']['S']
+    if item['codec']['S'] != DOCUMENT_CODEC:
+        raise ValueError('Unsupported document codec: ' + item['codec']['S'])
+    if 'metadata' in item:
+        return item['metadata']['B']
+
+    try:
+        response = get_s3_client().get_object(Bucket=item['s3_bucket']['S'], Key=item['s3_key']['S'])
+    except exceptions.ClientError as e:
+        print(e.response['Error']['Code'])
+        return None
+    return response['Body'].read()
+
+
+def decode_document(metadata):
+    """
+    :return: the text of a document read by read_document
+    :rtype: string
+    """
+    if isinstance(metadata, bytes):
+        return gzip.decompress(metadata).decode('utf-8')
+    return metadata
+
+
 def verify_params(event):
     """
     Verify dictionary keys are in place, grouped all keys needed here.
@@ -60,13 +209,14 @@ def verify_params(event):
     """
     all_good = True
     message = ''
+    batch = is_batch_request(event)
     if 'params' not in event:
         message = 'The following key was missing: params'
         all_good = False
-    elif 'path' not in event['params']:
+    elif not batch and 'path' not in event['params']:
         message = 'The following key was missing: params->path'
         all_good = False
-    elif 'entityId' not in event['params']['path']:
+    elif not batch and 'entityId' not in event['params']['path']:
         message = 'The following key was missing: params->path->entityId'
         all_good = False
     elif 'header' not in event['params']:
@@ -80,38 +230,459 @@ def verify_params(event):
         print(message)
         raise Exception('304')
 
+    if batch:
+        entity_ids = event['body-json']['entityIds']
+        if not isinstance(entity_ids, list) or not entity_ids or len(entity_ids) > BATCH_QUERY_LIMIT or \
+                not all(isinstance(entity_id, str) for entity_id in entity_ids):
+            print('body-json->entityIds must be a list of 1 to %d entityIds' % BATCH_QUERY_LIMIT)
+            raise Exception('400')
+
     return True
 
 
-def get_db_record(dynamo, entity_id):
+def is_batch_request(event):
+    return isinstance(event.get('body-json'), dict) and 'entityIds' in event['body-json']
+
+
+def get_entities_descriptor(identifiers, inbound_etag='', gzip_accepted=False):
+    """
+    Answer a batch request with one EntitiesDescriptor holding the entities asked for
+
+    The signed documents are concatenated as stored, without their XML declarations, so every
+    entity signature stays intact. Unlike a single document, the EntitiesDescriptor is compressed
+    as a whole for clients that accept gzip.
+
+    :param identifiers: entityIds or {sha1} identifiers
+    :param inbound_etag: etag the client already has, if any
+    :param gzip_accepted: whether the client accepts a gzip Content-Encoding
+    :type identifiers: list
+    :type inbound_etag: string
+    :type gzip_accepted: bool
+
+    :return: metadata information
+    :rtype: dict
+    """
+    etag, documents = get_entities(identifiers, inbound_etag)
+    if etag is None:
+        raise Exception('404')
+    if etag == inbound_etag:
+        print("ETags matched!")
+        raise Exception('304')
+
+    metadata = ENTITIES_DESCRIPTOR_START + \
+        ''.join(strip_xml_declaration(decode_document(document)) for document in documents) + \
+        ENTITIES_DESCRIPTOR_END
+    return create_response(metadata, etag, gzip_accepted)
+
+
+def get_entities(identifiers, inbound_etag=''):
+    """
+    Get several entities with as few DynamoDb round trips as possible
+
+    Cached entities are taken from the cache. For the others, the identifiers are resolved, the
+    combined etag is checked against the client's from the small records, and only then are the
+    documents read, all with BatchGetItem.
+
+    :param identifiers: entityIds or {sha1} identifiers
+    :param inbound_etag: etag the client already has, if any
+    :type identifiers: list
+    :type inbound_etag: string
+
+    :return: combined etag and the documents of the entities found, in the order asked for;
+        the documents are None when the etag matched, and the etag is None when no entity was found
+    :rtype: (string, list)
+    """
+    identifiers = list(OrderedDict.fromkeys(identifiers))
+    recorder = metrics.current()
+    records = {}
+    for identifier in identifiers:
+        record = ENTITY_CACHE.get(identifier)
+        if record is not None:
+            records[identifier] = record
+
+    missing = [identifier for identifier in identifiers
+               if identifier not in records and ENTITY_FILTER.might_contain(identifier)]
+    recorder.count('CacheHits', len(records))
+    recorder.count('CacheMisses', len(identifiers) - len(records))
+    recorder.count('FilterRejections', len(identifiers) - len(records) - len(missing))
+    if missing:
+        with recorder.timer('StoreTime'):
+            store = get_metadata_store()
+            entity_ids = resolve_identifiers(store, missing)
+
+            unique_ids = list(OrderedDict.fromkeys(entity_ids.values()))
+
+            if inbound_etag:
+                etags = dict((identifier, record[0]) for identifier, record in records.items())
+                stored = store.batch_get_items(unique_ids, ['etag'])
+                for identifier, entity_id in entity_ids.items():
+                    if entity_id in stored:
+                        etags[identifier] = stored[entity_id]['etag']['S']
+                etag = combine_etags([etags[identifier] for identifier in identifiers if identifier in etags])
+                if etag == inbound_etag:
+                    return etag, None
+
+            documents = store.batch_get_items([DOCUMENT_KEY_PREFIX + entity_id for entity_id in unique_ids],
+                                              DOCUMENT_ATTRIBUTES)
+            # Records stored before documents got items of their own hold the document themselves
+            legacy = [entity_id for entity_id in unique_ids if DOCUMENT_KEY_PREFIX + entity_id not in documents]
+            if legacy:
+                for entity_id, item in store.batch_get_items(legacy, ['metadata', 'etag']).items():
+                    if 'metadata' in item:
+                        documents[DOCUMENT_KEY_PREFIX + entity_id] = item
+
+            for identifier, entity_id in entity_ids.items():
+                item = documents.get(DOCUMENT_KEY_PREFIX + entity_id)
+                metadata = read_document(item) if item is not None else None
+                if metadata is not None:
+                    records[identifier] = (item['etag']['S'], metadata)
+                    ENTITY_CACHE.put(identifier, *records[identifier])
+        print('Entity cache: %(hits)d hits, %(misses)d misses, %(entries)d entries, %(bytes)d bytes' %
+              ENTITY_CACHE.stats())
+
+    found = [records[identifier] for identifier in identifiers if identifier in records]
+    print('Found %d of %d entities' % (len(found), len(identifiers)))
+    if not found:
+        return None, []
+    return combine_etags([record[0] for record in found]), [record[1] for record in found]
+
+
+def resolve_identifiers(store, identifiers):
+    """
+    Translate MDQ identifiers into the entityIds they stand for, with BatchGetItem for {sha1} identifiers
+
+    :return: identifier -> entityId, without {sha1} identifiers of no stored entity
+    :rtype: dict
+    """
+    entity_ids = {}
+    aliases = {}
+    for identifier in identifiers:
+        if identifier.startswith(SHA1_PREFIX):
+            aliases[SHA1_PREFIX + identifier[len(SHA1_PREFIX):].lower()] = identifier
+        else:
+            entity_ids[identifier] = identifier
+
+    for key, item in store.batch_get_items(list(aliases), ['entity']).items():
+        entity_ids[aliases[key]] = item['entity']['S']
+    return entity_ids
+
+
+def combine_etags(etags):
+    """
+    :return: etag of an EntitiesDescriptor of documents with the given etags, in that order
+    :rtype: string
+    """
+    return hashlib.md5(' '.join(etags).encode('utf-8')).hexdigest()
+
+
+def strip_xml_declaration(document):
+    if document.startswith('<?xml'):
+        return document[document.index('?>') + 2:].lstrip()
+    return document
+
+
+def get_entity(entity_id, inbound_etag=''):
+    """
+    Get the etag and metadata of an entity, from the cache of this container when possible
+
+    A cached entity is served for up to ENTITY_CACHE_TTL seconds, so an import shows up in
+    warm containers that much later. Otherwise a client's etag is first compared with the etag of
+    the entity's record, and the document is only read when they differ.
+
+    :param entity_id: ID of record trying to get, or its {sha1} identifier
+    :param inbound_etag: etag the client already has, if any
+    :type entity_id: string
+    :type inbound_etag: string
+
+    :return: etag and metadata, metadata is None when the etag matched and the document was not
+        read; None when there is no such record. The metadata is gzip-compressed bytes for documents
+        stored compressed.
+    :rtype: (string, bytes or string)
+    """
+    recorder = metrics.current()
+    record = ENTITY_CACHE.get(entity_id)
+    if record is not None:
+        print('Cached ETag: ' + record[0])
+        recorder.count('CacheHits')
+        return record
+    recorder.count('CacheMisses')
+
+    if not ENTITY_FILTER.might_contain(entity_id):
+        print("Entity filter rules out:", entity_id)
+        recorder.count('FilterRejections')
+        return None
+
+    with recorder.timer('StoreTime'):
+        store = get_metadata_store()
+        identifier = entity_id
+        entity_id = resolve_identifier(store, identifier)
+        if entity_id is None:
+            return None
+
+        if inbound_etag:
+            db_etag = get_db_record(store, entity_id)
+            if db_etag == inbound_etag:
+                return db_etag, None
+
+        record = get_db_item(store, entity_id)
+    if record is not None:
+        ENTITY_CACHE.put(identifier, record[0], record[1])
+    print('Entity cache: %(hits)d hits, %(misses)d misses, %(entries)d entries, %(bytes)d bytes' % ENTITY_CACHE.stats())
+    return record
+
+
+def resolve_identifier(store, identifier):
+    """
+    Translate an MDQ identifier into the entityId it stands for
+
+    :param store: metadata store
+    :param identifier: an entityId, or '{sha1}' and the hex SHA-1 of one
+    :type store: MetadataStore
+    :type identifier: string
+
+    :return: the entityId, None for a {sha1} identifier of no stored entity
+    :rtype: string
+    """
+    if not identifier.startswith(SHA1_PREFIX):
+        return identifier
+
+    try:
+        item = store.get_item(SHA1_PREFIX + identifier[len(SHA1_PREFIX):].lower(), ['entity'])
+    except StoreError as e:
+        print(e.code)
+        return None
+
+    if item is None:
+        print("No entity found for identifier:", identifier)
+        return None
+
+    return item['entity']['S']
+
+
+def get_db_record(store, entity_id):
     """
     get database record associated with entityId passed in
 
-    :param dynamo: dynamo db handler
+    :param store: metadata store
     :param entity_id: ID of record trying to get
-    :type dynamo: object
+    :type store: MetadataStore
     :type entity_id: string
 
-    :return: Record
+    :return: etag of the record, empty when there is none
     """
     try:
-        response = dynamo.get_item(
-            TableName='metadata',
-            Key={'entityID': {'S': entity_id}},
-            AttributesToGet=['metadata', 'etag']
-        )
-    except exceptions.ClientError as e:
-        print(e.response['Error']['Code'])
+        item = store.get_item(entity_id, ['etag'])
+    except StoreError as e:
+        print(e.code)
         return ''
 
-    if 'Item' not in response:
+    if item is None:
         print("No record found for entity_id:", entity_id)
         return ''
 
-    db_etag = response['Item']['etag']['S']
+    db_etag = item['etag']['S']
     print('Currently stored ETag: ' + db_etag)
     return db_etag
 
 
+def get_db_item(store, entity_id):
+    """
+    get the signed document associated with entityId passed in, and its etag
+
+    Records stored before documents got items of their own hold the document themselves.
+
+    :param store: metadata store
+    :param entity_id: ID of record trying to get
+    :type store: MetadataStore
+    :type entity_id: string
+
+    :return: etag and metadata as read by read_document, None when the record is missing or could
+        not be read
+    :rtype: (string, bytes or string)
+    """
+    try:
+        item = store.get_item(DOCUMENT_KEY_PREFIX + entity_id, DOCUMENT_ATTRIBUTES)
+        if item is None:
+            item = store.get_item(entity_id, ['metadata', 'etag'])
+    except StoreError as e:
+        print(e.code)
+        return None
+
+    if item is None or not ('metadata' in item or 's3_key' in item):
+        print("No record found for entity_id:", entity_id)
+        return None
+
+    metadata = read_document(item)
+    if metadata is None:
+        return None
+
+    db_etag = item['etag']['S']
+    print('Currently stored ETag: ' + db_etag)
+    return db_etag, metadata
+
+
+class EntityCache(object):
+    """
+    Least recently used entities of this container, kept across warm invocations
+
+    Holds entityID -> (etag, metadata, fetched at). Documents are kept as read, so compressed ones
+    stay compressed. Entries expire ttl seconds after they were fetched, and the least recently
+    used ones are dropped when the cached entity IDs, etags and documents take more than max_bytes.
+
+    A Lambda container handles one request at a time, but the cache may be shared by threads, as in
+    bench_query_load, so it is locked.
+    """
+
+    def __init__(self, ttl=ENTITY_CACHE_TTL, max_bytes=ENTITY_CACHE_MAX_BYTES, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, entity_id):
+        """
+        :return: etag and metadata of a cached entity, None when it is not cached or expired
+        :rtype: (string, bytes or string)
+        """
+        with self.lock:
+            entry = self.entries.get(entity_id)
+            if entry is None or self.clock() - entry[2] >= self.ttl:
+                if entry is not None:
+                    self._remove(entity_id)
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(entity_id)
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def put(self, entity_id, etag, metadata):
+        """
+        Caches an entity just read from DynamoDb; entities larger than the whole budget are not cached
+        """
+        size = len(entity_id.encode('utf-8')) + len(etag) + \
+            len(metadata if isinstance(metadata, bytes) else metadata.encode('utf-8'))
+
+        with self.lock:
+            if entity_id in self.entries:
+                self._remove(entity_id)
+            if size > self.max_bytes:
+                return
+
+            while self.bytes + size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+            self.entries[entity_id] = (etag, metadata, self.clock(), size)
+            self.bytes += size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """
+        :return: 'hits', 'misses', 'evictions', number of 'entries' and their 'bytes'
+        :rtype: dict
+        """
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self.entries), 'bytes': self.bytes}
+
+    def _remove(self, entity_id):
+        self.bytes -= self.entries.pop(entity_id)[3]
+
+
+class EntityFilter(object):
+    """
+    The entity filter published by importMetadata, loaded once per container
+
+    The manifest naming the current filter is asked for again, conditionally, every ttl seconds.
+    Without a filter, because none is configured or it could not be read, every identifier might
+    be stored.
+    """
+
+    def __init__(self, bucket=ENTITY_FILTER_BUCKET, ttl=ENTITY_FILTER_TTL, clock=time.monotonic):
+        self.bucket = bucket
+        self.ttl = ttl
+        self.clock = clock
+        self.filter = None
+        self.manifest_etag = None
+        self.checked = None
+        self.rejected = 0
+
+    def might_contain(self, identifier):
+        """
+        :param identifier: an entityId or a {sha1} identifier
+        :return: false when the identifier is definitely not stored
+        :rtype: bool
+        """
+        if not self.bucket:
+            return True
+        if self.checked is None or self.clock() - self.checked >= self.ttl:
+            self.refresh()
+        if self.filter is None:
+            return True
+
+        if identifier.startswith(SHA1_PREFIX):
+            identifier = SHA1_PREFIX + identifier[len(SHA1_PREFIX):].lower()
+        if identifier in self.filter:
+            return True
+        self.rejected += 1
+        return False
+
+    def refresh(self):
+        """
+        Loads the current filter when the manifest changed; a filter that cannot be read keeps the
+        one loaded before
+        """
+        self.checked = self.clock()
+        s3 = get_s3_client()
+        try:
+            if self.manifest_etag is None:
+                response = s3.get_object(Bucket=self.bucket, Key=ENTITY_FILTER_MANIFEST)
+            else:
+                response = s3.get_object(Bucket=self.bucket, Key=ENTITY_FILTER_MANIFEST, IfNoneMatch=self.manifest_etag)
+            manifest = json.loads(response['Body'].read().decode('utf-8'))
+            data = s3.get_object(Bucket=self.bucket, Key=manifest['key'])['Body'].read()
+            self.filter = BloomFilter.from_bytes(data)
+        except exceptions.ClientError as e:
+            if e.response['Error']['Code'] not in ('304', 'NotModified'):
+                print("Could not load the entity filter: %s" % e.response['Error']['Code'])
+            return
+        except ValueError as e:
+            print("Could not load the entity filter: %s" % e)
+            return
+
+        self.manifest_etag = response['ETag']
+        print("Loaded an entity filter of %(entities)d entities, %(bytes)d bytes" % manifest)
+
+    def clear(self):
+        self.filter = None
+        self.manifest_etag = None
+        self.checked = None
+        self.rejected = 0
+
+
+# Survive warm invocations of the container
+ENTITY_CACHE = EntityCache()
+ENTITY_FILTER = EntityFilter()
+
+
+def get_metadata_store():
+    return open_store(METADATA_STORE, METADATA_TABLE, get_dynamodb_client)
+
+
 def get_dynamodb_client():
-    return boto3.client('dynamodb')
+    return get_client('dynamodb')
+
+
+def get_s3_client():
+    return get_client('s3')
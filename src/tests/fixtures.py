@@ -0,0 +1,243 @@
+"""
+Shared test fixtures: signed aggregates built from the dummy metadata and mocked AWS resources.
+
+The dummy aggregate is re-signed with the dummy "our" key pair so that tests can verify it
+offline, without fetching the live feed.
+"""
+
+import gzip
+import hashlib
+import os
+import tempfile
+import threading
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import mock
+
+import signxml
+from lxml import etree
+
+from src.lambda_scripts.metadataStore import DOCUMENT_KEY_PREFIX, PROVIDER_INDEX_ATTRIBUTES, SHA1_PREFIX
+
+# Region of the mocked AWS services, patched in by the tests that need it
+TEST_REGION = 'us-west-1'
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+DUMMY_SAML_DATA = os.path.join(TESTS_DIR, 'dummy_saml_data.xml')
+DUMMY_OUR_CERT = os.path.join(TESTS_DIR, 'dummy_our_cert.crt')
+DUMMY_OUR_KEY = os.path.join(TESTS_DIR, 'dummy_our_key.key')
+
+DS = '{http://www.w3.org/2000/09/xmldsig#}'
+MD = '{urn:oasis:names:tc:SAML:2.0:metadata}'
+
+
+def read_our_cert():
+    with open(DUMMY_OUR_CERT, 'r') as handle:
+        return handle.read()
+
+
+def read_our_key():
+    with open(DUMMY_OUR_KEY, 'rb') as handle:
+        return handle.read()
+
+
+def build_signed_aggregate(entity_count=None, valid_until=None):
+    """
+    Builds an aggregate from the dummy metadata, signed with the dummy key
+
+    Signatures embedded in the dummy data are removed; they were made with keys we do not have.
+
+    :param entity_count: keep only the first N entities (all when None)
+    :param valid_until: overrides the aggregate's validUntil attribute
+    :return: serialized, signed aggregate
+    :rtype: bytes
+    """
+    root = etree.parse(DUMMY_SAML_DATA).getroot()
+
+    for signature in list(root.iter(DS + 'Signature')):
+        signature.getparent().remove(signature)
+
+    if entity_count is not None:
+        for entity in list(root.iter(MD + 'EntityDescriptor'))[entity_count:]:
+            entity.getparent().remove(entity)
+
+    if valid_until is not None:
+        root.attrib['validUntil'] = valid_until
+
+    return sign_aggregate(root)
+
+
+def sign_aggregate(root):
+    """
+    Signs an unsigned aggregate with the dummy key
+
+    :param root: EntitiesDescriptor element; a signature is inserted into it
+    :return: serialized, signed aggregate
+    :rtype: bytes
+    """
+    root.insert(0, etree.Element(DS + 'Signature', Id='placeholder', nsmap={'ds': DS[1:-1]}))
+    signer = signxml.XMLSigner(method=signxml.methods.enveloped,
+                               signature_algorithm=u'rsa-sha256',
+                               digest_algorithm=u'sha256',
+                               c14n_algorithm=u'http://www.w3.org/2001/10/xml-exc-c14n#')
+    signed = signer.sign(root, key=read_our_key(), cert=read_our_cert())
+    return etree.tostring(signed, xml_declaration=True, encoding='UTF-8')
+
+
+def write_aggregate_file(document):
+    """
+    Writes an aggregate to a temporary file
+
+    :param document: serialized aggregate
+    :return: (path, file:// url) of the file; the caller removes it
+    """
+    handle, path = tempfile.mkstemp(suffix='.xml')
+    with os.fdopen(handle, 'wb') as output:
+        output.write(document)
+    return path, 'file://' + path
+
+
+class AggregateServer(HTTPServer):
+    """
+    Local stand-in for a federation's metadata server
+
+    Serves one document with an ETag and Last-Modified, answers matching conditional requests with
+    304 and gzips the body for clients that accept it. Requests are recorded in `requests`.
+    """
+
+    def __init__(self, document):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), AggregateRequestHandler)
+        self.requests = []
+        self.publish(document)
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/metadata.xml' % self.server_address[1]
+
+    def publish(self, document):
+        self.document = document
+        self.etag = '"%s"' % hashlib.md5(document).hexdigest()
+        self.last_modified = formatdate(usegmt=True)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class AggregateRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+
+        if self.headers.get('If-None-Match') == server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        body = server.document
+        gzipped = 'gzip' in self.headers.get('Accept-Encoding', '')
+        if gzipped:
+            body = gzip.compress(body)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/samlmetadata+xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', server.etag)
+        self.send_header('Last-Modified', server.last_modified)
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeContext(object):
+    """
+    Stand-in for the Lambda context object
+
+    Reports plenty of remaining time for the first `calls` checks and none after that.
+    """
+
+    def __init__(self, calls=None, remaining=900000):
+        self.calls = calls
+        self.remaining = remaining
+        self.function_name = 'importMetadata'
+
+    def get_remaining_time_in_millis(self):
+        if self.calls is None:
+            return self.remaining
+        if self.calls == 0:
+            return 0
+        self.calls -= 1
+        return self.remaining
+
+
+def aws_environment(region=TEST_REGION):
+    """
+    :return: patch of the environment with the region and dummy credentials of the mocked AWS
+        services, to start in setUp or to decorate a function with
+    """
+    return mock.patch.dict(os.environ, {'AWS_DEFAULT_REGION': region, 'AWS_ACCESS_KEY_ID': 'testing',
+                                        'AWS_SECRET_ACCESS_KEY': 'testing'})
+
+
+def create_bucket(s3, bucket):
+    s3.create_bucket(Bucket=bucket,
+                     CreateBucketConfiguration={'LocationConstraint': os.environ['AWS_DEFAULT_REGION']})
+
+
+def create_metadata_table(dynamo_db, index=True):
+    """
+    Creates the 'metadata' table, with the provider index unless index is false
+    """
+    if not index:
+        dynamo_db.create_table(AttributeDefinitions=[{'AttributeName': 'entityID', 'AttributeType': 'S'}],
+                               TableName='metadata', KeySchema=[{'AttributeName': 'entityID', 'KeyType': 'HASH'}],
+                               ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5})
+        return
+
+    dynamo_db.create_table(
+        AttributeDefinitions=[{'AttributeName': 'entityID', 'AttributeType': 'S'},
+                              {'AttributeName': 'provider', 'AttributeType': 'S'},
+                              {'AttributeName': 'last_seen', 'AttributeType': 'N'}],
+        TableName='metadata',
+        KeySchema=[{'AttributeName': 'entityID', 'KeyType': 'HASH'}],
+        GlobalSecondaryIndexes=[{
+            'IndexName': 'provider-last_seen-index',
+            'KeySchema': [{'AttributeName': 'provider', 'KeyType': 'HASH'},
+                          {'AttributeName': 'last_seen', 'KeyType': 'RANGE'}],
+            'Projection': {'ProjectionType': 'INCLUDE', 'NonKeyAttributes': PROVIDER_INDEX_ATTRIBUTES},
+            'ProvisionedThroughput': {'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5}
+        }],
+        ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5}
+    )
+
+
+def scan_items(dynamo_db, table_name='metadata'):
+    """
+    :return: all entity records of a table, keyed by entityID, with the uncompressed 'metadata' of
+        their document item; {sha1} aliases are left out
+    """
+    items = {}
+    documents = {}
+    paginator = dynamo_db.get_paginator('scan')
+    for page in paginator.paginate(TableName=table_name):
+        for item in page['Items']:
+            if item['entityID']['S'].startswith(DOCUMENT_KEY_PREFIX):
+                documents[item['entityID']['S'][len(DOCUMENT_KEY_PREFIX):]] = item
+            elif not item['entityID']['S'].startswith(SHA1_PREFIX):
+                items[item['entityID']['S']] = item
+
+    for entity_id, document in documents.items():
+        if entity_id in items:
+            metadata = document['metadata']
+            if document.get('codec', {}).get('S') == 'gzip':
+                metadata = {'S': gzip.decompress(metadata['B']).decode('utf-8')}
+            items[entity_id]['metadata'] = metadata
+    return items
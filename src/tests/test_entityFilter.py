@@ -0,0 +1,49 @@
+import unittest
+
+from src.lambda_scripts.entityFilter import *
+
+
+class EntityFilterTestCase(unittest.TestCase):
+
+    def test_bloom_filter_membership(self):
+        """
+        Checks added identifiers are always found and unknown ones rarely, at about the rate asked for
+        """
+        entity_filter = BloomFilter.for_capacity(5000, 0.01)
+        for number in range(5000):
+            entity_filter.add('https://sp%d.example.org/shibboleth' % number)
+
+        self.assertEqual(len(entity_filter), 5000)
+        for number in range(5000):
+            self.assertIn('https://sp%d.example.org/shibboleth' % number, entity_filter)
+        false_positives = sum(1 for number in range(20000) if 'https://unknown%d.example.org' % number in entity_filter)
+        self.assertLess(false_positives / 20000.0, 0.02)
+        self.assertAlmostEqual(entity_filter.false_positive_rate, 0.01, delta=0.002)
+
+    def test_bloom_filter_serialization(self):
+        """
+        Checks a filter survives serialization and other data is refused
+        """
+        entity_filter = BloomFilter.for_capacity(100, 0.001)
+        entity_filter.add('https://idp.example.org')
+        restored = BloomFilter.from_bytes(entity_filter.to_bytes())
+        self.assertIn('https://idp.example.org', restored)
+        self.assertEqual((restored.bits, restored.hashes, len(restored)), (entity_filter.bits, entity_filter.hashes, 1))
+
+        for data in (b'', b'<EntitiesDescriptor/>', entity_filter.to_bytes()[:-1]):
+            with self.assertRaises(ValueError):
+                BloomFilter.from_bytes(data)
+
+    def test_bloom_filter_max_bytes(self):
+        """
+        Checks a size limit shrinks the filter at the expense of its false positive rate
+        """
+        entity_filter = BloomFilter.for_capacity(100000, 0.001, max_bytes=64 * 1024)
+        self.assertEqual(len(entity_filter.to_bytes()) - FILTER_HEADER.size, 64 * 1024)
+        for number in range(100000):
+            entity_filter.add(str(number))
+        self.assertGreater(entity_filter.false_positive_rate, 0.001)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,15 @@
+import os
 import sys
 import unittest
 import time
+import hashlib
+from unittest import mock
 
 from moto import mock_s3, mock_dynamodb2
 
 from src.lambda_scripts.importMetadata import *
+from src.lambda_scripts.metadataStore import CLIENTS, DynamoDbStore
+from src.tests import fixtures
 
 
 class ImportTestCase(unittest.TestCase):
@@ -26,10 +31,15 @@ class ImportTestCase(unittest.TestCase):
             'ourSigningKey': 'stored in file dummy_our_key.key',
             'providerName': 'again',
             'providerSigningCert': 'thisagain',
-            'tableName': 'table'
+            'tableName': 'metadata'
         }
         self.our_cert = self._get_our_cert()
         self.our_key = self._get_our_key()
+        S3_FILE_CACHE.clear()
+        CLIENTS.clear()
+        environment = fixtures.aws_environment()
+        environment.start()
+        self.addCleanup(environment.stop)
 
     def tearDown(self):
         """
@@ -52,6 +62,22 @@ class ImportTestCase(unittest.TestCase):
             event = validate_event_object('This is a string')
         self.assertEqual(exit_code.exception.code, 6)
 
+    def test_validate_event_object_shards_need_state_bucket(self):
+        """
+        Checks a sharded import without a stateBucket to stage the aggregate in is refused
+        """
+        with self.assertRaises(SystemExit) as exit_code:
+            validate_event_object(dict(self.good_event, shardSize=10))
+        self.assertEqual(exit_code.exception.code, 6)
+        self.assertTrue(validate_event_object(dict(self.good_event, shardSize=10, stateBucket='state')))
+
+    def test_get_document_bucket(self):
+        """
+        Checks documents are only offloaded to an explicit documentBucket, never to the keyBucket
+        """
+        self.assertIsNone(get_document_bucket(dict(self.good_event, stateBucket='state')))
+        self.assertEqual(get_document_bucket(dict(self.good_event, documentBucket='documents')), 'documents')
+
     @mock_s3
     def test_get_s3_client(self):
         """
@@ -68,7 +94,9 @@ class ImportTestCase(unittest.TestCase):
         dyna_db = get_dynamodb_client()
         self.assertEqual(dyna_db._endpoint.host, self.dynamo_url)
 
+    # These create their bucket without a LocationConstraint, which only us-east-1 accepts
     @mock_s3
+    @mock.patch.dict(os.environ, {'AWS_DEFAULT_REGION': 'us-east-1'})
     def test_read_file_from_s3(self):
         """
         Checks read_file_from_s3 function can read file from S3
@@ -85,6 +113,7 @@ class ImportTestCase(unittest.TestCase):
         self.assertEqual(s3_file_data, b'This is a test of the emergency broadcast system')
 
     @mock_s3
+    @mock.patch.dict(os.environ, {'AWS_DEFAULT_REGION': 'us-east-1'})
     def test_read_file_from_s3_no_bucket(self):
         """
         Check read_file_from_s3 function catches error when bucket not there
@@ -102,6 +131,7 @@ class ImportTestCase(unittest.TestCase):
         self.assertEqual(exit_code.exception.code, 6)
 
     @mock_s3
+    @mock.patch.dict(os.environ, {'AWS_DEFAULT_REGION': 'us-east-1'})
     def test_read_file_from_s3_no_file(self):
         """
         Checks read_file_from_s3 function catches error when file not in bucket
@@ -226,6 +256,921 @@ class ImportTestCase(unittest.TestCase):
 
         self.assertGreater(response['Table']['ItemCount'], 0)
 
+    def test_iter_entity_descriptors(self):
+        """
+        Checks the incremental walk yields every entity in order and frees processed siblings
+        """
+        document = fixtures.build_signed_aggregate()
+        root = etree.fromstring(document)
+        expected = [item.attrib['entityID'] for item in root.iter(URN + 'EntityDescriptor')]
+
+        spool = tempfile.SpooledTemporaryFile()
+        spool.write(document)
+
+        seen = []
+        for item in iter_entity_descriptors(spool):
+            seen.append(item.attrib['entityID'])
+            parent = item.getparent()
+
+        self.assertEqual(expected, seen)
+        self.assertLessEqual(len(parent), 3)
+        self.assertEqual(len(item), 0)
+
+    def test_verify_metadata_file(self):
+        """
+        Checks a spooled aggregate is verified and its validUntil returned
+        """
+        path, url = fixtures.write_aggregate_file(fixtures.build_signed_aggregate(entity_count=5))
+        try:
+            handle, _ = download_metadata(url)
+            self.assertEqual(verify_metadata_file(handle, self.our_cert), '2026-07-06T10:00:00Z')
+        finally:
+            os.remove(path)
+
+    def test_verify_metadata_file_tampered(self):
+        """
+        Checks a spooled aggregate that was changed after signing is rejected
+        """
+        document = fixtures.build_signed_aggregate(entity_count=5)
+        document = document.replace(b'https://', b'https://evil.', 1)
+        path, url = fixtures.write_aggregate_file(document)
+        try:
+            handle, _ = download_metadata(url)
+            with self.assertRaises(SystemExit) as exit_code:
+                verify_metadata_file(handle, self.our_cert)
+            self.assertEqual(exit_code.exception.code, 5)
+        finally:
+            os.remove(path)
+
+    @mock_s3
+    @mock_dynamodb2
+    def test_lambda_handler_streaming(self):
+        """
+        Checks a streaming import stores the same documents as the in-memory import
+        """
+        document = fixtures.build_signed_aggregate(entity_count=20)
+        path, url = fixtures.write_aggregate_file(document)
+        self.addCleanup(os.remove, path)
+
+        s3 = get_s3_client()
+        fixtures.create_bucket(s3, 'keys')
+        s3.put_object(Bucket='keys', Key='provider.pem', Body=self.our_cert)
+        s3.put_object(Bucket='keys', Key='ours.pem', Body=self.our_cert)
+        s3.put_object(Bucket='keys', Key='ours.key', Body=self.our_key)
+
+        dynamo_db = get_dynamodb_client()
+        fixtures.create_metadata_table(dynamo_db)
+
+        event = {
+            'keyBucket': 'keys',
+            'metadataUrl': url,
+            'providerName': 'Provider',
+            'providerSigningCert': 'provider.pem',
+            'ourSigningCert': 'ours.pem',
+            'ourSigningKey': 'ours.key',
+            'tableName': 'metadata',
+            'descriptorType': 'SPSSODescriptor',
+            'streaming': True
+        }
+        lambda_handler(event, None)
+        streamed = fixtures.scan_items(dynamo_db)
+        # Without a stateBucket no feed state is kept, and nothing is written next to our key
+        self.assertEqual(sorted(entry['Key'] for entry in s3.list_objects_v2(Bucket='keys')['Contents']),
+                         ['ours.key', 'ours.pem', 'provider.pem'])
+
+        root = get_and_validate_metadata(document, self.our_cert)
+        expected = [item.attrib['entityID'] for item in root.iter(URN + 'EntityDescriptor')
+                    if item.find(URN + 'SPSSODescriptor') is not None]
+        self.assertEqual(sorted(streamed), sorted(expected))
+
+        for item in streamed.values():
+            dynamo_db.delete_item(TableName='metadata', Key={'entityID': item['entityID']})
+        event['streaming'] = False
+        lambda_handler(event, None)
+        in_memory = fixtures.scan_items(dynamo_db)
+
+        # The in-memory import works on the canonicalized copy returned by the verifier, so the
+        # documents are compared by their signed content.
+        for entity_id, item in streamed.items():
+            self.assertEqual(self._signed_content(item['metadata']['S']),
+                             self._signed_content(in_memory[entity_id]['metadata']['S']))
+
+    def test_sign_documents_parallel_matches_serial(self):
+        """
+        Checks the worker pool returns the serial path's documents, byte for byte and in order
+        """
+        root = etree.fromstring(fixtures.build_signed_aggregate(entity_count=40))
+        entities = list(root.iter(URN + 'EntityDescriptor'))
+
+        serial = list(sign_documents(select_fragments(entities, 'SPSSODescriptor', 'validUntil'),
+                                     self.our_key, self.our_cert))
+        parallel = list(sign_documents(select_fragments(entities, 'SPSSODescriptor', 'validUntil'),
+                                       self.our_key, self.our_cert, workers=3))
+
+        self.assertGreater(len(serial), SIGNING_BATCH_SIZE)
+        self.assertEqual(serial, parallel)
+
+    def test_sign_documents_parallel_from_threads(self):
+        """
+        Checks worker pools started from several threads at once, as feedConcurrency does, are not
+        forked from the handler and sign like the serial path
+        """
+        root = etree.fromstring(fixtures.build_signed_aggregate(entity_count=20))
+        entities = list(root.iter(URN + 'EntityDescriptor'))
+        serial = list(sign_documents(select_fragments(entities, 'SPSSODescriptor', 'validUntil'),
+                                     self.our_key, self.our_cert))
+
+        def sign_parallel(_):
+            return list(sign_documents(select_fragments(entities, 'SPSSODescriptor', 'validUntil'),
+                                       self.our_key, self.our_cert, workers=2))
+
+        self.assertNotEqual(SIGNING_START_METHOD, 'fork')
+        with ThreadPoolExecutor(3) as executor:
+            for parallel in executor.map(sign_parallel, range(3)):
+                self.assertEqual(serial, parallel)
+
+    @mock_dynamodb2
+    def test_store_entities_parallel_duplicate_entity_ids(self):
+        """
+        Checks signing workers store the full dummy aggregate, which lists some entityIDs twice
+        """
+        dynamo_db = get_dynamodb_client()
+        fixtures.create_metadata_table(dynamo_db)
+        root = get_and_validate_metadata(fixtures.build_signed_aggregate(), self.our_cert)
+        entity_ids = [entity.attrib['entityID'] for entity in root.iter(URN + 'EntityDescriptor')]
+        self.assertLess(len(set(entity_ids)), len(entity_ids))
+
+        for descriptor_type in ('SPSSODescriptor', 'IDPSSODescriptor'):
+            event = dict(self.good_event, descriptorType=descriptor_type, signingWorkers=3)
+            results = {}
+            self.assertTrue(store_entities(root.iter(URN + 'EntityDescriptor'), root.attrib['validUntil'], event,
+                                           self.our_key, self.our_cert, results=results))
+            self.assertEqual(results['failed'], 0)
+
+        self.assertEqual(set(fixtures.scan_items(dynamo_db)), set(entity_ids))
+
+    def test_entity_signer_matches_xml_signer(self):
+        """
+        Checks the signing engine produces the XMLSigner documents byte for byte, and that they verify
+        """
+        root = etree.fromstring(fixtures.build_signed_aggregate(entity_count=10))
+        xml_signer = create_xml_signer()
+        signer = EntitySigner(self.our_key, self.our_cert)
+
+        for entity in root.iter(URN + 'EntityDescriptor'):
+            entity_id = entity.attrib['entityID']
+            expected = create_document(sign_fragment(create_standalone_fragment(entity, entity_id, 'validUntil'),
+                                                     xml_signer, self.our_key, self.our_cert))
+            document = signer.sign(create_standalone_fragment(entity, entity_id, 'validUntil'))
+
+            self.assertEqual(expected, document)
+            verified = signxml.XMLVerifier().verify(document, x509_cert=self.our_cert)
+            self.assertEqual(entity_id, verified.signed_xml.attrib['entityID'])
+
+    def test_sign_documents_parallel_error(self):
+        """
+        Checks a signing failure in a worker is raised in the handler
+        """
+        root = etree.fromstring(fixtures.build_signed_aggregate(entity_count=5))
+        fragments = select_fragments(root.iter(URN + 'EntityDescriptor'), 'IDPSSODescriptor', 'validUntil')
+
+        with self.assertRaises(ValueError):
+            list(sign_documents(fragments, b'not a key', self.our_cert, workers=2))
+
+    def test_entity_digest(self):
+        """
+        Checks the source digest follows the entity content and the stamped validity
+        """
+        root = etree.fromstring(fixtures.build_signed_aggregate(entity_count=2))
+        first, second = list(root.iter(URN + 'EntityDescriptor'))
+
+        digest = entity_digest(create_standalone_fragment(first, 'one', 'validUntil'), self.our_cert)
+        self.assertEqual(digest, entity_digest(create_standalone_fragment(first, 'one', 'validUntil'), self.our_cert))
+        self.assertNotEqual(digest, entity_digest(create_standalone_fragment(second, 'one', 'validUntil'), self.our_cert))
+        self.assertNotEqual(digest, entity_digest(create_standalone_fragment(first, 'one', 'later'), self.our_cert))
+
+    @mock_dynamodb2
+    def test_store_metadata_incremental(self):
+        """
+        Checks unchanged entities are not signed again and only get their last_seen refreshed
+        """
+        dynamo_db = get_dynamodb_client()
+        fixtures.create_metadata_table(dynamo_db)
+
+        root = get_and_validate_metadata(fixtures.build_signed_aggregate(entity_count=20), self.our_cert)
+        event = dict(self.good_event, descriptorType='SPSSODescriptor')
+        self.assertTrue(store_metadata(root, event, self.our_key, self.our_cert))
+        first = fixtures.scan_items(dynamo_db)
+        self.assertGreater(len(first), 0)
+
+        with mock.patch.object(EntitySigner, 'sign', autospec=True, side_effect=EntitySigner.sign) as signer:
+            self.assertTrue(store_metadata(root, event, self.our_key, self.our_cert))
+            self.assertEqual(signer.call_count, 0)
+
+        second = fixtures.scan_items(dynamo_db)
+        for entity_id, item in second.items():
+            self.assertEqual(item['etag'], first[entity_id]['etag'])
+            self.assertEqual(item['last_changed'], first[entity_id]['last_changed'])
+            self.assertGreater(float(item['last_seen']['N']), float(first[entity_id]['last_seen']['N']))
+
+        # A new validUntil changes every signed document
+        root.attrib['validUntil'] = '2030-01-01T00:00:00Z'
+        with mock.patch.object(EntitySigner, 'sign', autospec=True, side_effect=EntitySigner.sign) as signer:
+            self.assertTrue(store_metadata(root, event, self.our_key, self.our_cert))
+            self.assertEqual(signer.call_count, len(first))
+
+        third = fixtures.scan_items(dynamo_db)
+        for entity_id, item in third.items():
+            self.assertNotEqual(item['etag'], first[entity_id]['etag'])
+
+    @mock_dynamodb2
+    def test_store_metadata_signature_renewal(self):
+        """
+        Checks signatures carry our own validity window and are renewed only when due
+        """
+        dynamo_db = get_dynamodb_client()
+        fixtures.create_metadata_table(dynamo_db)
+
+        document = fixtures.build_signed_aggregate(entity_count=20, valid_until='2099-01-01T00:00:00Z')
+        root = get_and_validate_metadata(document, self.our_cert)
+        event = dict(self.good_event, descriptorType='SPSSODescriptor', signatureValidity=96, renewBefore=24)
+        now = current_timestamp()
+        feed_state = {}
+        self.assertTrue(store_metadata(root, event, self.our_key, self.our_cert, feed_state))
+
+        first = fixtures.scan_items(dynamo_db)
+        self.assertGreater(len(first), 0)
+        for item in first.values():
+            expiry = float(item['valid_until']['N'])
+            self.assertAlmostEqual(expiry, now + 96 * 3600, delta=60)
+            self.assertIn('validUntil="%s"' % format_xml_datetime(expiry), item['metadata']['S'])
+        self.assertAlmostEqual(feed_state['renewBy'], now + 72 * 3600, delta=60)
+
+        # A new publication of the aggregate does not touch our signatures
+        root.attrib['validUntil'] = '2098-01-01T00:00:00Z'
+        with mock.patch.object(EntitySigner, 'sign', autospec=True, side_effect=EntitySigner.sign) as signer:
+            self.assertTrue(store_metadata(root, event, self.our_key, self.our_cert))
+            self.assertEqual(signer.call_count, 0)
+
+        # Past the renewal margin every signature is renewed
+        later = now + 80 * 3600
+        with mock.patch('src.lambda_scripts.importMetadata.current_timestamp', return_value=later), \
+                mock.patch.object(EntitySigner, 'sign', autospec=True, side_effect=EntitySigner.sign) as signer:
+            self.assertTrue(store_metadata(root, event, self.our_key, self.our_cert))
+            self.assertEqual(signer.call_count, len(first))
+
+        renewed = fixtures.scan_items(dynamo_db)
+        for entity_id, item in renewed.items():
+            self.assertEqual(float(item['valid_until']['N']), later + 96 * 3600)
+            self.assertNotEqual(item['etag'], first[entity_id]['etag'])
+            self.assertEqual(item['source_digest'], first[entity_id]['source_digest'])
+
+    def test_renewal_schedule_aggregate_limit(self):
+        """
+        Checks our validity window never extends past the aggregate's validUntil
+        """
+        limit = parse_xml_datetime('2030-01-01T00:00:00Z')
+        schedule = RenewalSchedule(limit - 3600, 96 * 3600, 24 * 3600, '2030-01-01T00:00:00Z', {})
+        self.assertEqual(schedule.valid_until, limit)
+        self.assertEqual(schedule.valid_until_text, '2030-01-01T00:00:00Z')
+        self.assertTrue(schedule.is_due('unknown entity'))
+
+        schedule = RenewalSchedule(limit - 3600, 96 * 3600, 24 * 3600, None, {})
+        self.assertEqual(schedule.valid_until, limit - 3600 + 96 * 3600)
+
+    @mock_dynamodb2
+    def test_store_metadata_without_provider_index(self):
+        """
+        Checks imports into a table without the provider index scan for the stored digests instead
+        """
+        dynamo_db = get_dynamodb_client()
+        fixtures.create_metadata_table(dynamo_db, index=False)
+        root = get_and_validate_metadata(fixtures.build_signed_aggregate(entity_count=10), self.our_cert)
+        event = dict(self.good_event, descriptorType='SPSSODescriptor', sweepStale=True)
+        self.assertTrue(store_metadata(root, event, self.our_key, self.our_cert))
+        stored = fixtures.scan_items(dynamo_db)
+        self.assertGreater(len(stored), 0)
+
+        with mock.patch.object(EntitySigner, 'sign', autospec=True, side_effect=EntitySigner.sign) as signer:
+            self.assertTrue(store_metadata(root, event, self.our_key, self.our_cert))
+            self.assertEqual(signer.call_count, 0)
+        self.assertEqual(set(fixtures.scan_items(dynamo_db)), set(stored))
+
+    @mock_dynamodb2
+    def test_store_metadata_force_resign(self):
+        """
+        Checks forceResign signs every entity again
+        """
+        dynamo_db = get_dynamodb_client()
+        fixtures.create_metadata_table(dynamo_db)
+
+        root = get_and_validate_metadata(fixtures.build_signed_aggregate(entity_count=10), self.our_cert)
+        event = dict(self.good_event, descriptorType='IDPSSODescriptor')
+        store_metadata(root, event, self.our_key, self.our_cert)
+
+        event['forceResign'] = True
+        with mock.patch.object(EntitySigner, 'sign', autospec=True, side_effect=EntitySigner.sign) as signer:
+            store_metadata(root, event, self.our_key, self.our_cert)
+            self.assertEqual(signer.call_count, len(fixtures.scan_items(dynamo_db)))
+
+    @mock_dynamodb2
+    def test_store_metadata_sweeps_stale_entities(self):
+        """
+        Checks entities that dropped out of the feed are deleted with their documents and aliases
+        """
+        dynamo_db = get_dynamodb_client()
+        fixtures.create_metadata_table(dynamo_db)
+        other_provider = MetadataWriter(DynamoDbStore(dynamo_db), 1500000000.0)
+        other_provider.put('https://other.example.org', 'Other', b'<EntityDescriptor/>', 'digest')
+        other_provider.close()
+
+        event = dict(self.good_event, descriptorType='SPSSODescriptor', sweepStale=True)
+        root = get_and_validate_metadata(fixtures.build_signed_aggregate(entity_count=20), self.our_cert)
+        self.assertTrue(store_metadata(root, event, self.our_key, self.our_cert))
+        stored = set(fixtures.scan_items(dynamo_db))
+
+        # A failed write keeps the sweep from running
+        root = get_and_validate_metadata(fixtures.build_signed_aggregate(entity_count=10), self.our_cert)
+        remaining = set(entity.attrib['entityID'] for entity in root.iter(URN + 'EntityDescriptor')
+                        if entity.find(URN + 'SPSSODescriptor') is not None)
+        self.assertLess(len(remaining), len(stored) - 1)
+        with mock.patch('src.lambda_scripts.importMetadata.touch_last_seen', return_value=None), \
+                mock.patch('src.lambda_scripts.importMetadata.sweep_stale_entities') as sweep:
+            self.assertTrue(store_metadata(root, event, self.our_key, self.our_cert))
+            self.assertEqual(sweep.call_count, 0)
+
+        with mock.patch.object(dynamo_db, 'scan', wraps=dynamo_db.scan) as scan, \
+                mock.patch('src.lambda_scripts.importMetadata.get_dynamodb_client', return_value=dynamo_db):
+            timestamp = current_timestamp()
+            self.assertTrue(store_metadata(root, event, self.our_key, self.our_cert))
+            # The digests of the import and the sweep are read from the provider index, never by a scan
+            self.assertEqual(scan.call_count, 0)
+            counts = sweep_stale_entities('again', 'SPSSODescriptor', timestamp, DynamoDbStore(dynamo_db))
+            self.assertEqual(counts, {'deleted': 0, 'failed': 0})
+
+        self.assertEqual(set(fixtures.scan_items(dynamo_db)), remaining | {'https://other.example.org'})
+        keys = set()
+        for page in dynamo_db.get_paginator('scan').paginate(TableName='metadata'):
+            keys.update(item['entityID']['S'] for item in page['Items'])
+        for entity_id in stored - remaining - {'https://other.example.org'}:
+            self.assertNotIn(DOCUMENT_KEY_PREFIX + entity_id, keys)
+            self.assertNotIn(create_alias_item(entity_id)['entityID']['S'], keys)
+        self.assertEqual(len(keys), 3 * len(remaining) + 3)
+
+    @mock_dynamodb2
+    def test_store_metadata_sweeps_per_descriptor_type(self):
+        """
+        Checks the SP and IdP imports of one provider only sweep their own entities, and nothing is
+        swept unless asked for
+        """
+        dynamo_db = get_dynamodb_client()
+        fixtures.create_metadata_table(dynamo_db)
+        root = get_and_validate_metadata(fixtures.build_signed_aggregate(entity_count=20), self.our_cert)
+        entities = {}
+        for descriptor_type in ('SPSSODescriptor', 'IDPSSODescriptor'):
+            entities[descriptor_type] = set(entity.attrib['entityID'] for entity in root.iter(URN + 'EntityDescriptor')
+                                            if entity.find(URN + descriptor_type) is not None)
+            self.assertTrue(entities[descriptor_type])
+        self.assertFalse(entities['SPSSODescriptor'] & entities['IDPSSODescriptor'])
+
+        for descriptor_type in ('SPSSODescriptor', 'IDPSSODescriptor'):
+            event = dict(self.good_event, descriptorType=descriptor_type, sweepStale=True)
+            self.assertTrue(store_metadata(root, event, self.our_key, self.our_cert))
+        self.assertEqual(set(fixtures.scan_items(dynamo_db)),
+                         entities['SPSSODescriptor'] | entities['IDPSSODescriptor'])
+
+        # A later SP run sweeps the SPs it did not see, never the IdPs stored before it
+        root = get_and_validate_metadata(fixtures.build_signed_aggregate(entity_count=10), self.our_cert)
+        remaining = set(entity.attrib['entityID'] for entity in root.iter(URN + 'EntityDescriptor')
+                        if entity.find(URN + 'SPSSODescriptor') is not None)
+        self.assertLess(len(remaining), len(entities['SPSSODescriptor']))
+        self.assertTrue(store_metadata(root, dict(self.good_event, descriptorType='IDPSSODescriptor'),
+                                       self.our_key, self.our_cert))
+        self.assertEqual(set(fixtures.scan_items(dynamo_db)),
+                         entities['SPSSODescriptor'] | entities['IDPSSODescriptor'])
+        self.assertTrue(store_metadata(root, dict(self.good_event, descriptorType='SPSSODescriptor', sweepStale=True),
+                                       self.our_key, self.our_cert))
+        self.assertEqual(set(fixtures.scan_items(dynamo_db)), remaining | entities['IDPSSODescriptor'])
+
+    @mock_s3
+    @mock_dynamodb2
+    def test_store_metadata_publishes_documents(self):
+        """
+        Checks signed documents are published to S3 under both identifiers, once, and unpublished when stale
+        """
+        dynamo_db = get_dynamodb_client()
+        fixtures.create_metadata_table(dynamo_db)
+        s3 = get_s3_client()
+        fixtures.create_bucket(s3, 'published')
+
+        document = fixtures.build_signed_aggregate(entity_count=20, valid_until='2099-01-01T00:00:00Z')
+        root = get_and_validate_metadata(document, self.our_cert)
+        event = dict(self.good_event, descriptorType='SPSSODescriptor', publishBucket='published', sweepStale=True)
+        self.assertTrue(store_metadata(root, event, self.our_key, self.our_cert))
+
+        stored = fixtures.scan_items(dynamo_db)
+        keys = [entry['Key'] for entry in s3.list_objects_v2(Bucket='published')['Contents']]
+        self.assertEqual(len(keys), 2 * len(stored))
+        for entity_id, item in stored.items():
+            for key in ('entities/' + parse.quote(entity_id, safe=''),
+                        'entities/{sha1}' + hashlib.sha1(entity_id.encode('utf-8')).hexdigest()):
+                published = s3.get_object(Bucket='published', Key=key)
+                self.assertEqual(published['Body'].read().decode(), item['metadata']['S'])
+                self.assertEqual(published['ContentType'], 'application/samlmetadata+xml')
+                self.assertEqual(published['CacheControl'], 'public, max-age=21600')
+                self.assertEqual(published['ETag'], '"%s"' % item['etag']['S'])
+
+        # Documents signed again without a change are not uploaded again
+        event['forceResign'] = True
+        with mock.patch('src.lambda_scripts.importMetadata.get_s3_client', return_value=s3), \
+                mock.patch.object(s3, 'put_object', wraps=s3.put_object) as put_object:
+            self.assertTrue(store_metadata(root, event, self.our_key, self.our_cert))
+            self.assertEqual(put_object.call_count, 0)
+
+        # Published only, DynamoDb keeps the records of stale entities to sweep. moto's S3 loses some
+        # of the deletions it is sent at the same time, so the sweep unpublishes one entity at a time.
+        unpublish_lock = threading.Lock()
+
+        def unpublish(publisher, entity_id, unpublish=DocumentPublisher.unpublish):
+            with unpublish_lock:
+                return unpublish(publisher, entity_id)
+
+        root = get_and_validate_metadata(fixtures.build_signed_aggregate(entity_count=10), self.our_cert)
+        event = dict(event, publishOnly=True, forceResign=False)
+        with mock.patch.object(DocumentPublisher, 'unpublish', unpublish):
+            self.assertTrue(store_metadata(root, event, self.our_key, self.our_cert))
+        remaining = fixtures.scan_items(dynamo_db)
+        self.assertLess(len(remaining), len(stored))
+        keys = [entry['Key'] for entry in s3.list_objects_v2(Bucket='published')['Contents']]
+        self.assertEqual(len(keys), 2 * len(remaining))
+        self.assertIn('entities/' + parse.quote(sorted(remaining)[0], safe=''), keys)
+
+        writer = MetadataWriter(DynamoDbStore(dynamo_db), 1500000000.0, store_documents=False)
+        writer.put('https://new.example.org', 'again', b'<EntityDescriptor/>', 'digest')
+        writer.close()
+        self.assertNotIn('metadata', fixtures.scan_items(dynamo_db)['https://new.example.org'])
+
+    @mock_dynamodb2
+    def test_metadata_writer_batches_puts(self):
+        """
+        Checks puts are grouped into BatchWriteItem calls of 8 entities on a single client
+        """
+        dynamo_db = get_dynamodb_client()
+        fixtures.create_metadata_table(dynamo_db)
+
+        with mock.patch.object(dynamo_db, 'batch_write_item', wraps=dynamo_db.batch_write_item) as batch_write:
+            writer = MetadataWriter(DynamoDbStore(dynamo_db), 1500000000.0)
+            for number in range(60):
+                writer.put('https://sp%d.example.org' % number, 'Provider', b'<doc/>', 'digest')
+            counts = writer.close()
+
+        self.assertEqual(batch_write.call_count, 8)
+        self.assertEqual(counts['put'], 60)
+        self.assertEqual(counts['failed'], 0)
+
+        items = fixtures.scan_items(dynamo_db)
+        self.assertEqual(len(items), 60)
+        self.assertEqual(items['https://sp7.example.org']['source_digest']['S'], 'digest')
+        self.assertEqual(items['https://sp7.example.org']['etag']['S'], hashlib.md5(b'<doc/>').hexdigest())
+        self.assertEqual(items['https://sp7.example.org']['metadata']['S'], '<doc/>')
+        alias = dynamo_db.get_item(TableName='metadata',
+                                   Key={'entityID': {'S': '{sha1}' + hashlib.sha1(b'https://sp7.example.org').hexdigest()}})
+        self.assertEqual(alias['Item']['entity']['S'], 'https://sp7.example.org')
+
+    @mock_dynamodb2
+    def test_metadata_writer_resends_unprocessed_items(self):
+        """
+        Checks items DynamoDb did not process are sent again
+        """
+        dynamo_db = get_dynamodb_client()
+        fixtures.create_metadata_table(dynamo_db)
+        batch_write_item = dynamo_db.batch_write_item
+
+        def throttled(RequestItems):
+            if throttled.calls == 0:
+                requests = RequestItems['metadata']
+                batch_write_item(RequestItems={'metadata': requests[:10]})
+                throttled.calls += 1
+                return {'UnprocessedItems': {'metadata': requests[10:]}}
+            throttled.calls += 1
+            return batch_write_item(RequestItems=RequestItems)
+        throttled.calls = 0
+
+        with mock.patch.object(dynamo_db, 'batch_write_item', side_effect=throttled):
+            writer = MetadataWriter(DynamoDbStore(dynamo_db), 1500000000.0)
+            for number in range(25):
+                writer.put('https://sp%d.example.org' % number, 'Provider', b'<doc/>', 'digest')
+            counts = writer.close()
+
+        self.assertEqual(throttled.calls, 5)
+        self.assertEqual(counts['put'], 25)
+        self.assertEqual(len(fixtures.scan_items(dynamo_db)), 25)
+
+    @mock_dynamodb2
+    def test_metadata_writer_conditional_writes(self):
+        """
+        Checks conditional updates keep last_changed for identical documents and touches only refresh last_seen
+        """
+        dynamo_db = get_dynamodb_client()
+        fixtures.create_metadata_table(dynamo_db)
+
+        writer = MetadataWriter(DynamoDbStore(dynamo_db), 100.0)
+        writer.update('https://sp.example.org', 'Provider', b'<doc/>', 'digest')
+        writer.close()
+
+        writer = MetadataWriter(DynamoDbStore(dynamo_db), 200.0)
+        writer.update('https://sp.example.org', 'Provider', b'<doc/>', 'digest')
+        writer.touch('https://missing.example.org')
+        counts = writer.close()
+
+        self.assertEqual(counts['updated'], 1)
+        self.assertEqual(counts['failed'], 1)
+
+        items = fixtures.scan_items(dynamo_db)
+        self.assertEqual(list(items), ['https://sp.example.org'])
+        self.assertEqual(items['https://sp.example.org']['last_changed']['N'], '100.0')
+        self.assertEqual(items['https://sp.example.org']['last_seen']['N'], '200.0')
+        alias = dynamo_db.get_item(TableName='metadata',
+                                   Key={'entityID': {'S': '{sha1}' + hashlib.sha1(b'https://sp.example.org').hexdigest()}})
+        self.assertEqual(alias['Item']['entity']['S'], 'https://sp.example.org')
+
+    def test_download_metadata_conditional(self):
+        """
+        Checks the stored validators are sent, a 304 short-circuits and gzip bodies are decoded
+        """
+        document = fixtures.build_signed_aggregate(entity_count=3)
+        server = fixtures.AggregateServer(document)
+        self.addCleanup(server.stop)
+
+        handle, feed_state = download_metadata(server.url)
+        self.assertEqual(handle.read(), document)
+        self.assertEqual(server.requests[-1]['Accept-Encoding'], 'gzip')
+        self.assertEqual(feed_state, {'etag': server.etag, 'lastModified': server.last_modified})
+
+        handle, same_state = download_metadata(server.url, feed_state)
+        self.assertIsNone(handle)
+        self.assertEqual(same_state, feed_state)
+        self.assertEqual(server.requests[-1]['If-None-Match'], server.etag)
+        self.assertEqual(server.requests[-1]['If-Modified-Since'], server.last_modified)
+
+        server.publish(document + b'\n')
+        handle, new_state = download_metadata(server.url, feed_state)
+        self.assertEqual(handle.read(), document + b'\n')
+        self.assertNotEqual(new_state['etag'], feed_state['etag'])
+
+    @mock_s3
+    @mock_dynamodb2
+    def test_lambda_handler_not_modified(self):
+        """
+        Checks an unchanged aggregate is neither verified nor signed again, only marked as seen
+        """
+        server = fixtures.AggregateServer(fixtures.build_signed_aggregate(entity_count=10))
+        self.addCleanup(server.stop)
+
+        s3 = get_s3_client()
+        fixtures.create_bucket(s3, 'keys')
+        fixtures.create_bucket(s3, 'state')
+        s3.put_object(Bucket='keys', Key='provider.pem', Body=self.our_cert)
+        s3.put_object(Bucket='keys', Key='ours.pem', Body=self.our_cert)
+        s3.put_object(Bucket='keys', Key='ours.key', Body=self.our_key)
+
+        dynamo_db = get_dynamodb_client()
+        fixtures.create_metadata_table(dynamo_db)
+
+        event = {
+            'keyBucket': 'keys',
+            'stateBucket': 'state',
+            'metadataUrl': server.url,
+            'providerName': 'Provider',
+            'providerSigningCert': 'provider.pem',
+            'ourSigningCert': 'ours.pem',
+            'ourSigningKey': 'ours.key',
+            'tableName': 'metadata',
+            'descriptorType': 'IDPSSODescriptor'
+        }
+        lambda_handler(event, None)
+        first = fixtures.scan_items(dynamo_db)
+        self.assertGreater(len(first), 0)
+
+        response = s3.get_object(Bucket='state', Key='feeds/Provider/IDPSSODescriptor.json')
+        feed_state = json.loads(response['Body'].read())
+        self.assertEqual(feed_state['etag'], server.etag)
+
+        with mock.patch('src.lambda_scripts.importMetadata.verify_metadata_root') as verify:
+            lambda_handler(event, None)
+            self.assertEqual(verify.call_count, 0)
+
+        second = fixtures.scan_items(dynamo_db)
+        for entity_id, item in second.items():
+            self.assertEqual(item['etag'], first[entity_id]['etag'])
+            self.assertGreater(float(item['last_seen']['N']), float(first[entity_id]['last_seen']['N']))
+
+    @mock_s3
+    @mock_dynamodb2
+    def test_lambda_handler_renews_unchanged_aggregate(self):
+        """
+        Checks an unchanged aggregate is downloaded again once signatures are due for renewal
+        """
+        server = fixtures.AggregateServer(
+            fixtures.build_signed_aggregate(entity_count=10, valid_until='2099-01-01T00:00:00Z'))
+        self.addCleanup(server.stop)
+
+        s3 = get_s3_client()
+        fixtures.create_bucket(s3, 'keys')
+        fixtures.create_bucket(s3, 'state')
+        s3.put_object(Bucket='keys', Key='provider.pem', Body=self.our_cert)
+        s3.put_object(Bucket='keys', Key='ours.pem', Body=self.our_cert)
+        s3.put_object(Bucket='keys', Key='ours.key', Body=self.our_key)
+
+        dynamo_db = get_dynamodb_client()
+        fixtures.create_metadata_table(dynamo_db)
+
+        event = {
+            'keyBucket': 'keys',
+            'stateBucket': 'state',
+            'metadataUrl': server.url,
+            'providerName': 'Provider',
+            'providerSigningCert': 'provider.pem',
+            'ourSigningCert': 'ours.pem',
+            'ourSigningKey': 'ours.key',
+            'tableName': 'metadata',
+            'descriptorType': 'IDPSSODescriptor',
+            'signatureValidity': 48
+        }
+        lambda_handler(event, None)
+        first = fixtures.scan_items(dynamo_db)
+        response = s3.get_object(Bucket='state', Key='feeds/Provider/IDPSSODescriptor.json')
+        feed_state = json.loads(response['Body'].read())
+
+        lambda_handler(event, None)
+        self.assertEqual(server.requests[-1].get('If-None-Match'), server.etag)
+
+        with mock.patch('src.lambda_scripts.importMetadata.current_timestamp',
+                        return_value=feed_state['renewBy'] + 1):
+            lambda_handler(event, None)
+        self.assertNotIn('If-None-Match', server.requests[-1])
+
+        renewed = fixtures.scan_items(dynamo_db)
+        for entity_id, item in renewed.items():
+            self.assertGreater(float(item['valid_until']['N']), float(first[entity_id]['valid_until']['N']))
+
+    @mock_s3
+    @mock_dynamodb2
+    def test_lambda_handler_sharded(self):
+        """
+        Checks shard workers import the same entities as a single invocation would
+        """
+        # The dummy data lists one entityID twice from entity 20 on
+        document = fixtures.build_signed_aggregate(entity_count=20)
+        server = fixtures.AggregateServer(document)
+        self.addCleanup(server.stop)
+
+        s3 = get_s3_client()
+        fixtures.create_bucket(s3, 'keys')
+        fixtures.create_bucket(s3, 'state')
+        s3.put_object(Bucket='keys', Key='provider.pem', Body=self.our_cert)
+        s3.put_object(Bucket='keys', Key='ours.pem', Body=self.our_cert)
+        s3.put_object(Bucket='keys', Key='ours.key', Body=self.our_key)
+
+        dynamo_db = get_dynamodb_client()
+        fixtures.create_metadata_table(dynamo_db)
+
+        event = {
+            'keyBucket': 'keys',
+            'stateBucket': 'state',
+            'metadataUrl': server.url,
+            'providerName': 'Provider',
+            'providerSigningCert': 'provider.pem',
+            'ourSigningCert': 'ours.pem',
+            'ourSigningKey': 'ours.key',
+            'tableName': 'metadata',
+            'descriptorType': 'SPSSODescriptor',
+            'shardSize': 7,
+            'shardConcurrency': 2
+        }
+        with mock.patch.object(LocalShardExecutor, 'invoke', autospec=True,
+                               side_effect=LocalShardExecutor.invoke) as invoke:
+            lambda_handler(event, None)
+
+        shards = [call[0][1]['shard'] for call in invoke.call_args_list]
+        self.assertEqual(sorted((shard['start'], shard['stop']) for shard in shards),
+                         [(0, 7), (7, 14), (14, 20)])
+        self.assertNotIn('Contents', s3.list_objects_v2(Bucket='state', Prefix=STAGING_PREFIX))
+        self.assertIn('Contents', s3.list_objects_v2(Bucket='state', Prefix=FEED_STATE_PREFIX))
+
+        root = etree.fromstring(document)
+        expected = [item.attrib['entityID'] for item in root.iter(URN + 'EntityDescriptor')
+                    if item.find(URN + 'SPSSODescriptor') is not None]
+        self.assertEqual(sorted(fixtures.scan_items(dynamo_db)), sorted(expected))
+
+        # A single invocation finds nothing left to sign
+        single = dict(event, conditionalFetch=False)
+        del single['shardSize']
+        with mock.patch.object(EntitySigner, 'sign', autospec=True, side_effect=EntitySigner.sign) as signer:
+            lambda_handler(single, None)
+            self.assertEqual(signer.call_count, 0)
+
+    @mock_s3
+    @mock_dynamodb2
+    def test_import_sharded_failure(self):
+        """
+        Checks a failed shard fails the import and keeps the feed state from being saved
+        """
+        document = fixtures.build_signed_aggregate(entity_count=10)
+        s3 = get_s3_client()
+        fixtures.create_bucket(s3, 'keys')
+        fixtures.create_bucket(s3, 'state')
+        s3.put_object(Bucket='keys', Key='ours.pem', Body=self.our_cert)
+        s3.put_object(Bucket='keys', Key='ours.key', Body=self.our_key)
+        fixtures.create_metadata_table(get_dynamodb_client())
+
+        event = dict(self.good_event, keyBucket='keys', stateBucket='state', providerName='Provider',
+                     ourSigningCert='ours.pem', ourSigningKey='ours.key', descriptorType='SPSSODescriptor', shardSize=4)
+        handle = tempfile.SpooledTemporaryFile()
+        handle.write(document)
+
+        original = import_shard
+
+        def failing_shard(shard_event):
+            if shard_event['shard']['start'] == 4:
+                sys.exit(6)
+            return original(shard_event)
+
+        feed_state = {}
+        with mock.patch('src.lambda_scripts.importMetadata.import_shard', side_effect=failing_shard):
+            self.assertFalse(import_sharded(handle, 'validUntil', event, feed_state))
+        self.assertNotIn('Contents', s3.list_objects_v2(Bucket='state', Prefix=STAGING_PREFIX))
+
+    @mock_s3
+    @mock_dynamodb2
+    def test_lambda_handler_checkpoint_resume(self):
+        """
+        Checks an import that runs out of time saves a checkpoint and the next invocation finishes it
+        """
+        document = fixtures.build_signed_aggregate(entity_count=20)
+        server = fixtures.AggregateServer(document)
+        self.addCleanup(server.stop)
+
+        s3 = get_s3_client()
+        fixtures.create_bucket(s3, 'keys')
+        fixtures.create_bucket(s3, 'state')
+        s3.put_object(Bucket='keys', Key='provider.pem', Body=self.our_cert)
+        s3.put_object(Bucket='keys', Key='ours.pem', Body=self.our_cert)
+        s3.put_object(Bucket='keys', Key='ours.key', Body=self.our_key)
+
+        dynamo_db = get_dynamodb_client()
+        fixtures.create_metadata_table(dynamo_db)
+
+        event = {
+            'keyBucket': 'keys',
+            'stateBucket': 'state',
+            'metadataUrl': server.url,
+            'providerName': 'Provider',
+            'providerSigningCert': 'provider.pem',
+            'ourSigningCert': 'ours.pem',
+            'ourSigningKey': 'ours.key',
+            'tableName': 'metadata',
+            'descriptorType': 'SPSSODescriptor',
+            'checkpointMargin': 10
+        }
+        lambda_handler(event, fixtures.FakeContext(calls=8))
+
+        response = s3.get_object(Bucket='state', Key='checkpoints/Provider/SPSSODescriptor.json')
+        checkpoint = json.loads(response['Body'].read())
+        self.assertEqual(checkpoint['entityIndex'], 7)
+        self.assertIn('Contents', s3.list_objects_v2(Bucket='state', Prefix=STAGING_PREFIX))
+        self.assertNotIn('Contents', s3.list_objects_v2(Bucket='state', Prefix=FEED_STATE_PREFIX))
+        first = fixtures.scan_items(dynamo_db)
+
+        entities = list(etree.fromstring(document).iter(URN + 'EntityDescriptor'))
+        remaining = [item for item in entities[8:] if item.find(URN + 'SPSSODescriptor') is not None]
+        with mock.patch('src.lambda_scripts.importMetadata.verify_metadata_root') as verify, \
+                mock.patch.object(EntitySigner, 'sign', autospec=True, side_effect=EntitySigner.sign) as signer:
+            lambda_handler(event, fixtures.FakeContext())
+            self.assertEqual(verify.call_count, 0)
+            self.assertEqual(signer.call_count, len(remaining))
+        self.assertEqual(len(server.requests), 1)
+
+        self.assertNotIn('Contents', s3.list_objects_v2(Bucket='state', Prefix=CHECKPOINT_PREFIX))
+        self.assertNotIn('Contents', s3.list_objects_v2(Bucket='state', Prefix=STAGING_PREFIX))
+        self.assertIn('Contents', s3.list_objects_v2(Bucket='state', Prefix=FEED_STATE_PREFIX))
+
+        items = fixtures.scan_items(dynamo_db)
+        expected = [item.attrib['entityID'] for item in entities if item.find(URN + 'SPSSODescriptor') is not None]
+        self.assertEqual(sorted(items), sorted(expected))
+        for entity_id, item in items.items():
+            self.assertEqual(item['last_changed']['N'], str(checkpoint['timestamp']))
+            if entity_id in first:
+                self.assertEqual(item['etag'], first[entity_id]['etag'])
+
+    @mock_s3
+    @mock_dynamodb2
+    def test_lambda_handler_feeds(self):
+        """
+        Checks feeds imported together store each entity once, under the first feed carrying it
+        """
+        first_server = fixtures.AggregateServer(fixtures.build_signed_aggregate(entity_count=6))
+        second_server = fixtures.AggregateServer(fixtures.build_signed_aggregate(entity_count=12))
+        self.addCleanup(first_server.stop)
+        self.addCleanup(second_server.stop)
+
+        s3 = get_s3_client()
+        fixtures.create_bucket(s3, 'keys')
+        fixtures.create_bucket(s3, 'state')
+        s3.put_object(Bucket='keys', Key='provider.pem', Body=self.our_cert)
+        s3.put_object(Bucket='keys', Key='ours.pem', Body=self.our_cert)
+        s3.put_object(Bucket='keys', Key='ours.key', Body=self.our_key)
+        dynamo_db = get_dynamodb_client()
+        fixtures.create_metadata_table(dynamo_db)
+
+        first = {'metadataUrl': first_server.url, 'providerName': 'First', 'providerSigningCert': 'provider.pem'}
+        second = {'metadataUrl': second_server.url, 'providerName': 'Second', 'providerSigningCert': 'provider.pem'}
+        event = {
+            'keyBucket': 'keys',
+            'stateBucket': 'state',
+            'ourSigningCert': 'ours.pem',
+            'ourSigningKey': 'ours.key',
+            'tableName': 'metadata',
+            'descriptorType': 'IDPSSODescriptor',
+            'feeds': [first, second]
+        }
+        first_ids = set(entity.attrib['entityID'] for entity in
+                        etree.fromstring(first_server.document).iter(URN + 'EntityDescriptor')
+                        if entity.find(URN + 'IDPSSODescriptor') is not None)
+
+        reports = import_feeds(event)
+        # The feeds shared the container's client
+        self.assertIs(get_dynamodb_client(), dynamo_db)
+        self.assertEqual([report['status'] for report in reports.values()], ['imported', 'imported'])
+        for report in reports.values():
+            self.assertGreater(report['fetch'], 0)
+            self.assertGreater(report['verify'], 0)
+            self.assertGreater(report['store'], 0)
+        self.assertEqual(reports['First']['skipped'], 0)
+        self.assertGreater(len(first_ids), 0)
+        self.assertEqual(reports['Second']['skipped'], len(first_ids))
+
+        items = fixtures.scan_items(dynamo_db)
+        self.assertGreater(len(items), len(first_ids))
+        for entity_id, item in items.items():
+            self.assertEqual(item['provider']['S'], 'First' if entity_id in first_ids else 'Second')
+
+        # Neither feed changed, so their entities are only marked as seen
+        reports = import_feeds(event)
+        self.assertEqual([report['status'] for report in reports.values()], ['notModified', 'notModified'])
+        self.assertEqual(set(fixtures.scan_items(dynamo_db)), set(items))
+
+        # The other order of precedence hands the shared entities over, without sweeping them
+        lambda_handler(dict(event, feeds=[second, first], conditionalFetch=False), None)
+        swapped = fixtures.scan_items(dynamo_db)
+        self.assertEqual(set(swapped), set(items))
+        for item in swapped.values():
+            self.assertEqual(item['provider']['S'], 'Second')
+
+    @mock_s3
+    def test_read_cached_file_from_s3(self):
+        """
+        Checks warm reads come from the cache and are revalidated against the ETag after the TTL
+        """
+        s3_mock = get_s3_client()
+        fixtures.create_bucket(s3_mock, self.bucket.lower())
+        s3_mock.put_object(Bucket=self.bucket.lower(), Key=self.file_name, Body=b'first')
+
+        with mock.patch('src.lambda_scripts.importMetadata.get_s3_client', wraps=get_s3_client) as client:
+            self.assertEqual(read_cached_file_from_s3(self.file_name, self.bucket.lower()), b'first')
+            self.assertEqual(read_cached_file_from_s3(self.file_name, self.bucket.lower()), b'first')
+            self.assertEqual(client.call_count, 1)
+
+            # Expired but unchanged: a conditional request keeps the cached copy
+            self.assertEqual(read_cached_file_from_s3(self.file_name, self.bucket.lower(), ttl=0), b'first')
+            self.assertEqual(client.call_count, 2)
+
+            s3_mock.put_object(Bucket=self.bucket.lower(), Key=self.file_name, Body=b'second')
+            self.assertEqual(read_cached_file_from_s3(self.file_name, self.bucket.lower()), b'first')
+            self.assertEqual(read_cached_file_from_s3(self.file_name, self.bucket.lower(), ttl=0), b'second')
+
+    def test_load_signing_material_once(self):
+        """
+        Checks keys and certificates are parsed once and sign exactly like their PEM
+        """
+        key = load_signing_key(self.our_key)
+        self.assertIs(key, load_signing_key(self.our_key))
+        self.assertIs(load_x509_certificate(self.our_cert), load_x509_certificate(self.our_cert.encode()))
+        self.assertEqual(len(load_cert_chain(self.our_cert)), 1)
+
+        root = etree.fromstring(fixtures.build_signed_aggregate(entity_count=3))
+        entity = next(root.iter(URN + 'EntityDescriptor'))
+        xml_signer = create_xml_signer()
+        from_pem = create_document(sign_fragment(create_standalone_fragment(entity, 'one', 'validUntil'),
+                                                 xml_signer, self.our_key, self.our_cert))
+        parsed = create_document(sign_fragment(create_standalone_fragment(entity, 'one', 'validUntil'),
+                                               xml_signer, key, load_cert_chain(self.our_cert)))
+        self.assertEqual(from_pem, parsed)
+
+    def _signed_content(self, document):
+        verified = signxml.XMLVerifier().verify(document.encode(), x509_cert=self.our_cert)
+        return etree.tostring(verified.signed_xml, method='c14n', exclusive=True)
+
     @staticmethod
     def _get_our_cert():
         handle_cert = open('src/tests/dummy_our_cert.crt', 'r')
@@ -0,0 +1,166 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from moto import mock_dynamodb2
+
+from src.lambda_scripts import importMetadata, queryMetadata
+from src.lambda_scripts.metadataStore import *
+from src.tests import fixtures
+
+
+class MetadataStoreTestCase(unittest.TestCase):
+    """
+    Runs the same checks against every backend
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        MEMORY_STORES.clear()
+        CLIENTS.clear()
+        environment = fixtures.aws_environment()
+        environment.start()
+        self.addCleanup(environment.stop)
+
+    def tearDown(self):
+        for store in SQLITE_STORES.values():
+            store.close()
+        SQLITE_STORES.clear()
+        shutil.rmtree(self.directory)
+
+    def _stores(self):
+        dynamo_db = importMetadata.get_dynamodb_client()
+        fixtures.create_metadata_table(dynamo_db)
+        return [DynamoDbStore(dynamo_db), MemoryStore(), SQLiteStore(os.path.join(self.directory, 'metadata.db'))]
+
+    @mock_dynamodb2
+    def test_records_and_conditional_updates(self):
+        """
+        Checks conditional updates, touches and the provider lookups behave alike
+        """
+        for store in self._stores():
+            with self.subTest(store=type(store).__name__):
+                values = {'provider': {'S': 'Provider'}, 'etag': {'S': 'one'}, 'last_seen': {'N': '100'},
+                          'metadata': {'S': 'legacy'}, 'source_digest': {'S': 'digest'}}
+                self.assertTrue(store.update_record('https://sp.example.org', values))
+                self.assertFalse(store.update_record('https://sp.example.org', values, ['metadata'], 'one'))
+                self.assertTrue(store.update_record('https://sp.example.org', dict(values, etag={'S': 'two'}),
+                                                    ['metadata'], 'two'))
+                self.assertTrue(store.touch_record('https://sp.example.org', {'last_seen': {'N': '200'}}))
+                self.assertFalse(store.touch_record('https://missing.example.org', {'last_seen': {'N': '200'}}))
+
+                item = store.get_item('https://sp.example.org', consistent=True)
+                self.assertEqual(item['etag'], {'S': 'two'})
+                self.assertEqual(item['last_seen'], {'N': '200'})
+                self.assertNotIn('metadata', item)
+                self.assertEqual(store.get_item('https://sp.example.org', ['etag'])['etag'], {'S': 'two'})
+                self.assertIsNone(store.get_item('https://missing.example.org'))
+
+                store.put_item({'entityID': {'S': '#document#https://sp.example.org'}, 'metadata': {'B': b'\x1f\x8b'}})
+                store.put_item({'entityID': {'S': 'https://old.example.org'}, 'provider': {'S': 'Provider'},
+                                'descriptor_type': {'S': 'SPSSODescriptor'}, 'last_seen': {'N': '50'}})
+                store.put_item({'entityID': {'S': 'https://untyped.example.org'}, 'provider': {'S': 'Provider'},
+                                'last_seen': {'N': '50'}})
+                self.assertEqual(store.get_item('#document#https://sp.example.org')['metadata'], {'B': b'\x1f\x8b'})
+                self.assertEqual(sorted(store.entity_ids()), ['https://old.example.org', 'https://sp.example.org',
+                                                              'https://untyped.example.org'])
+                self.assertEqual(list(store.stale_entity_ids('Provider', 'SPSSODescriptor', 150)),
+                                 ['https://old.example.org'])
+                self.assertEqual(list(store.stale_entity_ids('Provider', 'IDPSSODescriptor', 150)), [])
+                self.assertEqual(list(store.stale_entity_ids('Other', 'SPSSODescriptor', 150)), [])
+                records = dict((item['entityID']['S'], item) for item in store.provider_records('Provider',
+                                                                                                ['source_digest']))
+                self.assertEqual(records['https://sp.example.org'],
+                                 {'entityID': {'S': 'https://sp.example.org'}, 'source_digest': {'S': 'digest'}})
+                self.assertEqual(sorted(records), ['https://old.example.org', 'https://sp.example.org',
+                                                   'https://untyped.example.org'])
+
+    def test_incomplete_backend(self):
+        """
+        Checks a backend missing an operation cannot be created
+        """
+
+        class PutOnlyStore(MetadataStore):
+            def put_item(self, item):
+                pass
+
+        with self.assertRaises(TypeError):
+            PutOnlyStore()
+
+    @mock_dynamodb2
+    def test_batches(self):
+        """
+        Checks batch writes and reads across more than one BatchGetItem chunk
+        """
+        keys = ['https://sp%d.example.org' % number for number in range(150)]
+        for store in self._stores():
+            with self.subTest(store=type(store).__name__):
+                for start in range(0, len(keys), 25):
+                    self.assertEqual(store.batch_write([{'PutRequest': {'Item': {
+                        'entityID': {'S': key}, 'etag': {'S': 'etag'}, 'entity': {'S': key}}}}
+                        for key in keys[start:start + 25]]), [])
+                store.batch_write([{'DeleteRequest': {'Key': {'entityID': {'S': keys[0]}}}}])
+
+                items = store.batch_get_items(keys + ['https://missing.example.org'], ['etag'], consistent=True)
+                self.assertEqual(sorted(items), sorted(keys[1:]))
+                self.assertEqual(items[keys[1]], {'entityID': {'S': keys[1]}, 'etag': {'S': 'etag'}})
+
+    @mock_dynamodb2
+    def test_batch_get_items_chunks_and_retries(self):
+        """
+        Checks keys are read in chunks of 100 and unprocessed keys are asked for again
+        """
+        dynamo_db = importMetadata.get_dynamodb_client()
+        fixtures.create_metadata_table(dynamo_db)
+        keys = ['https://sp%d.example.org' % number for number in range(150)]
+        for key in keys:
+            dynamo_db.put_item(TableName='metadata', Item={'entityID': {'S': key}, 'etag': {'S': 'etag'}})
+        batch_get_item = dynamo_db.batch_get_item
+
+        def throttled(RequestItems):
+            throttled.calls += 1
+            if throttled.calls == 1:
+                request = RequestItems['metadata']
+                response = batch_get_item(RequestItems={'metadata': dict(request, Keys=request['Keys'][:30])})
+                response['UnprocessedKeys'] = {'metadata': dict(request, Keys=request['Keys'][30:])}
+                return response
+            return batch_get_item(RequestItems=RequestItems)
+        throttled.calls = 0
+
+        with mock.patch.object(dynamo_db, 'batch_get_item', side_effect=throttled):
+            items = DynamoDbStore(dynamo_db).batch_get_items(keys + ['https://missing.example.org'], ['etag'])
+
+        self.assertEqual(throttled.calls, 3)
+        self.assertEqual(sorted(items), sorted(keys))
+
+    def test_import_and_query_without_aws(self):
+        """
+        Checks an import into a SQLite store is served by queryMetadata from the same file
+        """
+        our_cert = fixtures.read_our_cert()
+        spec = 'sqlite:' + os.path.join(self.directory, 'metadata.db')
+        root = importMetadata.get_and_validate_metadata(fixtures.build_signed_aggregate(entity_count=6), our_cert)
+        event = {'providerName': 'Provider', 'descriptorType': 'SPSSODescriptor', 'metadataStore': spec,
+                 'tableName': 'entities'}
+        self.assertTrue(importMetadata.store_metadata(root, event, fixtures.read_our_key(), our_cert))
+
+        store = open_store(spec, 'entities')
+        self.assertIs(store, importMetadata.get_metadata_store(event))
+        entity_ids = sorted(store.entity_ids())
+        self.assertGreater(len(entity_ids), 0)
+
+        queryMetadata.ENTITY_CACHE.clear()
+        with mock.patch('src.lambda_scripts.queryMetadata.METADATA_STORE', spec), \
+                mock.patch('src.lambda_scripts.queryMetadata.METADATA_TABLE', 'entities'), \
+                mock.patch('src.lambda_scripts.queryMetadata.get_dynamodb_client') as get_client:
+            event = {'params': {'path': {'entityId': entity_ids[0]}, 'header': {'If-None-Match': ''}}}
+            response = queryMetadata.lambda_handler(event, None)
+            self.assertIn(entity_ids[0], response['metadata'])
+            self.assertEqual(get_client.call_count, 0)
+        queryMetadata.ENTITY_CACHE.clear()
+
+
+if __name__ == '__main__':
+    unittest.main()
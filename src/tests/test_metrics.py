@@ -0,0 +1,168 @@
+import threading
+import unittest
+from unittest import mock
+
+from moto import mock_dynamodb2
+
+from src.lambda_scripts import importMetadata, metrics, queryMetadata
+from src.lambda_scripts.metadataStore import CLIENTS, DynamoDbStore
+from src.lambda_scripts.metrics import *
+from src.tests import fixtures
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        queryMetadata.ENTITY_CACHE.clear()
+        CLIENTS.clear()
+        environment = fixtures.aws_environment()
+        environment.start()
+        self.addCleanup(environment.stop)
+
+    def test_records_follow_emf(self):
+        """
+        Checks values are split into records of at most 100 per metric and counters are summed
+        """
+        recorder = MetricsRecorder('MDQ', {'Function': 'importMetadata'})
+        recorder.set_dimension('Provider', 'Provider')
+        recorder.set_property('requestId', 'request')
+        for number in range(150):
+            recorder.put('SignTime', float(number), 'Milliseconds')
+            recorder.count('Changed')
+
+        first, second = recorder.records(timestamp=1500000000.0)
+        self.assertEqual(first['_aws'], {'Timestamp': 1500000000000, 'CloudWatchMetrics': [{
+            'Namespace': 'MDQ', 'Dimensions': [['Function', 'Provider']],
+            'Metrics': [{'Name': 'SignTime', 'Unit': 'Milliseconds'}, {'Name': 'Changed', 'Unit': 'Count'}]}]})
+        self.assertEqual(first['Function'], 'importMetadata')
+        self.assertEqual(first['Provider'], 'Provider')
+        self.assertEqual(first['requestId'], 'request')
+        self.assertEqual(first['SignTime'], [float(number) for number in range(100)])
+        self.assertEqual(first['Changed'], 150)
+        self.assertEqual(second['SignTime'], [float(number) for number in range(100, 150)])
+        self.assertNotIn('Changed', second)
+        self.assertEqual(second['_aws']['CloudWatchMetrics'][0]['Metrics'], [{'Name': 'SignTime',
+                                                                             'Unit': 'Milliseconds'}])
+
+        sampled = MetricsRecorder('MDQ', {}, max_values=10)
+        for number in range(1000):
+            sampled.put('Latency', number)
+        values = sampled.records()[0]['Latency']
+        self.assertEqual(len(values), 10)
+        self.assertGreater(max(values), 10)
+
+    def test_disabled_scope_records_nothing(self):
+        """
+        Checks handlers run without a recorder unless metrics are enabled
+        """
+        handler = metric_scope('handler')(lambda event, context: metrics.current())
+        with mock.patch.object(metrics, 'emit_record') as emit:
+            self.assertIs(handler({}, None), NULL_RECORDER)
+            with NULL_RECORDER.timer('Duration'):
+                NULL_RECORDER.count('Changed')
+            self.assertEqual(emit.call_count, 0)
+
+            with mock.patch.object(metrics, 'METRICS_ENABLED', True):
+                self.assertIsInstance(handler({}, None), MetricsRecorder)
+            self.assertIs(metrics.current(), NULL_RECORDER)
+            self.assertEqual(emit.call_count, 1)
+
+    def test_concurrent_scopes(self):
+        """
+        Checks handlers running at the same time on different threads record into their own
+        recorder, and work they hand to other threads records into it too
+        """
+        barrier = threading.Barrier(2)
+
+        def handle(event, context):
+            recorder = metrics.current()
+            barrier.wait()
+            worker = threading.Thread(target=metrics.bind(lambda: metrics.current().count(event['name'])))
+            worker.start()
+            worker.join()
+            barrier.wait()
+            return {'status': '200', 'same': metrics.current() is recorder}
+
+        handler = metric_scope('handler')(handle)
+        records = []
+        results = []
+        with mock.patch.object(metrics, 'METRICS_ENABLED', True), \
+                mock.patch.object(metrics, 'emit_record', side_effect=records.append):
+            threads = [threading.Thread(target=lambda name=name: results.append(handler({'name': name}, None)))
+                       for name in ('First', 'Second')]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual([result['same'] for result in results], [True, True])
+        self.assertEqual(sorted([name for name in ('First', 'Second') if name in record] for record in records),
+                         [['First'], ['Second']])
+
+    @mock_dynamodb2
+    def test_query_records(self):
+        """
+        Checks every query logs its status, cache hits and store time
+        """
+        dynamo_db = queryMetadata.get_dynamodb_client()
+        fixtures.create_metadata_table(dynamo_db)
+        writer = importMetadata.MetadataWriter(DynamoDbStore(dynamo_db), 1500000000.0)
+        writer.put('https://sp.example.org', 'Provider', b'<EntityDescriptor/>', 'digest')
+        writer.close()
+
+        records = []
+        with mock.patch.object(metrics, 'METRICS_ENABLED', True), \
+                mock.patch.object(metrics, 'emit_record', side_effect=records.append), \
+                mock.patch('src.lambda_scripts.queryMetadata.get_dynamodb_client', return_value=dynamo_db):
+            for entity_id in ('https://sp.example.org', 'https://sp.example.org', 'https://missing.example.org'):
+                event = {'params': {'path': {'entityId': entity_id}, 'header': {'If-None-Match': ''}}}
+                try:
+                    queryMetadata.lambda_handler(event, None)
+                except Exception:
+                    pass
+
+        self.assertEqual(len(records), 3)
+        self.assertEqual([record['Function'] for record in records], ['queryMetadata'] * 3)
+        self.assertEqual(records[0]['Status200'], 1)
+        self.assertEqual(records[0]['CacheMisses'], 1)
+        self.assertIn('StoreTime', records[0])
+        self.assertEqual(records[1]['CacheHits'], 1)
+        self.assertNotIn('StoreTime', records[1])
+        self.assertEqual(records[2]['Status404'], 1)
+        for record in records:
+            self.assertGreater(record['Duration'], 0)
+            names = [metric['Name'] for metric in record['_aws']['CloudWatchMetrics'][0]['Metrics']]
+            self.assertEqual(sorted(names), sorted(name for name in record if name not in ('_aws', 'Function')))
+
+    @mock_dynamodb2
+    def test_import_records(self):
+        """
+        Checks an import records its sign times, write latencies and entity counts
+        """
+        dynamo_db = importMetadata.get_dynamodb_client()
+        fixtures.create_metadata_table(dynamo_db)
+        our_cert = fixtures.read_our_cert()
+        root = importMetadata.get_and_validate_metadata(fixtures.build_signed_aggregate(entity_count=12), our_cert)
+        event = {'providerName': 'Provider', 'descriptorType': 'SPSSODescriptor', 'sweepStale': True}
+
+        recorder = MetricsRecorder('MDQ', {'Function': 'importMetadata'})
+        with metrics.recording(recorder), \
+                mock.patch('src.lambda_scripts.importMetadata.get_dynamodb_client', return_value=dynamo_db):
+            importMetadata.store_metadata(root, event, fixtures.read_our_key(), our_cert)
+            importMetadata.store_metadata(root, event, fixtures.read_our_key(), our_cert)
+            importMetadata.get_and_validate_metadata(fixtures.build_signed_aggregate(entity_count=1), our_cert)
+
+        record, = recorder.records()
+        stored = len(fixtures.scan_items(dynamo_db))
+        self.assertEqual(record['Changed'], stored)
+        self.assertEqual(record['Unchanged'], stored)
+        self.assertEqual(record['Failed'], 0)
+        self.assertEqual(record['Swept'], 0)
+        self.assertEqual(len(record['SignTime']), stored)
+        self.assertIn('BatchWriteLatency', record)
+        self.assertEqual(len(record['WriteLatency']), stored)
+        self.assertIsInstance(record['VerifyTime'], float)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,22 @@
+import os
 import sys
 import unittest
+import threading
 import time
+import base64
+import gzip
 import hashlib
+import subprocess
+from unittest import mock
 
-from moto import mock_dynamodb2
+import signxml
+from lxml import etree
+from moto import mock_dynamodb2, mock_s3
 
+from src.lambda_scripts import importMetadata
 from src.lambda_scripts.queryMetadata import *
+from src.lambda_scripts.metadataStore import CLIENTS, DynamoDbStore
+from src.tests import fixtures
 
 
 class QueryTestCase(unittest.TestCase):
@@ -43,6 +54,11 @@ class QueryTestCase(unittest.TestCase):
                 'header': ''
             }
         }
+        ENTITY_CACHE.clear()
+        CLIENTS.clear()
+        environment = fixtures.aws_environment()
+        environment.start()
+        self.addCleanup(environment.stop)
 
     def tearDown(self):
         """
@@ -82,6 +98,23 @@ class QueryTestCase(unittest.TestCase):
         dyna_db = get_dynamodb_client()
         self.assertEqual(dyna_db._endpoint.host, self.dynamo_url)
 
+    @mock_dynamodb2
+    def test_clients_are_created_once(self):
+        """
+        Checks warm invocations reuse the clients of the container, and importing the handler loads none
+        of the heavy dependencies
+        """
+        self.assertIs(get_dynamodb_client(), get_dynamodb_client())
+        self.assertIs(importMetadata.get_dynamodb_client(), get_dynamodb_client())
+        self.assertIsNot(get_s3_client(), get_dynamodb_client())
+
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        loaded = subprocess.check_output([sys.executable, '-c', 'import sys\n'
+                                          'from src.lambda_scripts import queryMetadata\n'
+                                          'print(" ".join(sys.modules))'], cwd=root).decode().split()
+        for module in ('boto3', 'botocore', 'lxml', 'signxml', 'cryptography', 'OpenSSL'):
+            self.assertNotIn(module, loaded)
+
     @mock_dynamodb2
     def test_get_db_record(self):
         """
@@ -117,7 +150,7 @@ class QueryTestCase(unittest.TestCase):
         print('second record added: ', response_two)
 
         dynamo_db_new = get_dynamodb_client()
-        result = get_db_record(dynamo_db_new, 'https://ci.unicon_test.net/shibboleth')
+        result = get_db_record(DynamoDbStore(dynamo_db_new), 'https://ci.unicon_test.net/shibboleth')
 
         self.assertEqual(etag_one, result)
 
@@ -156,10 +189,356 @@ class QueryTestCase(unittest.TestCase):
         print('second record added: ', response_two)
 
         dynamo_db_new = get_dynamodb_client()
-        result = get_db_record(dynamo_db_new, 'https://ci.unicon_test_two.net/shibboleth_WRONG')
+        result = get_db_record(DynamoDbStore(dynamo_db_new), 'https://ci.unicon_test_two.net/shibboleth_WRONG')
 
         self.assertNotEqual(etag_one, result)
 
+    @mock_dynamodb2
+    def test_lambda_handler_cached(self):
+        """
+        Checks repeated lookups of an entity are answered from the cache without DynamoDb
+        """
+        dynamo_db = get_dynamodb_client()
+        fixtures.create_metadata_table(dynamo_db)
+        etag = hashlib.md5(b'document').hexdigest()
+        dynamo_db.put_item(TableName='metadata', Item={'entityID': {'S': 'entityIDValue'},
+                                                       'metadata': {'S': '<EntityDescriptor/>'},
+                                                       'etag': {'S': etag}})
+
+        with mock.patch('src.lambda_scripts.queryMetadata.get_db_item', wraps=get_db_item) as get_item:
+            for _ in range(3):
+                response = lambda_handler(self.good_event, None)
+                self.assertEqual(response['metadata'], '<EntityDescriptor/>')
+                self.assertEqual(response['headers']['etag'], 'W/"%s"' % etag)
+
+            event = {'params': {'path': {'entityId': 'entityIDValue'}, 'header': {'If-None-Match': etag}}}
+            with self.assertRaises(Exception) as error:
+                lambda_handler(event, None)
+            self.assertEqual(str(error.exception), '304')
+
+            self.assertEqual(get_item.call_count, 1)
+
+        self.assertEqual(ENTITY_CACHE.stats()['hits'], 3)
+        self.assertEqual(ENTITY_CACHE.stats()['misses'], 1)
+
+    @mock_dynamodb2
+    def test_conditional_request_reads_etag_only(self):
+        """
+        Checks a matching If-None-Match is answered from the small record, without reading the document
+        """
+        dynamo_db = get_dynamodb_client()
+        fixtures.create_metadata_table(dynamo_db)
+        document = b'<EntityDescriptor>' + b'x' * 20000 + b'</EntityDescriptor>'
+        writer = importMetadata.MetadataWriter(DynamoDbStore(dynamo_db), 1500000000.0)
+        writer.put('entityIDValue', 'Provider', document, 'digest')
+        writer.close()
+        etag = hashlib.md5(document).hexdigest()
+
+        bytes_read = []
+        dynamo_db.meta.events.register('after-call.dynamodb.GetItem',
+                                       lambda http_response, **kwargs: bytes_read.append(len(http_response.content)))
+
+        event = {'params': {'path': {'entityId': 'entityIDValue'}, 'header': {'If-None-Match': etag}}}
+        with mock.patch('src.lambda_scripts.queryMetadata.get_dynamodb_client', return_value=dynamo_db):
+            with self.assertRaises(Exception) as error:
+                lambda_handler(event, None)
+            self.assertEqual(str(error.exception), '304')
+            not_modified = list(bytes_read)
+
+            del bytes_read[:]
+            event['params']['header']['If-None-Match'] = 'W/"outdated"'
+            response = lambda_handler(event, None)
+            self.assertEqual(response['metadata'], document.decode())
+            self.assertEqual(response['headers']['etag'], 'W/"%s"' % etag)
+            modified = list(bytes_read)
+
+        print('bytes read per 304: %d, per 200: %d' % (sum(not_modified), sum(modified)))
+        self.assertEqual(len(not_modified), 1)
+        self.assertLess(sum(not_modified), 1024)
+        self.assertGreater(sum(modified), len(gzip.compress(document, mtime=0)))
+
+    @mock_dynamodb2
+    def test_lambda_handler_gzip_passthrough(self):
+        """
+        Checks documents are stored compressed and returned as stored to clients that accept gzip
+        """
+        dynamo_db = get_dynamodb_client()
+        fixtures.create_metadata_table(dynamo_db)
+        document = b'<EntityDescriptor entityID="entityIDValue">' + b'<md:Extensions/>' * 1000 + \
+            b'</EntityDescriptor>'
+        writer = importMetadata.MetadataWriter(DynamoDbStore(dynamo_db), 1500000000.0)
+        writer.put('entityIDValue', 'Provider', document, 'digest')
+        writer.close()
+
+        item = dynamo_db.get_item(TableName='metadata', Key={'entityID': {'S': DOCUMENT_KEY_PREFIX + 'entityIDValue'}})
+        stored = item['Item']['metadata']['B']
+        self.assertEqual(item['Item']['codec']['S'], 'gzip')
+        self.assertEqual(item['Item']['etag']['S'], hashlib.md5(document).hexdigest())
+        self.assertLess(len(stored), len(document) / 10)
+
+        event = {'params': {'path': {'entityId': 'entityIDValue'},
+                            'header': {'If-None-Match': '', 'Accept-Encoding': 'deflate, gzip;q=0.8'}}}
+        # Off by default, as API Gateway has to be set up for binary responses
+        with mock.patch('src.lambda_scripts.queryMetadata.get_dynamodb_client', return_value=dynamo_db):
+            response = lambda_handler(event, None)
+        self.assertEqual(response['metadata'], document.decode())
+        self.assertNotIn('Content-Encoding', response['headers'])
+        self.assertNotIn('isBase64Encoded', response)
+
+        gzip_responses = mock.patch('src.lambda_scripts.queryMetadata.GZIP_RESPONSES', True)
+        gzip_responses.start()
+        self.addCleanup(gzip_responses.stop)
+        ENTITY_CACHE.clear()
+        with mock.patch('src.lambda_scripts.queryMetadata.get_dynamodb_client', return_value=dynamo_db), \
+                mock.patch.object(gzip, 'decompress', wraps=gzip.decompress) as decompress, \
+                mock.patch.object(gzip, 'compress', wraps=gzip.compress) as compress:
+            response = lambda_handler(event, None)
+            self.assertEqual(decompress.call_count, 0)
+            self.assertEqual(compress.call_count, 0)
+        self.assertTrue(response['isBase64Encoded'])
+        self.assertEqual(response['headers']['Content-Encoding'], 'gzip')
+        self.assertEqual(base64.b64decode(response['metadata']), stored)
+
+        # Served from the cache, compressed, and decompressed only for clients without gzip
+        for accept_encoding in ('identity', 'gzip;q=0'):
+            event['params']['header']['Accept-Encoding'] = accept_encoding
+            with mock.patch('src.lambda_scripts.queryMetadata.get_dynamodb_client') as get_client:
+                response = lambda_handler(event, None)
+                self.assertEqual(get_client.call_count, 0)
+            self.assertEqual(response['metadata'], document.decode())
+            self.assertNotIn('Content-Encoding', response['headers'])
+            self.assertNotIn('isBase64Encoded', response)
+
+        # Documents stored before compression are still served
+        dynamo_db.put_item(TableName='metadata', Item={'entityID': {'S': DOCUMENT_KEY_PREFIX + 'legacy'},
+                                                       'metadata': {'S': '<EntityDescriptor/>'},
+                                                       'etag': {'S': 'legacy'}})
+        event['params']['path']['entityId'] = 'legacy'
+        event['params']['header']['Accept-Encoding'] = 'gzip'
+        with mock.patch('src.lambda_scripts.queryMetadata.get_dynamodb_client', return_value=dynamo_db):
+            response = lambda_handler(event, None)
+        self.assertEqual(gzip.decompress(base64.b64decode(response['metadata'])), b'<EntityDescriptor/>')
+
+    @mock_s3
+    @mock_dynamodb2
+    def test_lambda_handler_offloaded_document(self):
+        """
+        Checks a document too large for its item is stored in S3 under its digest and served from there
+        """
+        dynamo_db = get_dynamodb_client()
+        fixtures.create_metadata_table(dynamo_db)
+        s3 = get_s3_client()
+        fixtures.create_bucket(s3, 'documents')
+        # Random logos hardly compress
+        logo = base64.b64encode(os.urandom(600 * 1024))
+        document = b'<EntityDescriptor><Logo>' + logo + b'</Logo></EntityDescriptor>'
+
+        writer = importMetadata.MetadataWriter(DynamoDbStore(dynamo_db), 1500000000.0, document_bucket='documents')
+        writer.put('https://large.example.org', 'Provider', document, 'digest')
+        writer.put('https://small.example.org', 'Provider', b'<EntityDescriptor/>', 'digest')
+        self.assertEqual(writer.close()['put'], 2)
+        importMetadata.update_dynamodb('https://updated.example.org', 'Provider', document, 1500000000.0,
+                                       'digest', DynamoDbStore(dynamo_db), document_bucket='documents')
+
+        objects = s3.list_objects_v2(Bucket='documents')['Contents']
+        compressed = gzip.compress(document, mtime=0)
+        # Both entities share the object of their identical document
+        self.assertEqual([entry['Key'] for entry in objects],
+                         ['documents/%s.xml.gz' % hashlib.sha256(compressed).hexdigest()])
+        item = dynamo_db.get_item(TableName='metadata',
+                                  Key={'entityID': {'S': DOCUMENT_KEY_PREFIX + 'https://large.example.org'}})['Item']
+        self.assertNotIn('metadata', item)
+        self.assertEqual(item['s3_key']['S'], objects[0]['Key'])
+        self.assertEqual(item['etag']['S'], hashlib.md5(document).hexdigest())
+
+        with mock.patch('src.lambda_scripts.queryMetadata.get_dynamodb_client', return_value=dynamo_db), \
+                mock.patch('src.lambda_scripts.queryMetadata.GZIP_RESPONSES', True):
+            event = {'params': {'path': {'entityId': 'https://large.example.org'},
+                                'header': {'If-None-Match': '', 'Accept-Encoding': 'gzip'}}}
+            response = lambda_handler(event, None)
+            self.assertEqual(base64.b64decode(response['metadata']), compressed)
+
+            event = {'params': {'header': {'If-None-Match': ''}},
+                     'body-json': {'entityIds': ['https://small.example.org', 'https://updated.example.org']}}
+            response = lambda_handler(event, None)
+            self.assertIn(document.decode(), response['metadata'])
+            self.assertIn('<EntityDescriptor/>', response['metadata'])
+
+    @mock_s3
+    @mock_dynamodb2
+    def test_lambda_handler_entity_filter(self):
+        """
+        Checks identifiers ruled out by the published entity filter are answered without reading DynamoDb
+        """
+        dynamo_db = get_dynamodb_client()
+        fixtures.create_metadata_table(dynamo_db)
+        s3 = get_s3_client()
+        fixtures.create_bucket(s3, 'filters')
+        our_cert = fixtures.read_our_cert()
+        root = importMetadata.get_and_validate_metadata(fixtures.build_signed_aggregate(entity_count=12), our_cert)
+        event = {'providerName': 'Provider', 'descriptorType': 'SPSSODescriptor', 'filterBucket': 'filters'}
+        with mock.patch('src.lambda_scripts.importMetadata.get_dynamodb_client', return_value=dynamo_db):
+            importMetadata.store_metadata(root, event, fixtures.read_our_key(), our_cert)
+        stored = sorted(fixtures.scan_items(dynamo_db))
+
+        clock = mock.Mock(return_value=0.0)
+        entity_filter = EntityFilter('filters', 300, clock)
+        with mock.patch('src.lambda_scripts.queryMetadata.ENTITY_FILTER', entity_filter), \
+                mock.patch('src.lambda_scripts.queryMetadata.get_dynamodb_client', return_value=dynamo_db):
+            sha1 = hashlib.sha1(stored[0].encode('utf-8')).hexdigest()
+            for identifier in (stored[0], '{sha1}' + sha1.upper()):
+                event = {'params': {'path': {'entityId': identifier}, 'header': {'If-None-Match': ''}}}
+                self.assertEqual(lambda_handler(event, None)['status'], '200')
+
+            with mock.patch.object(dynamo_db, 'get_item') as get_item, \
+                    mock.patch.object(dynamo_db, 'batch_get_item') as batch_get:
+                for identifier in ('https://unknown.example.org', '{sha1}' + '0' * 40):
+                    event = {'params': {'path': {'entityId': identifier}, 'header': {'If-None-Match': ''}}}
+                    with self.assertRaises(Exception) as error:
+                        lambda_handler(event, None)
+                    self.assertEqual(str(error.exception), '404')
+                event = {'params': {'header': {'If-None-Match': ''}},
+                         'body-json': {'entityIds': ['https://unknown.example.org']}}
+                with self.assertRaises(Exception) as error:
+                    lambda_handler(event, None)
+                self.assertEqual(str(error.exception), '404')
+                self.assertEqual(get_item.call_count + batch_get.call_count, 0)
+            self.assertEqual(entity_filter.rejected, 3)
+
+            # A newer filter is picked up once the loaded one is older than the TTL
+            dynamo_db.put_item(TableName='metadata', Item=importMetadata.create_metadata_item(
+                'https://new.example.org', 'Provider', b'<EntityDescriptor/>', 1500000000.0, 'digest'))
+            importMetadata.publish_entity_filter('filters', store=DynamoDbStore(dynamo_db))
+            self.assertFalse(entity_filter.might_contain('https://new.example.org'))
+            clock.return_value = 300.0
+            self.assertTrue(entity_filter.might_contain('https://new.example.org'))
+
+    @mock_dynamodb2
+    def test_lambda_handler_sha1_identifier(self):
+        """
+        Checks entities can be asked for by entityID and by {sha1} identifier
+        """
+        dynamo_db = get_dynamodb_client()
+        fixtures.create_metadata_table(dynamo_db)
+        entity_id = 'https://sp.example.org/shibboleth'
+        writer = importMetadata.MetadataWriter(DynamoDbStore(dynamo_db), 1500000000.0)
+        writer.put(entity_id, 'Provider', b'<EntityDescriptor/>', 'digest')
+        writer.close()
+        sha1 = hashlib.sha1(entity_id.encode('utf-8')).hexdigest()
+
+        identifiers = [parse.quote(entity_id, safe=''), '{sha1}' + sha1, parse.quote('{sha1}' + sha1.upper())]
+        for identifier in identifiers:
+            ENTITY_CACHE.clear()
+            event = {'params': {'path': {'entityId': identifier}, 'header': {'If-None-Match': ''}}}
+            with mock.patch.object(dynamo_db, 'get_item', wraps=dynamo_db.get_item) as get_item, \
+                    mock.patch('src.lambda_scripts.queryMetadata.get_dynamodb_client', return_value=dynamo_db):
+                response = lambda_handler(event, None)
+            self.assertEqual(response['metadata'], '<EntityDescriptor/>')
+            # The alias is one keyed read on top of the document
+            self.assertEqual(get_item.call_count, 1 if identifier == identifiers[0] else 2)
+
+        event = {'params': {'path': {'entityId': '{sha1}' + '0' * 40}, 'header': {'If-None-Match': ''}}}
+        with self.assertRaises(Exception) as error:
+            lambda_handler(event, None)
+        self.assertEqual(str(error.exception), '404')
+
+    @mock_dynamodb2
+    def test_lambda_handler_batch(self):
+        """
+        Checks a batch request returns the entities asked for in one EntitiesDescriptor with intact signatures
+        """
+        dynamo_db = get_dynamodb_client()
+        fixtures.create_metadata_table(dynamo_db)
+        our_cert = fixtures.read_our_cert()
+        root = importMetadata.get_and_validate_metadata(fixtures.build_signed_aggregate(entity_count=12), our_cert)
+        with mock.patch('src.lambda_scripts.importMetadata.get_dynamodb_client', return_value=dynamo_db):
+            importMetadata.store_metadata(root, {'providerName': 'Provider', 'descriptorType': 'SPSSODescriptor'},
+                                          fixtures.read_our_key(), our_cert)
+        stored = sorted(fixtures.scan_items(dynamo_db))
+        self.assertGreater(len(stored), 3)
+
+        asked = [stored[2], '{sha1}' + hashlib.sha1(stored[0].encode('utf-8')).hexdigest(),
+                 'https://unknown.example.org', stored[1]]
+        event = {'params': {'header': {'If-None-Match': ''}}, 'body-json': {'entityIds': asked}}
+        with mock.patch.object(dynamo_db, 'get_item', wraps=dynamo_db.get_item) as get_item, \
+                mock.patch('src.lambda_scripts.queryMetadata.get_dynamodb_client', return_value=dynamo_db):
+            response = lambda_handler(event, None)
+            self.assertEqual(get_item.call_count, 0)
+
+        entities = etree.fromstring(response['metadata'].encode('utf-8'))
+        self.assertEqual(entities.tag, '{urn:oasis:names:tc:SAML:2.0:metadata}EntitiesDescriptor')
+        self.assertEqual([entity.get('entityID') for entity in entities], [stored[2], stored[0], stored[1]])
+        for entity in entities:
+            verified = signxml.XMLVerifier().verify(etree.tostring(entity), x509_cert=our_cert)
+            self.assertEqual(verified.signed_xml.get('entityID'), entity.get('entityID'))
+
+        # The combined etag revalidates without reading the documents
+        ENTITY_CACHE.clear()
+        event['params']['header']['If-None-Match'] = response['headers']['etag']
+        with mock.patch.object(dynamo_db, 'batch_get_item', wraps=dynamo_db.batch_get_item) as batch_get, \
+                mock.patch('src.lambda_scripts.queryMetadata.get_dynamodb_client', return_value=dynamo_db):
+            with self.assertRaises(Exception) as error:
+                lambda_handler(event, None)
+            self.assertEqual(str(error.exception), '304')
+        for call in batch_get.call_args_list:
+            self.assertNotIn('metadata', call[1]['RequestItems']['metadata']['AttributesToGet'])
+
+    def test_entity_cache_ttl_and_budget(self):
+        """
+        Checks cached entities expire after the TTL and the least recently used go first
+        """
+        now = [0.0]
+        cache = EntityCache(ttl=10, max_bytes=40, clock=lambda: now[0])
+
+        cache.put('a', 'etag-a', 'x' * 10)
+        cache.put('b', 'etag-b', 'x' * 10)
+        self.assertEqual(cache.get('a'), ('etag-a', 'x' * 10))
+
+        # 'b' is the least recently used entity when 'c' needs room
+        cache.put('c', 'etag-c', 'x' * 10)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertLessEqual(cache.stats()['bytes'], 40)
+
+        # Larger than the whole budget
+        cache.put('d', 'etag-d', 'x' * 100)
+        self.assertIsNone(cache.get('d'))
+        self.assertIsNotNone(cache.get('a'))
+
+        now[0] = 10.0
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNone(cache.get('c'))
+        self.assertEqual(cache.stats(), {'hits': 2, 'misses': 4, 'evictions': 1, 'entries': 0, 'bytes': 0})
+
+    def test_entity_cache_threads(self):
+        """
+        Checks threads sharing the cache, as bench_query_load's do, keep its entries and counters consistent
+        """
+        cache = EntityCache(ttl=60, max_bytes=400)
+        rounds = 2000
+
+        def use(number):
+            for step in range(rounds):
+                entity_id = 'entity%d' % ((number * 7 + step) % 50)
+                if cache.get(entity_id) is None:
+                    cache.put(entity_id, 'etag', 'x' * 20)
+
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            threads = [threading.Thread(target=use, args=(number,)) for number in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(interval)
+
+        stats = cache.stats()
+        self.assertEqual(stats['hits'] + stats['misses'], 8 * rounds)
+        self.assertEqual(stats['bytes'], sum(entry[3] for entry in cache.entries.values()))
+        self.assertLessEqual(stats['bytes'], 400)
+
     def _create_db_table(self, dynamo_db):
         """
         Method to build dynamo db for testing.